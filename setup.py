@@ -29,10 +29,17 @@ setup(
     zip_safe=False,
     python_requires=">=3.6",
     install_requires=install_requires,
+    extras_require={
+        "s3": ["boto3>=1.35"],
+    },
     entry_points={
         "console_scripts": [
             "encrypt=itoko.cmd.encrypt:main",
             "decrypt=itoko.cmd.decrypt:main",
+            "reindex=itoko.cmd.reindex:main",
+            "sweep=itoko.cmd.sweep:main",
+            "shard=itoko.cmd.shard:main",
+            "migrate=itoko.cmd.migrate:main",
         ],
     }
 )
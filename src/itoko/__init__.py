@@ -5,8 +5,17 @@ import toml
 from flask import Flask
 
 from itoko.imp import import_object
+from itoko.crypto.kdf.cache import derived_key_cache
+from itoko.crypto.parallel import parallel_engine
+from itoko.fs.cache import hot_file_cache
+from itoko.fs.format import DEFAULT_CHUNK_SIZE
+from itoko.fs.generators import default_filename_generator
+from itoko.lookup import lookup_filter
+from itoko.stats import register_stats
 from itoko.db import db, init_db
 from itoko.api import api_blueprint
+from itoko.tasks import TaskRunner
+from itoko.tasks.sweeper import make_sweeper
 from itoko.ui import ui_blueprint
 
 __version__ = "1.0.0"
@@ -26,7 +35,33 @@ def make_app():
             readers=[
                 "itoko.fs.format.v1:ItokoV1FormatReader",
                 "itoko.fs.format.v2:ItokoV2FormatReader",
-            ]
+                "itoko.fs.format.v3:ItokoV3FormatReader",
+            ],
+        ),
+        ITOKO_CRYPTO=dict(
+            kdf_cache_size=0,
+            kdf_cache_ttl=300,
+            threads=0,
+            parallel_min_size=16 * 1024 * 1024,
+        ),
+        ITOKO_CACHE=dict(
+            folder="",
+            max_size=64 * 1024 * 1024,
+            max_file_size=1024 * 1024,
+            admission_misses=2,
+        ),
+        ITOKO_FILTER=dict(
+            capacity=0,
+            error_rate=0.01,
+        ),
+        ITOKO_STATS=dict(
+            enabled=False,
+        ),
+        ITOKO_TASKS=dict(
+            run_in_process=False,
+            temporary_ttl=0,
+            sweep_interval=1.0,
+            sweep_batch_size=100,
         ),
         ITOKO_UI=dict(
             abuse_email="abuse@itoko.moe",
@@ -36,11 +71,27 @@ def make_app():
         cfg = toml.load(os.getenv("ITOKO_CONFIG"))
         app.config.update(cfg)
 
-    # Make the uploads folder if it doesn't exist
-    os.makedirs(app.config["ITOKO_STORAGE"]["temporary_folder"], exist_ok=True)
-
-    # Make the permanent uploads folder if it doesn't exist
-    os.makedirs(app.config["ITOKO_STORAGE"]["permanent_folder"], exist_ok=True)
+    # Optional storage settings
+    app.config["ITOKO_STORAGE"].setdefault(
+        "backend", "itoko.fs.backends.filesystem:FilesystemBackend"
+    )
+    app.config["ITOKO_STORAGE"].setdefault("chunk_size", DEFAULT_CHUNK_SIZE)
+    app.config["ITOKO_STORAGE"].setdefault("sendfile", False)
+    app.config["ITOKO_STORAGE"].setdefault("accel_redirect", "")
+    app.config["ITOKO_STORAGE"].setdefault("shard_depth", 0)
+    app.config["ITOKO_STORAGE"].setdefault("fsync", "file")
+    app.config["ITOKO_STORAGE"].setdefault("node_id", 0)
+    app.config["ITOKO_STORAGE"].setdefault("blob_folder", "")
+    app.config["ITOKO_STORAGE"].setdefault("compression", "")
+
+    # Make the blob folder if deduplication is enabled
+    if app.config["ITOKO_STORAGE"]["blob_folder"]:
+        os.makedirs(app.config["ITOKO_STORAGE"]["blob_folder"], exist_ok=True)
+
+    # Filenames are only unique across nodes if every node has its own ID
+    default_filename_generator.configure(
+        app.config["ITOKO_STORAGE"]["node_id"]
+    )
 
     app.config["ITOKO_STORAGE"]["writer"] = import_object(
         app.config["ITOKO_STORAGE"]["writer"]
@@ -49,6 +100,48 @@ def make_app():
         import_object(reader)
         for reader in app.config["ITOKO_STORAGE"]["readers"]
     ]
+    app.config["ITOKO_STORAGE"]["backend"] = import_object(
+        app.config["ITOKO_STORAGE"]["backend"]
+    )
+
+    # Derived key cache is opt-in, a size of 0 keeps it disabled
+    derived_key_cache.configure(
+        max_size=app.config["ITOKO_CRYPTO"].get("kdf_cache_size", 0),
+        ttl=app.config["ITOKO_CRYPTO"].get("kdf_cache_ttl", 300),
+    )
+    register_stats("kdf_cache", derived_key_cache.stats)
+
+    # Hot file cache is opt-in too, an empty folder keeps it disabled
+    hot_file_cache.configure(
+        folder=app.config["ITOKO_CACHE"].get("folder", ""),
+        max_size=app.config["ITOKO_CACHE"].get("max_size", 64 * 1024 * 1024),
+        max_file_size=app.config["ITOKO_CACHE"].get(
+            "max_file_size", 1024 * 1024
+        ),
+        admission_misses=app.config["ITOKO_CACHE"].get(
+            "admission_misses", 2
+        ),
+    )
+    register_stats("hot_file_cache", hot_file_cache.stats)
+
+    # Lookup filter is opt-in, a capacity of 0 keeps it disabled. Processes
+    # sharing the database share the journal next to it by default.
+    lookup_filter.configure(
+        capacity=app.config["ITOKO_FILTER"].get("capacity", 0),
+        error_rate=app.config["ITOKO_FILTER"].get("error_rate", 0.01),
+        journal_path=app.config["ITOKO_FILTER"].get(
+            "journal", app.config["SQLITE3_DATABASE"] + "-filter"
+        ),
+    )
+    register_stats("lookup_filter", lookup_filter.stats)
+
+    # Parallel CTR engine is opt-in as well, 0 threads keeps it disabled
+    parallel_engine.configure(
+        threads=app.config["ITOKO_CRYPTO"].get("threads", 0),
+        min_size=app.config["ITOKO_CRYPTO"].get(
+            "parallel_min_size", 16 * 1024 * 1024
+        ),
+    )
 
     # Add sqlite3 extension
     db.init_app(app)
@@ -61,6 +154,26 @@ def make_app():
     app.register_blueprint(api_blueprint)
     app.register_blueprint(ui_blueprint)
 
+    # Background tasks are opt-in, and a TTL of 0 keeps files forever
+    tasks_cfg = app.config["ITOKO_TASKS"]
+    if tasks_cfg.get("run_in_process") and tasks_cfg.get("temporary_ttl"):
+        # Processes sharing the lock file run the tasks in one of them only
+        runner = TaskRunner(
+            app,
+            lock_path=tasks_cfg.get(
+                "lock_file", app.config["SQLITE3_DATABASE"] + "-tasks"
+            ),
+        )
+        with app.app_context():
+            sweeper = make_sweeper()
+        runner.add(sweeper, tasks_cfg.get("sweep_interval", 1.0))
+        register_stats("sweeper", sweeper.stats)
+        # Started by the process serving requests, pre-forking servers such
+        # as uWSGI load the app in a master process whose threads don't make
+        # it into the workers
+        app.before_request(runner.start)
+        app.extensions["itoko_tasks"] = runner
+
     return app
 
 
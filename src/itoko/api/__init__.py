@@ -1,29 +1,304 @@
-from io import BytesIO
+import os
+from typing import Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
 from flask import (
     Blueprint,
+    Response,
     current_app,
     abort,
     flash,
     jsonify,
-    make_response,
     redirect,
     request,
     render_template,
-    send_file,
     url_for,
 )
 
-from itoko.fs.storage import FSStorageType, FSStorage
-from itoko.fs.generators import default_key_generator
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
+
+from itoko.db import db
+from itoko.fs.backends import StorageBackend
+from itoko.fs.blobs import BlobStore
+from itoko.fs.cache import hot_file_cache
+from itoko.fs.format import FormatFile
+from itoko.fs.index import FileIndex
+from itoko.fs.payload import Payload, FilePayload
+from itoko.fs.storage import FSStorageType, FSyncPolicy, FSStorage
+from itoko.fs.generators import (
+    default_key_generator,
+    default_filename_generator,
+)
 from itoko.crypto.exc import DecryptionError
-from itoko.api.util import request_wants_json, get_content_disposition
+from itoko.lookup import lookup_filter
+from itoko.api.util import (
+    request_wants_json,
+    get_content_disposition,
+    get_etag,
+    accepts_encoding,
+    is_not_modified,
+    get_byte_ranges,
+)
 from itoko.shorten import shorten_filename, find_shortened
+from itoko.stats import collect_stats
 
 __all__ = ["api_blueprint"]
 
 api_blueprint = Blueprint("api", __name__, template_folder="templates")
 
+# Stored files never change, so permanent ones may be cached for a year, the
+# longest lifetime HTTP caches are expected to honor
+PERMANENT_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def get_backend() -> StorageBackend:
+    """
+    Returns the storage backend of the current app. It's built on first use
+    from the app configuration and kept, as backends may hold connections or
+    even the stored files.
+
+    :return: Storage backend.
+    """
+    backend = current_app.extensions.get("itoko_storage")
+    if backend is None:
+        st_cfg = current_app.config["ITOKO_STORAGE"]
+        # Threads racing here all end up with the first one stored
+        backend = current_app.extensions.setdefault(
+            "itoko_storage", st_cfg["backend"].from_config(st_cfg)
+        )
+    return backend
+
+
+def get_storage() -> FSStorage:
+    """
+    Builds the file storage handler from the current app configuration.
+
+    :return: Storage handler.
+    """
+    st_cfg = current_app.config["ITOKO_STORAGE"]
+    return FSStorage(
+        backend=get_backend(),
+        readers=[
+            reader() for reader in st_cfg["readers"]
+        ],
+        chunk_size=st_cfg["chunk_size"],
+        index=FileIndex(db),
+        blobs=(
+            BlobStore(
+                st_cfg["blob_folder"], db, FSyncPolicy(st_cfg["fsync"])
+            )
+            if st_cfg["blob_folder"]
+            else None
+        ),
+        compression=st_cfg["compression"] or None,
+    )
+
+
+def wrap_payload_file(
+    view: Payload, start: int, end: int, chunk_size: int
+) -> Optional[Iterable[bytes]]:
+    """
+    Hands a byte range of a stored payload to the WSGI server file wrapper, so
+    servers supporting it can send it straight from the kernel page cache with
+    sendfile(2). The file is positioned at the start of the range, which must
+    run up to the end of the stored file, as file wrappers send everything
+    past the current position.
+
+    :param view: View over the unencrypted payload of a lazily loaded file.
+    :param start: First byte of the range.
+    :param end: Byte after the last byte of the range.
+    :param chunk_size: Amount of bytes to read at once as a fallback.
+    :return: File wrapper or None if the range can't be sent this way.
+    """
+    # uWSGI's file wrapper always sends the whole file from its start
+    if not isinstance(view, FilePayload) or "uwsgi.version" in request.environ:
+        return None
+    fp = view.fp
+    if view.offset + end != os.fstat(fp.fileno()).st_size:
+        return None
+    fp.seek(view.offset + start)
+    return wrap_file(request.environ, fp, chunk_size)
+
+
+def get_accel_redirect(view: Payload) -> Optional[str]:
+    """
+    Makes the URI of the internal nginx location holding a payload, if it's a
+    whole deduplicated blob. Blobs are stored without any header, so nginx
+    can send them as they are, byte ranges included, with sendfile(2). See
+    accel_redirect in the storage configuration.
+
+    :param view: View over the unencrypted payload of a lazily loaded file.
+    :return: URI to redirect to or None if the payload isn't a blob.
+    """
+    st_cfg = current_app.config["ITOKO_STORAGE"]
+    if not (
+        st_cfg["accel_redirect"]
+        and st_cfg["blob_folder"]
+        and isinstance(view, FilePayload)
+    ):
+        return None
+    fp = view.fp
+    if view.offset or len(view) != os.fstat(fp.fileno()).st_size:
+        return None
+    path = os.path.relpath(fp.name, st_cfg["blob_folder"])
+    if path.startswith(os.pardir):
+        return None
+    return "{}/{}".format(
+        st_cfg["accel_redirect"].rstrip("/"),
+        quote(path.replace(os.sep, "/")),
+    )
+
+
+def set_cache_headers(
+    response: Response,
+    etag: str,
+    last_modified: float,
+    permanent: bool,
+    private: bool,
+    vary_encoding: bool = False,
+    weak: bool = False,
+) -> None:
+    """
+    Adds validators and caching directives for a stored file to a response.
+
+    :param response: Response to a request for the file.
+    :param etag: Entity tag of the file.
+    :param last_modified: Modification timestamp of the stored file.
+    :param permanent: Whether the file is in permanent storage.
+    :param private: Whether shared caches must not store the response, as
+                    for decrypted files.
+    :param vary_encoding: Whether the response depends on Accept-Encoding, as
+                          for compressed files.
+    :param weak: Whether the entity tag is weak.
+    """
+    response.set_etag(etag, weak=weak)
+    response.last_modified = int(last_modified)
+    scope = "private" if private else "public"
+    if permanent:
+        response.headers["Cache-Control"] = "{}, max-age={}, immutable".format(
+            scope, PERMANENT_MAX_AGE
+        )
+    else:
+        # Temporary files expire, have clients revalidate, which is cheap
+        response.headers["Cache-Control"] = "{}, no-cache".format(scope)
+    if vary_encoding:
+        response.vary.add("Accept-Encoding")
+
+
+def make_file_response(
+    file: FormatFile,
+    ranges: Optional[List[Tuple[int, int]]],
+    chunk_size: int,
+    sendfile: bool = False,
+    encoded: bool = False,
+) -> Response:
+    """
+    Builds a streaming response for a decrypted file. If byte ranges are given
+    only those are read, as a single part for one range or as a
+    multipart/byteranges body for several. Compressed files may be sent as
+    they are stored instead, with their encoding as content coding.
+
+    :param file: Unencrypted file to send.
+    :param ranges: Sorted (start, end) byte ranges or None for the whole file.
+    :param chunk_size: Amount of bytes to read at once.
+    :param sendfile: Whether to hand whole stored payloads to the WSGI server
+                     file wrapper when possible.
+    :param encoded: Whether to send the compressed payload of the file as it
+                    is stored, without ranges.
+    :return: Response object, which closes the file once sent.
+    """
+    size = file.size
+    if encoded:
+        # Clients decompress it themselves, it's never decompressed here
+        view = file.encoded_view
+        body = None
+        if sendfile:
+            body = wrap_payload_file(view, 0, len(view), chunk_size)
+        if body is None:
+            body = view.iter_chunks(chunk_size=chunk_size)
+        response = Response(
+            body,
+            mimetype=file.mime_type,
+            direct_passthrough=True,
+        )
+        response.content_length = len(view)
+        response.content_encoding = file.encoding
+    elif not ranges:
+        body = None
+        if sendfile:
+            body = wrap_payload_file(file.view, 0, size, chunk_size)
+        if body is None:
+            body = file.iter_payload(chunk_size=chunk_size)
+        response = Response(
+            body,
+            mimetype=file.mime_type,
+            direct_passthrough=True,
+        )
+        response.content_length = size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        body = None
+        if sendfile:
+            body = wrap_payload_file(file.view, start, end, chunk_size)
+        if body is None:
+            body = file.iter_payload(start, end, chunk_size)
+        response = Response(
+            body,
+            status=206,
+            mimetype=file.mime_type,
+            direct_passthrough=True,
+        )
+        response.content_length = end - start
+        response.headers["Content-Range"] = "bytes {}-{}/{}".format(
+            start, end - 1, size
+        )
+    else:
+        boundary = os.urandom(16).hex()
+        parts = [
+            (
+                (
+                    "--{boundary}\r\n"
+                    "Content-Type: {mime_type}\r\n"
+                    "Content-Range: bytes {start}-{last}/{size}\r\n\r\n"
+                ).format(
+                    boundary=boundary,
+                    mime_type=file.mime_type,
+                    start=start,
+                    last=end - 1,
+                    size=size,
+                ).encode("latin-1"),
+                start,
+                end,
+            )
+            for start, end in ranges
+        ]
+        closing = "--{}--\r\n".format(boundary).encode("latin-1")
+
+        def multipart() -> Iterator[bytes]:
+            for part_header, start, end in parts:
+                yield part_header
+                yield from file.iter_payload(start, end, chunk_size)
+                yield b"\r\n"
+            yield closing
+
+        response = Response(
+            multipart(),
+            status=206,
+            mimetype="multipart/byteranges",
+            direct_passthrough=True,
+        )
+        response.headers["Content-Type"] = (
+            "multipart/byteranges; boundary={}".format(boundary)
+        )
+        response.content_length = len(closing) + sum(
+            len(part_header) + (end - start) + 2
+            for part_header, start, end in parts
+        )
+    response.headers["Accept-Ranges"] = "bytes"
+    response.call_on_close(file.close)
+    return response
+
 
 @api_blueprint.route("/upload", methods=["POST"])
 def upload_file():
@@ -32,13 +307,7 @@ def upload_file():
         return redirect(url_for("home_page"))
 
     st_cfg = current_app.config["ITOKO_STORAGE"]
-    fs = FSStorage(
-        temporary_folder=st_cfg["temporary_folder"],
-        permanent_folder=st_cfg["permanent_folder"],
-        readers=[
-            reader() for reader in st_cfg["readers"]
-        ]
-    )
+    fs = get_storage()
 
     r_file = request.files["file"]
     # Hacky way to check if the string contained is a true value.
@@ -50,22 +319,27 @@ def upload_file():
         flash("No file selected", category="error")
         return redirect(url_for("home_page"))
 
-    file = st_cfg["writer"](
-        payload=r_file.stream.read(),
-        filename=r_file.filename,
-    )
-
     key = None  # silence annoying warnings
     if encrypt:
         key = default_key_generator()
-        file = file.encrypt(key)
 
     if permanent:
         fst = FSStorageType.PERMANENT_STORAGE
     else:
         fst = FSStorageType.TEMPORARY_STORAGE
 
-    fs.write(fst, file)
+    # Stream the upload straight to disk instead of building it in memory
+    fs_filename = default_filename_generator()
+    fs.write_stream(
+        fst,
+        fs_filename,
+        st_cfg["writer"],
+        r_file.stream,
+        filename=r_file.filename,
+        key=key,
+        # Generated keys are random enough to skip PBKDF2 on every download
+        generated_key=encrypt,
+    )
 
     # Use the set site URL if in config, else guess based on HOST header
     site_url = current_app.config.get("SITE_URL") or request.host_url[:-1]
@@ -73,16 +347,16 @@ def upload_file():
     if encrypt:
         file_url = "{site_url}/u/{filename}?key={key}".format(
             site_url=site_url,
-            filename=file.fs_filename,
+            filename=fs_filename,
             key=key.decode("utf-8"),
         )
     else:
         file_url = "{site_url}/u/{filename}".format(
-            site_url=site_url, filename=file.fs_filename
+            site_url=site_url, filename=fs_filename
         )
 
     if shorten:
-        short_name = shorten_filename(file.fs_filename)
+        short_name = shorten_filename(fs_filename)
         if encrypt:
             short_url = "{site_url}/s/{short_name}?key={key}".format(
                 site_url=site_url,
@@ -113,42 +387,136 @@ def upload_file():
 @api_blueprint.route("/s/<short_filename>")
 @api_blueprint.route("/b/<base64_filename>")
 def serve_file(filename=None, short_filename=None, base64_filename=None):
+    fs = get_storage()
+
+    # Names never handed out are turned down without any lookup
     if not filename:
         if not short_filename:
             abort(404)
+        if not lookup_filter.may_be_shortened(short_filename):
+            return abort(404)
         filename = find_shortened(short_filename)
-    if not filename:
+        if not filename:
+            lookup_filter.false_positive()
+            return abort(404)
+    elif not lookup_filter.may_exist(filename):
         return abort(404)
 
     key = request.args.get('key')
 
-    st_cfg = current_app.config["ITOKO_STORAGE"]
-    fs = FSStorage(
-        temporary_folder=st_cfg["temporary_folder"],
-        permanent_folder=st_cfg["permanent_folder"],
-        readers=[
-            reader() for reader in st_cfg["readers"]
-        ]
-    )
-
     fst = fs.exists(filename)
     if not fst:
+        lookup_filter.false_positive()
         return abort(404)
 
-    file = fs.read(fst, filename)
+    # Small files served often are already parsed in the shared cache
+    cached = hot_file_cache.get(filename)
+    if cached is not None:
+        file, stat = cached
+    else:
+        # Only the headers are parsed, the payload is streamed from disk
+        try:
+            stat = fs.stat(fst, filename)
+            file = fs.open(fst, filename)
+        except FileNotFoundError:
+            # Gone from disk behind our back, forget about it
+            fs.index.remove(filename)
+            return abort(404)
+    record = fs.touch(filename)
+
+    # Compressed files go out as stored to clients able to decompress them,
+    # byte ranges are only served over the decompressed payload
+    encoded = (
+        not file.is_encrypted
+        and file.encoding is not None
+        and "Range" not in request.headers
+        and accepts_encoding(file.encoding)
+    )
+
+    try:
+        etag, weak = get_etag(
+            file,
+            stat,
+            file.encoding if encoded else None,
+            digest=record.digest if record is not None else None,
+        )
+    except DecryptionError:
+        # Unknown crypto header, there's no way to decrypt it either
+        file.close()
+        return abort(403)
+    cache_headers = dict(
+        etag=etag,
+        last_modified=stat.st_mtime,
+        permanent=fst == FSStorageType.PERMANENT_STORAGE,
+        private=file.is_encrypted,
+        vary_encoding=file.encoding is not None,
+        weak=weak,
+    )
+
+    # A cached copy is still good, no need to derive keys or decrypt anything
+    if is_not_modified(etag, stat.st_mtime):
+        file.close()
+        response = Response(status=304)
+        set_cache_headers(response, **cache_headers)
+        return response
+
+    head = request.method == "HEAD"
+    # Only misses sending the file count towards caching it
+    if cached is None and not head:
+        hot_file_cache.put(filename, file, stat)
 
     if file.is_encrypted:
         try:
-            # Put an empty key if none was provided
-            file = file.decrypt((key or "").encode("utf-8"))
+            # Put an empty key if none was provided. HEAD only needs the
+            # metadata and size, the payload is left unverified and unread
+            file = file.decrypt(
+                (key or "").encode("utf-8"), verify=not head
+            )
         except DecryptionError:
+            file.close()
             return abort(403)
 
-    io = BytesIO(file.payload)
-    response = make_response(send_file(io, mimetype=file.mime_type))
+    try:
+        # HEAD responses carry no body, so there's nothing to slice
+        ranges = None if head else get_byte_ranges(
+            file.size, None if weak else etag, stat.st_mtime
+        )
+    except RequestedRangeNotSatisfiable:
+        file.close()
+        raise
+
+    accel_redirect = None
+    if not (head or encoded):
+        accel_redirect = get_accel_redirect(file.view)
+    if accel_redirect is not None:
+        # Conditions are checked already, nginx sends the blob and applies
+        # the same byte ranges to it
+        file.close()
+        response = Response(mimetype=file.mime_type)
+        response.headers["X-Accel-Redirect"] = accel_redirect
+    else:
+        # HEAD bodies are dropped unread, the payload is never touched
+        response = make_file_response(
+            file,
+            ranges,
+            fs.chunk_size,
+            sendfile=(
+                not head and current_app.config["ITOKO_STORAGE"]["sendfile"]
+            ),
+            encoded=encoded,
+        )
+    set_cache_headers(response, **cache_headers)
 
     # Add filename, set as attachment if not allowed inline
     response.headers["Content-Disposition"] = get_content_disposition(
         file.filename, file.mime_type
     )
     return response
+
+
+@api_blueprint.route("/stats")
+def serve_stats():
+    if not current_app.config["ITOKO_STATS"].get("enabled"):
+        return abort(404)
+    # Counters are per process, tell which one answered
+    return jsonify(pid=os.getpid(), **collect_stats())
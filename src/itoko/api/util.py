@@ -1,8 +1,26 @@
+import hashlib
+import os
+import struct
+from typing import List, Optional, Tuple
 from urllib.parse import quote
 
 from flask import request
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import parse_date, quote_etag
 
-__all__ = ["request_wants_json", "get_content_disposition"]
+from itoko.fs.format import FormatFile
+
+__all__ = [
+    "request_wants_json",
+    "get_content_disposition",
+    "get_etag",
+    "accepts_encoding",
+    "is_not_modified",
+    "get_byte_ranges",
+]
+
+# Past this many ranges in a single request we just send the whole file
+MAX_BYTE_RANGES = 16
 
 INLINE_MIMETYPES = [
     "application/json",
@@ -78,3 +96,149 @@ def get_content_disposition(filename: str, mimetype: str) -> str:
         return (
             f"attachment; filename=\"{escaped}\"; filename*=UTF-8''{escaped}"
         )
+
+
+def get_etag(
+    file: FormatFile,
+    stat: os.stat_result,
+    encoding: str = None,
+    digest: str = None,
+) -> Tuple[str, bool]:
+    """
+    Makes an entity tag for a stored file without decrypting it. Encrypted
+    files are identified by the tag which authenticates their ciphertext,
+    unencrypted ones by the digest of their payload recorded when stored,
+    both making for strong entity tags. Unencrypted files without a known
+    digest are identified by the size and modification time of the stored
+    file, which don't follow their contents, as files rewritten in place
+    keep their modification time. Their entity tag is weak, good for
+    revalidation but not for byte ranges, as are the tags of payloads sent
+    as stored compressed, which may be compressed again.
+
+    :param file: Stored file, before any decryption.
+    :param stat: Status of the stored file.
+    :param encoding: Content coding the file is sent with, as every encoding
+                     of a file needs its own entity tag.
+    :param digest: SHA-256 hex digest of the unencrypted payload, if known.
+    :return: Entity tag, unquoted, and whether it's weak.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(file.fs_filename.encode("utf-8"))
+    if file.is_encrypted:
+        h.update(file.tag)
+    elif digest is not None:
+        h.update(bytes.fromhex(digest))
+    else:
+        h.update(struct.pack("!QQ", stat.st_size, stat.st_mtime_ns))
+    if encoding is not None:
+        h.update(encoding.encode("utf-8"))
+    weak = not file.is_encrypted and (digest is None or encoding is not None)
+    return h.hexdigest(), weak
+
+
+def accepts_encoding(encoding: str) -> bool:
+    """
+    Returns whether the current Flask request accepts a content coding.
+
+    :param encoding: Content coding, such as gzip.
+    :return: Boolean indicating whether the coding is acceptable.
+    """
+    return request.accept_encodings[encoding] > 0
+
+
+def is_not_modified(etag: str, last_modified: float) -> bool:
+    """
+    Evaluates the If-None-Match and If-Modified-Since headers of the current
+    Flask request, the latter only if the former is missing.
+
+    :param etag: Entity tag of the requested resource.
+    :param last_modified: Modification timestamp of the requested resource.
+    :return: Boolean indicating whether a 304 response should be sent.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if_modified_since = request.if_modified_since
+    # HTTP dates have a resolution of a second
+    return (
+        if_modified_since is not None
+        and int(last_modified) <= if_modified_since.timestamp()
+    )
+
+
+def _if_range_matches(etag: Optional[str], last_modified: Optional[float]):
+    value = request.headers["If-Range"].strip()
+    if value.startswith("W/"):
+        # Byte ranges need a strong validator
+        return False
+    if value.startswith("\""):
+        return etag is not None and value == quote_etag(etag)
+    date = parse_date(value)
+    return (
+        date is not None
+        and last_modified is not None
+        and date.timestamp() == int(last_modified)
+    )
+
+
+def get_byte_ranges(
+    length: int, etag: str = None, last_modified: float = None
+) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses the Range header of the current Flask request against a resource
+    of the given length. Overlapping or adjacent ranges are coalesced. Ranges
+    are ignored if an If-Range header doesn't match the given validators.
+
+    :param length: Length of the requested resource.
+    :param etag: Strong entity tag of the requested resource, weak ones
+                 never match.
+    :param last_modified: Modification timestamp of the requested resource.
+    :return: Sorted list of (start, end) byte ranges, with end exclusive, or
+             None if the whole resource should be sent.
+    :raises RequestedRangeNotSatisfiable: If no requested range is within the
+                                          resource.
+    """
+    header = request.headers.get("Range")
+    if not header:
+        return None
+    if "If-Range" in request.headers and not _if_range_matches(
+        etag, last_modified
+    ):
+        return None
+    units, _, specs = header.partition("=")
+    if units.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, sep, last = spec.strip().partition("-")
+        try:
+            if not sep:
+                return None
+            elif not first:
+                # Suffix range, the last N bytes
+                suffix = int(last)
+                start, end = max(length - suffix, 0), length
+                if suffix == 0:
+                    continue
+            else:
+                start = int(first)
+                end = int(last) + 1 if last else length
+                if last and end <= start:
+                    return None
+                end = min(end, length)
+        except ValueError:
+            return None
+        if start < length:
+            ranges.append((start, end))
+    if not ranges:
+        raise RequestedRangeNotSatisfiable(length=length)
+    ranges.sort()
+    coalesced = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = coalesced[-1]
+        if start <= last_end:
+            coalesced[-1] = (last_start, max(end, last_end))
+        else:
+            coalesced.append((start, end))
+    if len(coalesced) > MAX_BYTE_RANGES:
+        return None
+    return coalesced
@@ -1,32 +1,122 @@
 import argparse
+import os
 import sys
+from typing import BinaryIO, Optional
+from itoko.cmd.files import (
+    STDIO,
+    add_batch_arguments,
+    list_folder,
+    open_input,
+    open_output,
+    read_manifest,
+    run_batch,
+)
+from itoko.crypto.exc import DecryptionError
+from itoko.fs.format import FormatFile
 from itoko.fs.format.v1 import ItokoV1FormatReader
 from itoko.fs.format.v2 import ItokoV2FormatReader
+from itoko.fs.format.v3 import ItokoV3FormatReader
+from itoko.fs.payload import DEFAULT_CHUNK_SIZE, FilePayload
 
 readers = [
     ItokoV1FormatReader(),
     ItokoV2FormatReader(),
+    ItokoV3FormatReader(),
 ]
 
 
-def decrypt(filename: str, key: str) -> None:
-    with open(filename, "rb") as f:
-        data = f.read()
-        for reader in readers:
-            if reader.complies(data):
-                eff = reader.read(filename, data)
-                ff = eff.decrypt(key.encode("utf-8"))
-                sys.stdout.buffer.write(ff.payload)
+def open_file(f: BinaryIO, filename: str) -> FormatFile:
+    """
+    Opens a stored file without loading its payload. The format is detected
+    and headers parsed from a single read of the start of the file.
+
+    :param f: Seekable file object, read from its current position on.
+    :param filename: Filename of the file, for error messages.
+    :return: File, to be closed by the caller.
+    :raises ValueError: If no reader understands the file.
+    """
+    payload = FilePayload(f, offset=f.tell()).prefetch()
+    for reader in readers:
+        file = reader.open(filename, payload)
+        if file is not None:
+            return file
+    raise ValueError("Unknown file format.")
+
+
+def decrypt(f: BinaryIO, fp: BinaryIO, filename: str, key: str) -> None:
+    """
+    Decrypts a stored file into a stream, a chunk at a time. Unencrypted
+    files are written out as they are.
+
+    :param f: Seekable file object with the stored file.
+    :param fp: Writable file object to write the contents into.
+    :param filename: Filename of the file, for error messages.
+    :param key: Decryption key, not needed for unencrypted files.
+    """
+    buf = bytearray(DEFAULT_CHUNK_SIZE)
+    file = open_file(f, filename)
+    if file.reference is not None:
+        raise ValueError("Contents stored in a deduplicated blob.")
+    if file.is_encrypted:
+        if not key:
+            raise ValueError("File is encrypted and no key given.")
+        # Verified up front, then decrypted chunk by chunk
+        file = file.decrypt(key.encode("utf-8"))
+    for chunk in file.view.iter_into(buf):
+        fp.write(chunk)
+
+
+def decrypt_file(path: str, key: Optional[str], fp: BinaryIO) -> None:
+    with open(path, "rb") as f:
+        decrypt(f, fp, path, key)
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Decrypt a file.')
+    parser = argparse.ArgumentParser(
+        description='Decrypt a file, or a batch of files in parallel.'
+    )
+    parser.add_argument(
+        'filename',
+        metavar='FILE',
+        type=str,
+        help='file to read, "-" for stdin, or a folder to decrypt every file '
+             'in',
+    )
+    parser.add_argument(
+        'key',
+        metavar='KEY',
+        type=str,
+        nargs='?',
+        help='decryption key, not needed for unencrypted files',
+    )
     parser.add_argument(
-        'filename', metavar='FILE', type=str, help='file to read'
+        '-o',
+        '--output',
+        default=STDIO,
+        help='file to write, "-" for stdout, or the folder to write into '
+             'when decrypting a batch',
     )
-    parser.add_argument('key', metavar="kEY", type=str, help='decryption key')
+    add_batch_arguments(parser)
     args = parser.parse_args()
-    decrypt(args.filename, args.key)
+    if args.manifest or os.path.isdir(args.filename):
+        if args.output == STDIO:
+            parser.error('batches need an output folder')
+        if args.manifest:
+            with open_input(args.filename) as f:
+                jobs = read_manifest(f, args.key, args.output)
+        else:
+            jobs = list_folder(args.filename, args.key, args.output)
+        failed = run_batch(decrypt_file, jobs, args.processes, "decrypted")
+        sys.exit(1 if failed else 0)
+    try:
+        with open_input(args.filename, seekable=True) as f, open_output(
+            args.output
+        ) as fp:
+            decrypt(f, fp, args.filename, args.key)
+    except DecryptionError:
+        sys.exit("decrypt: wrong key or corrupted file")
+    except ValueError as e:
+        sys.exit("decrypt: {}".format(e))
 
 
 if __name__ == '__main__':
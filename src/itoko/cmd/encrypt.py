@@ -1,31 +1,96 @@
 import argparse
+import os
 import sys
-import magic
+from typing import BinaryIO, Optional
+from itoko.cmd.files import (
+    STDIO,
+    add_batch_arguments,
+    list_folder,
+    open_input,
+    open_output,
+    read_manifest,
+    run_batch,
+)
 from itoko.fs.format.v2 import ItokoV2FormatFile
 
 
-def encrypt(filename: str, key: str) -> None:
-    with open(filename, "rb") as f:
-        data = f.read()
-        ff = ItokoV2FormatFile(
-            payload=data,
-            fs_filename=None,
-            is_encrypted=False,
-            filename=filename,
-            mime_type=magic.from_buffer(data, mime=True)
-        )
-        eff = ff.encrypt(key.encode("utf-8"))
-        sys.stdout.buffer.write(eff.file)
+def encrypt(stream: BinaryIO, fp: BinaryIO, filename: str, key: str) -> None:
+    """
+    Encrypts a stream into a v2 file, a chunk at a time.
+
+    :param stream: Readable file object with the file contents.
+    :param fp: Seekable file object to write the encrypted file into, the
+               crypto header is backfilled.
+    :param filename: Original filename to store in the encrypted file.
+    :param key: Encryption key.
+    """
+    ItokoV2FormatFile.write_stream(
+        fp,
+        stream,
+        filename=filename,
+        key=key.encode("utf-8"),
+    )
+
+
+def encrypt_file(path: str, key: Optional[str], fp: BinaryIO) -> None:
+    if not key:
+        raise ValueError("No key given.")
+    with open(path, "rb") as f:
+        encrypt(f, fp, os.path.basename(path), key)
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Encrypt a file.')
+    parser = argparse.ArgumentParser(
+        description='Encrypt a file, or a batch of files in parallel.'
+    )
+    parser.add_argument(
+        'filename',
+        metavar='FILE',
+        type=str,
+        help='file to read, "-" for stdin, or a folder to encrypt every file '
+             'in',
+    )
+    parser.add_argument(
+        'key',
+        metavar='KEY',
+        type=str,
+        nargs='?',
+        help='encryption key, optional with --manifest',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        default=STDIO,
+        help='file to write, "-" for stdout, or the folder to write into '
+             'when encrypting a batch',
+    )
     parser.add_argument(
-        'filename', metavar='FILE', type=str, help='file to read'
+        '--name',
+        help='original filename to store, defaults to the name of FILE',
     )
-    parser.add_argument('key', metavar="kEY", type=str, help='encryption key')
+    add_batch_arguments(parser)
     args = parser.parse_args()
-    encrypt(args.filename, args.key)
+    if args.manifest or os.path.isdir(args.filename):
+        if args.output == STDIO:
+            parser.error('batches need an output folder')
+        if args.manifest:
+            with open_input(args.filename) as f:
+                jobs = read_manifest(f, args.key, args.output)
+        elif not args.key:
+            parser.error('the key is required')
+        else:
+            jobs = list_folder(args.filename, args.key, args.output)
+        failed = run_batch(encrypt_file, jobs, args.processes, "encrypted")
+        sys.exit(1 if failed else 0)
+    if not args.key:
+        parser.error('the key is required')
+    name = args.name
+    if name is None:
+        name = "stdin" if args.filename == STDIO else args.filename
+    with open_input(args.filename) as f, open_output(
+        args.output, seekable=True
+    ) as fp:
+        encrypt(f, fp, os.path.basename(name), args.key)
 
 
 if __name__ == '__main__':
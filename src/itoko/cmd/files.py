@@ -0,0 +1,245 @@
+"""
+Input, output and batch handling shared by the encrypt and decrypt commands.
+
+Single files are streamed from a file or stdin to a file or stdout. In batch
+mode a command runs over every file in a folder or listed in a manifest
+across a pool of processes. Output files are written under a hidden name and
+only show up once complete, and failures are reported per file without
+stopping the batch.
+"""
+import argparse
+import fcntl
+import multiprocessing
+import os
+import stat
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import (
+    BinaryIO,
+    Callable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from itoko.fs.atomic import FSyncPolicy, PARTIAL_PREFIX, PartialFile
+from itoko.fs.payload import DEFAULT_CHUNK_SIZE, iter_stream
+
+__all__ = [
+    "STDIO",
+    "Job",
+    "open_input",
+    "open_output",
+    "add_batch_arguments",
+    "list_folder",
+    "read_manifest",
+    "run_batch",
+]
+
+# Path standing for stdin or stdout
+STDIO = "-"
+
+
+@contextmanager
+def open_input(path: str, seekable: bool = False) -> Iterator[BinaryIO]:
+    """
+    Opens a file to read, or stdin.
+
+    :param path: Path of the file, or "-" for stdin.
+    :param seekable: Whether the file must be seekable, stdin is then copied
+                     to a temporary file unless redirected from a file.
+    """
+    if path != STDIO:
+        with open(path, "rb") as f:
+            yield f
+        return
+    stdin = sys.stdin.buffer
+    if not seekable or stat.S_ISREG(os.fstat(stdin.fileno()).st_mode):
+        yield stdin
+        return
+    with tempfile.TemporaryFile() as tmp:
+        for chunk in iter_stream(stdin, bytearray(DEFAULT_CHUNK_SIZE)):
+            tmp.write(chunk)
+        tmp.seek(0)
+        yield tmp
+
+
+@contextmanager
+def open_output(path: str, seekable: bool = False) -> Iterator[BinaryIO]:
+    """
+    Opens a file to write, or stdout. Files only show up once complete,
+    replacing any file already at the path.
+
+    :param path: Path of the file, or "-" for stdout.
+    :param seekable: Whether the file must be seekable, output to stdout is
+                     then written to a temporary file first unless
+                     redirected to a file, and not for appending.
+    """
+    if path != STDIO:
+        # Bare filenames have no folder to publish into
+        path = os.path.abspath(path)
+        with PartialFile(
+            os.path.dirname(path),
+            os.path.basename(path),
+            FSyncPolicy.NONE,
+        ) as partial:
+            yield partial.fp
+            partial.publish(path, replace=True)
+        return
+    stdout = sys.stdout.buffer
+    stdout.flush()
+    # Appended writes ignore seeks, headers couldn't be filled in
+    if not seekable or (
+        stdout.seekable()
+        and not fcntl.fcntl(stdout.fileno(), fcntl.F_GETFL) & os.O_APPEND
+    ):
+        yield stdout
+        stdout.flush()
+        return
+    with tempfile.TemporaryFile() as tmp:
+        yield tmp
+        tmp.seek(0)
+        for chunk in iter_stream(tmp, bytearray(DEFAULT_CHUNK_SIZE)):
+            stdout.write(chunk)
+        stdout.flush()
+
+
+class Job(NamedTuple):
+    source: str
+    key: Optional[str]
+    output: str
+
+
+def add_batch_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--manifest',
+        action='store_true',
+        help='read FILE as a manifest of "path<TAB>key" lines, keys '
+             'defaulting to KEY, and write into the OUTPUT folder',
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=os.cpu_count(),
+        help='worker processes in batch mode',
+    )
+
+
+def list_folder(
+    folder: str, key: Optional[str], output_folder: str
+) -> List[Job]:
+    """
+    Lists the files in a folder and its subfolders, to be written under the
+    same relative paths in the output folder.
+    """
+    jobs = []
+    output_folder_path = os.path.realpath(output_folder)
+    for path, folders, files in os.walk(folder):
+        # Leave out files being written, as storage folders are walked too,
+        # and earlier outputs
+        folders[:] = [
+            f
+            for f in folders
+            if not f.startswith(PARTIAL_PREFIX)
+            and os.path.realpath(os.path.join(path, f)) != output_folder_path
+        ]
+        for name in files:
+            if name.startswith(PARTIAL_PREFIX):
+                continue
+            source = os.path.join(path, name)
+            jobs.append(Job(
+                source=source,
+                key=key,
+                output=os.path.join(
+                    output_folder, os.path.relpath(source, folder)
+                ),
+            ))
+    return jobs
+
+
+def read_manifest(
+    stream: BinaryIO, key: Optional[str], output_folder: str
+) -> List[Job]:
+    """
+    Reads a manifest of files, one per line with an optional key after a
+    tab, to be written under their names in the output folder.
+    """
+    jobs = []
+    for line in stream:
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line.strip():
+            continue
+        source, _, line_key = line.partition("\t")
+        jobs.append(Job(
+            source=source,
+            key=line_key or key,
+            output=os.path.join(output_folder, os.path.basename(source)),
+        ))
+    return jobs
+
+
+def _run_job(
+    args: Tuple[Callable[[str, Optional[str], BinaryIO], None], Job]
+) -> Tuple[Job, Optional[str], int]:
+    func, job = args
+    try:
+        size = os.stat(job.source).st_size
+        output = os.path.abspath(job.output)
+        with PartialFile(
+            os.path.dirname(output),
+            os.path.basename(output),
+            FSyncPolicy.NONE,
+        ) as partial:
+            func(job.source, job.key, partial.fp)
+            # Outputs already there are left alone, as are their names
+            partial.publish(output)
+    except Exception as e:
+        return job, repr(e), 0
+    return job, None, size
+
+
+def run_batch(
+    func: Callable[[str, Optional[str], BinaryIO], None],
+    jobs: List[Job],
+    processes: int,
+    done: str,
+) -> int:
+    """
+    Runs a command over many files in a pool of processes, reporting every
+    failure and a summary to stderr.
+
+    :param func: Function taking the path of a file, its key and the file
+                 object to write the output into. It must be importable from
+                 the worker processes.
+    :param jobs: Files to run the command over.
+    :param processes: Worker processes.
+    :param done: Past participle of the command, for the summary.
+    :return: Number of files that failed.
+    """
+    failed = size = 0
+    start = time.monotonic()
+    with multiprocessing.Pool(processes) as pool:
+        for job, error, job_size in pool.imap_unordered(
+            _run_job, ((func, job) for job in jobs)
+        ):
+            if error is not None:
+                print("{}: {}".format(job.source, error), file=sys.stderr)
+                failed += 1
+            size += job_size
+    elapsed = max(time.monotonic() - start, 1e-9)
+    print(
+        "{} {} files, {} failed, in {:.1f}s at {:.2f} MiB/s.".format(
+            done.capitalize(),
+            len(jobs) - failed,
+            failed,
+            elapsed,
+            size / elapsed / 2 ** 20,
+        ),
+        file=sys.stderr,
+    )
+    return failed
+
@@ -0,0 +1,305 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from typing import Iterator, List, Optional, Set, Tuple
+from itoko import make_app
+from itoko.api import get_storage
+from itoko.fs.backends.filesystem import FilesystemBackend
+from itoko.fs.cache import hot_file_cache
+from itoko.fs.format.v1 import ItokoV1FormatReader
+from itoko.fs.format.v2 import ItokoV2FormatFile
+from itoko.fs.payload import HashingReader, PayloadReader
+from itoko.fs.storage import FSStorageType
+
+CONVERTED = "converted"
+ENCRYPTED = "encrypted"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# Set in every worker process by _init_worker()
+_backend = None
+_encoding = None
+_dry_run = False
+
+
+def _init_worker(
+    backend: FilesystemBackend, encoding: Optional[str], dry_run: bool
+) -> None:
+    global _backend, _encoding, _dry_run
+    _backend = backend
+    _encoding = encoding
+    _dry_run = dry_run
+
+
+def _convert(
+    task: Tuple[str, str, Optional[str]]
+) -> Tuple[str, str, str, int, int, Optional[str]]:
+    """
+    Converts a stored v1 file to v2 in place, in a worker process.
+
+    :param task: Storage type value, filename of the file stored in-server
+                 and its MIME type if known.
+    :return: Storage type value, filename, status, the stored size before
+             and after, and the digest of the payload if converted.
+    """
+    st_value, name, mime_type = task
+    st = FSStorageType(st_value)
+    try:
+        payload = _backend.open(st, name).prefetch()
+    except FileNotFoundError:
+        # Removed since the folder was listed
+        return st_value, name, SKIPPED, 0, 0, None
+    try:
+        file = ItokoV1FormatReader().open(name, payload)
+        if file is None:
+            return st_value, name, SKIPPED, 0, 0, None
+        # The key is needed to get at the plaintext, leave them be
+        if file.is_encrypted:
+            return st_value, name, ENCRYPTED, 0, 0, None
+        size = len(payload)
+        if _dry_run:
+            return st_value, name, CONVERTED, size, size, None
+        # The payload is read through anyway, hash it for entity tags
+        stream = HashingReader(PayloadReader(file.view))
+        with _backend.replace(st, name) as fp:
+            ItokoV2FormatFile.write_stream(
+                fp,
+                stream,
+                filename=file.filename,
+                mime_type=mime_type,
+                encoding=_encoding,
+            )
+            new_size = fp.tell()
+        return st_value, name, CONVERTED, size, new_size, stream.hexdigest()
+    except FileNotFoundError:
+        # Removed while being converted
+        return st_value, name, SKIPPED, 0, 0, None
+    except Exception as e:
+        print("Failed to convert {}: {!r}".format(name, e), file=sys.stderr)
+        return st_value, name, FAILED, 0, 0, None
+    finally:
+        payload.close()
+
+
+def _tasks(skip: Set[str]) -> Iterator[Tuple[str, str, Optional[str]]]:
+    fs = get_storage()
+    seen = set()
+    # Same lookup order as FSStorage.exists(), in case both folders are one
+    for st in (
+        FSStorageType.PERMANENT_STORAGE,
+        FSStorageType.TEMPORARY_STORAGE,
+    ):
+        for entry in fs.backend.scan(st):
+            if entry.name in seen or entry.name in skip:
+                continue
+            seen.add(entry.name)
+            record = fs.index.get(entry.name)
+            if record is not None and record.version != 1:
+                # Files only change version by being migrated
+                continue
+            # Keep the MIME type served so far instead of sniffing again
+            yield (
+                st.value,
+                entry.name,
+                record.mime_type if record is not None else None,
+            )
+
+
+def _reindex(fs, st: FSStorageType, name: str, digest: str) -> None:
+    previous = fs.index.get(name)
+    try:
+        record = fs.record(st, name, digest=digest)
+    except FileNotFoundError:
+        # Removed since converted
+        return
+    if previous is not None:
+        record = record._replace(
+            created_at=previous.created_at,
+            accessed_at=previous.accessed_at,
+        )
+    else:
+        record = record._replace(
+            created_at=fs.stat(st, name).st_mtime,
+        )
+    fs.index.put(record)
+
+
+def _batches(tasks: Iterator, batch_size: int) -> Iterator[List]:
+    batch = []
+    for task in tasks:
+        batch.append(task)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _read_checkpoint(path: str) -> Set[str]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {line.split("\t", 1)[0] for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def migrate(
+    processes: int,
+    batch_size: int,
+    delay: float,
+    max_rate: float,
+    checkpoint: str,
+    dry_run: bool,
+    progress: float,
+) -> None:
+    fs = get_storage()
+    encoding = fs.compression
+    if encoding not in ItokoV2FormatFile.ENCODINGS:
+        encoding = None
+    done = _read_checkpoint(checkpoint) if checkpoint else set()
+    counts = {CONVERTED: 0, ENCRYPTED: 0, SKIPPED: 0, FAILED: 0}
+    bytes_in = bytes_out = 0
+    start = last_report = time.monotonic()
+
+    def report(prefix: str) -> None:
+        elapsed = max(time.monotonic() - start, 1e-9)
+        looked_at = sum(counts.values())
+        print(
+            "{} {} files in {:.1f}s, {:.1f} files/s, {:.2f} MiB/s: {} "
+            "{}, {} encrypted, {} skipped, {} failed.".format(
+                prefix,
+                looked_at,
+                elapsed,
+                looked_at / elapsed,
+                bytes_in / elapsed / 2 ** 20,
+                counts[CONVERTED],
+                "to convert" if dry_run else "converted",
+                counts[ENCRYPTED],
+                counts[SKIPPED],
+                counts[FAILED],
+            ),
+            file=sys.stderr,
+        )
+
+    out = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+    try:
+        with multiprocessing.Pool(
+            processes,
+            initializer=_init_worker,
+            initargs=(fs.backend, encoding, dry_run),
+        ) as pool:
+            # Batches are listed here, the index can't be read from the
+            # pool's threads
+            for batch in _batches(_tasks(done), batch_size):
+                for (
+                    st_value, name, status, size, new_size, digest
+                ) in pool.map(_convert, batch):
+                    counts[status] += 1
+                    bytes_in += size
+                    if status == ENCRYPTED:
+                        # Left for the owners of the keys to deal with
+                        print(name)
+                    if dry_run:
+                        continue
+                    if status == CONVERTED:
+                        bytes_out += new_size
+                        _reindex(fs, FSStorageType(st_value), name, digest)
+                        hot_file_cache.invalidate(name)
+                    if out is not None and status != FAILED:
+                        out.write("{}\t{}\n".format(name, status))
+                if out is not None:
+                    out.flush()
+                now = time.monotonic()
+                if progress and now - last_report >= progress:
+                    report("Looked at")
+                    last_report = now
+                # Keep the average read rate under the limit
+                if max_rate:
+                    ahead = bytes_in / (max_rate * 2 ** 20) - (now - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+                # Pause between batches so conversions don't starve the
+                # server
+                if delay:
+                    time.sleep(delay)
+    finally:
+        if out is not None:
+            out.close()
+    report("Done, looked at")
+    if counts[CONVERTED] and not dry_run:
+        print(
+            "Converted files take up {} bytes.".format(bytes_out),
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert unencrypted v1 files to v2 in place, while the '
+                    'server keeps running. Encrypted v1 files are listed on '
+                    'stdout and left as they are.'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=os.cpu_count(),
+        help='worker processes converting files',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=100,
+        help='files converted between checkpoints and pauses',
+    )
+    parser.add_argument(
+        '--delay',
+        type=float,
+        default=0.0,
+        help='seconds to pause between batches',
+    )
+    parser.add_argument(
+        '--max-rate',
+        type=float,
+        default=0.0,
+        help='MiB of stored files to read per second at most, 0 for no limit',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        default='',
+        help='file recording the files dealt with, which are skipped when '
+             'run again',
+    )
+    parser.add_argument(
+        '--progress',
+        type=float,
+        default=10.0,
+        help='seconds between progress reports, 0 for none',
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='only count the files to convert',
+    )
+    args = parser.parse_args()
+    if args.processes < 1 or args.batch_size < 1:
+        parser.error('processes and batch size must be positive')
+    app = make_app()
+    backend = app.config["ITOKO_STORAGE"]["backend"]
+    if not issubclass(backend, FilesystemBackend):
+        parser.error('only filesystem storage is migrated')
+    with app.app_context():
+        migrate(
+            args.processes,
+            args.batch_size,
+            args.delay,
+            args.max_rate,
+            args.checkpoint,
+            args.dry_run,
+            args.progress,
+        )
+
+
+if __name__ == '__main__':
+    main()
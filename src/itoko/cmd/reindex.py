@@ -0,0 +1,69 @@
+import argparse
+import sys
+from itoko import make_app
+from itoko.api import get_storage
+from itoko.fs.storage import FSStorageType
+
+
+def reindex() -> None:
+    fs = get_storage()
+    seen = set()
+    indexed = skipped = removed = 0
+    # Same lookup order as FSStorage.exists(), in case both folders are one
+    for st in (
+        FSStorageType.PERMANENT_STORAGE,
+        FSStorageType.TEMPORARY_STORAGE,
+    ):
+        for entry in fs.scan(st):
+            if entry.name in seen:
+                continue
+            seen.add(entry.name)
+            previous = fs.index.get(entry.name)
+            try:
+                record = fs.record(
+                    st,
+                    entry.name,
+                    created_at=entry.stat().st_mtime,
+                )
+            except Exception as e:
+                print(
+                    "Skipping {}: {!r}".format(entry.name, e),
+                    file=sys.stderr,
+                )
+                skipped += 1
+                continue
+            if previous is not None:
+                # Keep what the index knows better than the filesystem
+                record = record._replace(
+                    created_at=previous.created_at,
+                    accessed_at=previous.accessed_at,
+                )
+                if not record.is_encrypted and record.digest is None:
+                    # Only known from when the file was stored
+                    record = record._replace(digest=previous.digest)
+            fs.index.put(record)
+            indexed += 1
+    for record in fs.index:
+        if record.fs_filename not in seen:
+            fs.index.remove(record.fs_filename)
+            removed += 1
+    print(
+        "Indexed {} files, skipped {}, removed {} stale records.".format(
+            indexed, skipped, removed
+        ),
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild the metadata index from the stored files.'
+    )
+    parser.parse_args()
+    app = make_app()
+    with app.app_context():
+        reindex()
+
+
+if __name__ == '__main__':
+    main()
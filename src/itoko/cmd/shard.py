@@ -0,0 +1,70 @@
+import argparse
+import sys
+import time
+from itoko import make_app
+from itoko.api import get_storage
+from itoko.fs.backends.filesystem import FilesystemBackend
+from itoko.fs.storage import FSStorageType
+
+
+def shard(batch_size: int, delay: float) -> None:
+    backend = get_storage().backend
+    moved = skipped = 0
+    for st in (
+        FSStorageType.PERMANENT_STORAGE,
+        FSStorageType.TEMPORARY_STORAGE,
+    ):
+        # Only look at the files left at the top of the folder
+        for entry in backend.scan(st, sharded=False):
+            try:
+                backend.move_to_shard(st, entry.name)
+            except FileNotFoundError:
+                # Removed since the folder was listed
+                continue
+            except OSError as e:
+                print(
+                    "Skipping {}: {!r}".format(entry.path, e),
+                    file=sys.stderr,
+                )
+                skipped += 1
+                continue
+            moved += 1
+            # Pause between batches so the renames don't starve the server
+            if delay and moved % batch_size == 0:
+                time.sleep(delay)
+    print(
+        "Moved {} files into shards, skipped {}.".format(moved, skipped),
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Move files stored flat into their shard folders, while '
+                    'the server keeps running.'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='files moved between pauses',
+    )
+    parser.add_argument(
+        '--delay',
+        type=float,
+        default=0.0,
+        help='seconds to pause between batches',
+    )
+    args = parser.parse_args()
+    app = make_app()
+    backend = app.config["ITOKO_STORAGE"]["backend"]
+    if not issubclass(backend, FilesystemBackend):
+        parser.error('only filesystem storage is sharded')
+    if not app.config["ITOKO_STORAGE"]["shard_depth"]:
+        parser.error('sharding is disabled, set shard_depth first')
+    with app.app_context():
+        shard(args.batch_size, args.delay)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import sys
+import time
+from itoko import make_app
+from itoko.tasks.sweeper import ExpirySweeper, make_sweeper
+
+
+def sweep(sweeper: ExpirySweeper, delay: float) -> None:
+    # Pause between batches so the deletions don't starve the server
+    while not sweeper.step():
+        time.sleep(delay)
+    print(
+        "Scanned {} files, removed {} expired ones.".format(
+            sweeper.scanned, sweeper.removed
+        ),
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Delete expired files from the temporary storage.'
+    )
+    parser.add_argument(
+        '--ttl',
+        type=float,
+        help='seconds temporary files are kept for, defaults to the '
+             'configured temporary_ttl',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='files looked at per batch, defaults to the configured '
+             'sweep_batch_size',
+    )
+    parser.add_argument(
+        '--delay',
+        type=float,
+        help='seconds to wait between batches, defaults to the configured '
+             'sweep_interval',
+    )
+    args = parser.parse_args()
+    app = make_app()
+    tasks_cfg = app.config["ITOKO_TASKS"]
+    with app.app_context():
+        try:
+            sweeper = make_sweeper()
+        except ValueError as e:
+            parser.error(str(e))
+        if args.ttl is not None:
+            sweeper.ttl = args.ttl
+        if args.batch_size is not None:
+            sweeper.batch_size = args.batch_size
+        if not sweeper.ttl:
+            parser.error('no TTL configured, set temporary_ttl or --ttl')
+        if args.delay is None:
+            args.delay = tasks_cfg["sweep_interval"]
+        sweep(sweeper, args.delay)
+
+
+if __name__ == '__main__':
+    main()
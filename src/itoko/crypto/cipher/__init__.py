@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
 from typing import Optional
 
-from cryptography.hazmat.primitives.ciphers import Cipher as CryptoCipher
+from cryptography.hazmat.primitives.ciphers import (
+    Cipher as CryptoCipher,
+    CipherContext,
+)
 
 from itoko.crypto.kdf import DerivedKey
 
@@ -11,6 +14,9 @@ __all__ = ["Cipher"]
 class Cipher(ABC):
     __slots__ = ("key", "iv", "nonce", "_cipher")
 
+    # Cipher block size in bytes, or 1 for stream ciphers
+    BLOCK_SIZE = 1
+
     key: DerivedKey
     iv: Optional[bytes]
     nonce: Optional[bytes]
@@ -27,16 +33,64 @@ class Cipher(ABC):
     def _build_cipher(self) -> CryptoCipher:
         raise NotImplementedError
 
+    def buffer_size(self, size: int) -> int:
+        """
+        Returns the size of a buffer able to hold the output of a context's
+        update_into() for the given amount of input bytes. The same buffer can
+        then be reused for every chunk of at most that size.
+
+        :param size: Amount of input bytes per update_into() call.
+        :return: Buffer size in bytes.
+        """
+        return size + self.BLOCK_SIZE - 1
+
+    def encryptor(self) -> CipherContext:
+        """
+        Returns an incremental encryption context, to be fed chunk by chunk.
+        """
+        return self._cipher.encryptor()
+
+    def decryptor(self) -> CipherContext:
+        """
+        Returns an incremental decryption context, to be fed chunk by chunk.
+        """
+        return self._cipher.decryptor()
+
+    def encryptor_at(self, offset: int) -> CipherContext:
+        """
+        Returns an incremental encryption context positioned at the given byte
+        offset of the plaintext, producing the same ciphertext a context fed
+        from the start would from there on. Only seekable modes can start past
+        zero.
+        """
+        if offset:
+            raise NotImplementedError("Cipher mode is not seekable.")
+        return self.encryptor()
+
+    def decryptor_at(self, offset: int) -> CipherContext:
+        """
+        Returns an incremental decryption context positioned at the given byte
+        offset of the ciphertext. Only seekable modes can start past zero.
+        """
+        if offset:
+            raise NotImplementedError("Cipher mode is not seekable.")
+        return self.decryptor()
+
     def encrypt(self, plaintext: bytes) -> bytes:
         """
         Encrypts plaintext with chosen algorithm.
         """
         encryptor = self._cipher.encryptor()
-        return encryptor.update(plaintext) + encryptor.finalize()
+        encrypted = encryptor.update(plaintext)
+        # Stream modes have nothing left, don't copy the ciphertext for nothing
+        tail = encryptor.finalize()
+        return encrypted + tail if tail else encrypted
 
     def decrypt(self, encrypted: bytes) -> bytes:
         """
         Decrypts ciphertext with chosen algorithm.
         """
         decryptor = self._cipher.decryptor()
-        return decryptor.update(encrypted) + decryptor.finalize()
+        decrypted = decryptor.update(encrypted)
+        tail = decryptor.finalize()
+        return decrypted + tail if tail else decrypted
@@ -1,6 +1,7 @@
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import (
     Cipher as CryptoCipher,
+    CipherContext,
     algorithms,
     modes,
 )
@@ -11,9 +12,41 @@ __all__ = ["AESCTRCipher"]
 
 
 class AESCTRCipher(Cipher):
-    def _build_cipher(self) -> CryptoCipher:
+    BLOCK_SIZE = 16
+
+    def _build_cipher(self, nonce: bytes = None) -> CryptoCipher:
         return CryptoCipher(
             algorithms.AES(self.key.cipher_key),
-            modes.CTR(self.nonce),
+            modes.CTR(nonce or self.nonce),
             backend=default_backend(),
         )
+
+    def _context_at(self, offset: int, encrypt: bool) -> CipherContext:
+        blocks, skip = divmod(offset, self.BLOCK_SIZE)
+        if not blocks:
+            cipher = self._cipher
+        else:
+            counter = int.from_bytes(self.nonce, "big") + blocks
+            counter %= 1 << (self.BLOCK_SIZE * 8)
+            cipher = self._build_cipher(
+                counter.to_bytes(self.BLOCK_SIZE, "big")
+            )
+        context = cipher.encryptor() if encrypt else cipher.decryptor()
+        # Discard the keystream before the offset inside the first block
+        if skip:
+            context.update(bytes(skip))
+        return context
+
+    def encryptor_at(self, offset: int) -> CipherContext:
+        """
+        Returns an encryption context positioned at the given byte offset. CTR
+        keystream blocks only depend on the counter, so we just advance it.
+        """
+        return self._context_at(offset, encrypt=True)
+
+    def decryptor_at(self, offset: int) -> CipherContext:
+        """
+        Returns a decryption context positioned at the given byte offset. CTR
+        keystream blocks only depend on the counter, so we just advance it.
+        """
+        return self._context_at(offset, encrypt=False)
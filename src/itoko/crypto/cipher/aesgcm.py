@@ -0,0 +1,52 @@
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import (
+    Cipher as CryptoCipher,
+    CipherContext,
+    algorithms,
+    modes,
+)
+
+from itoko.crypto.cipher import Cipher
+
+__all__ = ["AESGCMCipher"]
+
+
+class AESGCMCipher(Cipher):
+    """
+    AES in GCM mode, which authenticates while encrypting. Being an
+    authenticated cipher the whole derived key is used as cipher key, and the
+    96-bit IV is expected in the iv field.
+    """
+
+    BLOCK_SIZE = 16
+    IV_SIZE = 12
+    TAG_SIZE = 16
+
+    def _build_cipher(self) -> CryptoCipher:
+        return CryptoCipher(
+            algorithms.AES(self.key.derived_key),
+            modes.GCM(self.iv),
+            backend=default_backend(),
+        )
+
+    def decryptor_at(self, offset: int) -> CipherContext:
+        """
+        Returns a decryption context positioned at the given byte offset. GCM
+        encrypts in CTR mode with the counter block following the IV, so the
+        returned context is a plain CTR one. It does NOT authenticate anything,
+        only use it once the tag has been verified.
+        """
+        blocks, skip = divmod(offset, self.BLOCK_SIZE)
+        # With a 96-bit IV the first counter block is IV || 2, as IV || 1 is
+        # used to encrypt the tag
+        counter = int.from_bytes(self.iv + b"\0\0\0\2", "big") + blocks
+        counter %= 1 << (self.BLOCK_SIZE * 8)
+        decryptor = CryptoCipher(
+            algorithms.AES(self.key.derived_key),
+            modes.CTR(counter.to_bytes(self.BLOCK_SIZE, "big")),
+            backend=default_backend(),
+        ).decryptor()
+        # Discard the keystream before the offset inside the first block
+        if skip:
+            decryptor.update(bytes(skip))
+        return decryptor
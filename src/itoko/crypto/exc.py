@@ -1,4 +1,8 @@
-__all__ = ["InvalidKeyLengthError", "DecryptionError"]
+__all__ = [
+    "InvalidKeyLengthError",
+    "DecryptionError",
+    "UnsupportedSuiteError",
+]
 
 
 class InvalidKeyLengthError(Exception):
@@ -13,3 +17,10 @@ class DecryptionError(Exception):
     Raised when ciphertext decryption fails. Generally caused by the HMAC
     function failing to authenticate the given key.
     """
+
+
+class UnsupportedSuiteError(DecryptionError):
+    """
+    Raised when a bundle was encrypted with a suite that is unknown or not
+    allowed in the format it is stored in.
+    """
@@ -26,6 +26,34 @@ class HMAC(ABC):
     def _build_hmac(self) -> CryptoHMAC:
         raise NotImplementedError
 
+    def update(self, ciphertext: bytes) -> None:
+        """
+        Feeds a chunk of ciphertext into the HMAC. Chunks must be fed in order.
+
+        :param ciphertext: Raw ciphertext bytes.
+        """
+        self._hmac.update(ciphertext)
+
+    def finalize(self) -> bytes:
+        """
+        Finalizes the HMAC over every chunk fed so far.
+
+        :return: Computed HMAC.
+        """
+        return self._hmac.finalize()
+
+    def verify(self, hmac: bytes) -> None:
+        """
+        Checks whether every chunk fed so far matches a given HMAC with the
+        current HMAC key.
+
+        :param hmac: Previously obtained HMAC.
+        """
+        try:
+            self._hmac.verify(hmac)
+        except InvalidSignature as e:
+            raise DecryptionError from e
+
     def build(self, ciphertext: bytes):
         """
         Builds an HMAC over a given ciphertext with the current HMAC key.
@@ -0,0 +1,73 @@
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+
+__all__ = ["VerificationCache", "verification_cache"]
+
+# Amount of verified ciphertexts remembered per process
+VERIFICATION_CACHE_SIZE = 4096
+
+
+class VerificationCache:
+    """
+    Remembers which ciphertexts have already had their HMAC verified with a
+    given key, so immutable files don't need to be hashed again on every
+    request. Entries are identified by the ciphertext identity and its stored
+    HMAC. Keys are only kept as a keyed hash, with a secret generated per
+    process, so a plain hash of a key is never stored.
+    """
+
+    __slots__ = ("max_size", "_secret", "_entries", "_lock")
+
+    max_size: int
+
+    def __init__(self, max_size: int = VERIFICATION_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, hmac_key: bytes) -> bytes:
+        return hmac.new(self._secret, hmac_key, hashlib.sha256).digest()
+
+    def is_verified(
+        self, identity: tuple, stored_hmac: bytes, hmac_key: bytes
+    ) -> bool:
+        """
+        Checks whether a ciphertext was previously verified with a given key.
+
+        :param identity: Identity of the ciphertext.
+        :param stored_hmac: HMAC stored alongside the ciphertext.
+        :param hmac_key: Derived key authenticating the ciphertext, the HMAC
+                         key or the GCM key.
+        :return: Boolean indicating a previous successful verification.
+        """
+        with self._lock:
+            fingerprint = self._entries.get((identity, stored_hmac))
+            if fingerprint is None:
+                return False
+            self._entries.move_to_end((identity, stored_hmac))
+        return hmac.compare_digest(fingerprint, self._fingerprint(hmac_key))
+
+    def add(
+        self, identity: tuple, stored_hmac: bytes, hmac_key: bytes
+    ) -> None:
+        """
+        Records a successful verification of a ciphertext with a given key.
+
+        :param identity: Identity of the ciphertext.
+        :param stored_hmac: HMAC stored alongside the ciphertext.
+        :param hmac_key: Derived key authenticating the ciphertext, the HMAC
+                         key or the GCM key.
+        """
+        fingerprint = self._fingerprint(hmac_key)
+        with self._lock:
+            self._entries[(identity, stored_hmac)] = fingerprint
+            self._entries.move_to_end((identity, stored_hmac))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+verification_cache = VerificationCache()
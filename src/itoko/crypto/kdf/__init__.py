@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
+from typing import Type
 
 from itoko.crypto.exc import InvalidKeyLengthError
+from itoko.crypto.kdf.cache import derived_key_cache
 
 __all__ = ["KDF", "DerivedKey"]
 
@@ -55,6 +57,7 @@ class KDF(ABC):
 
     default_key_length = None
     supported_key_lengths = ()
+    derived_key_class: Type[DerivedKey] = DerivedKey
 
     key_length: int
     iterations: int
@@ -77,11 +80,62 @@ class KDF(ABC):
                 raise InvalidKeyLengthError
             return key_length
 
-    @abstractmethod
-    def derive_key(self, key: bytes, salt: bytes) -> DerivedKey:
+    @property
+    def params(self) -> str:
+        """
+        Returns a description of the KDF algorithm and its parameters.
+        """
+        return "{}:{}:{}".format(
+            type(self).__name__, self.key_length, self.iterations
+        )
+
+    def derive_key(
+        self, key: bytes, salt: bytes, cached: bool = False
+    ) -> DerivedKey:
         """
         Derives a cryptographic fixed-length key from the given key.
 
+        :param key: Plaintext key.
+        :param salt: Salt value.
+        :param cached: Whether to look up the derived key in the derived key
+                       cache, if enabled. Only worth it when the same key and
+                       salt are expected again, as in decryption.
+        """
+        derived = None
+        if cached and derived_key_cache.enabled:
+            derived = derived_key_cache.get(
+                derived_key_cache.fingerprint(self.params, key, salt)
+            )
+        if derived is None:
+            derived = self._derive(key, salt)
+        return self.derived_key_class(
+            key_length=self.key_length,
+            key=key,
+            salt=salt,
+            derived_key=derived,
+        )
+
+    def cache_key(self, derived_key: DerivedKey) -> None:
+        """
+        Stores a derived key in the derived key cache, if enabled. Call only
+        once the key is known to be right, so failed attempts can't push
+        good keys out of the cache.
+
+        :param derived_key: Key derived by this KDF.
+        """
+        if derived_key_cache.enabled:
+            derived_key_cache.put(
+                derived_key_cache.fingerprint(
+                    self.params, derived_key.key, derived_key.salt
+                ),
+                derived_key.derived_key,
+            )
+
+    @abstractmethod
+    def _derive(self, key: bytes, salt: bytes) -> bytes:
+        """
+        Derives the raw fixed-length key bytes from the given key.
+
         :param key: Plaintext key.
         :param salt: Salt value.
         """
@@ -0,0 +1,170 @@
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+__all__ = ["DerivedKeyCache", "derived_key_cache"]
+
+
+class DerivedKeyCache:
+    """
+    Size and TTL bounded cache of derived keys, so a popular encrypted file
+    doesn't pay for key derivation on every request.
+
+    Keys only ever live in process memory. Entries are looked up through a
+    keyed hash of the plaintext key, salt and KDF parameters, with a secret
+    generated per process, so neither the plaintext key nor a plain hash of
+    it is stored. Derived keys themselves are kept as they are, and stay in
+    memory until garbage collected once evicted or expired, like the copies
+    handed out on lookup and held by ciphers. Nothing is wiped, the cache
+    only bounds how long a key stays reachable from it.
+
+    The cache is disabled until given a size.
+    """
+
+    __slots__ = (
+        "max_size",
+        "ttl",
+        "hits",
+        "misses",
+        "evictions",
+        "_secret",
+        "_entries",
+        "_lock",
+    )
+
+    max_size: int
+    ttl: float
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, max_size: int = 0, ttl: float = 300.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def configure(self, max_size: int, ttl: float) -> None:
+        """
+        Resizes the cache, evicting entries over the new size.
+
+        :param max_size: Maximum amount of derived keys held, 0 disables it.
+        :param ttl: Seconds a derived key is held since it was derived.
+        """
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._expire()
+            self._trim()
+
+    def fingerprint(self, params: str, key: bytes, salt: bytes) -> bytes:
+        """
+        Computes the lookup key for a derivation.
+
+        :param params: KDF algorithm and parameters.
+        :param key: Plaintext key.
+        :param salt: Salt value.
+        :return: Keyed hash identifying the derivation.
+        """
+        h = hmac.new(self._secret, digestmod=hashlib.sha256)
+        # Length-prefix every field so they can't run into each other
+        for field in (params.encode("utf-8"), bytes(key), bytes(salt)):
+            h.update(struct.pack("!I", len(field)))
+            h.update(field)
+        return h.digest()
+
+    def get(self, fingerprint: bytes) -> Optional[bytes]:
+        """
+        Looks up a derived key.
+
+        :param fingerprint: Lookup key from fingerprint().
+        :return: Derived key or None if not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._evict(fingerprint)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(fingerprint)
+            return entry[1]
+
+    def put(self, fingerprint: bytes, derived_key: bytes) -> None:
+        """
+        Stores a derived key, evicting the least recently used ones if full.
+
+        :param fingerprint: Lookup key from fingerprint().
+        :param derived_key: Derived key.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if fingerprint in self._entries:
+                # Keep the original expiry, the TTL counts from derivation
+                self._entries.move_to_end(fingerprint)
+                return
+            self._entries[fingerprint] = (
+                time.monotonic() + self.ttl,
+                bytes(derived_key),
+            )
+            self._trim()
+
+    def clear(self) -> None:
+        """
+        Evicts every derived key.
+        """
+        with self._lock:
+            for fingerprint in list(self._entries):
+                self._evict(fingerprint)
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters, to help sizing it.
+        """
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                max_size=self.max_size,
+                ttl=self.ttl,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        # Entries are kept in use order, not expiry order, check them all
+        for fingerprint, (expires_at, _) in list(self._entries.items()):
+            if expires_at <= now:
+                self._evict(fingerprint)
+
+    def _trim(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            fingerprint, (expires_at, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and expires_at > now:
+                break
+            self._evict(fingerprint)
+
+    def _evict(self, fingerprint: bytes) -> None:
+        del self._entries[fingerprint]
+        self.evictions += 1
+
+
+derived_key_cache = DerivedKeyCache()
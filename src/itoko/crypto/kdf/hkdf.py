@@ -0,0 +1,63 @@
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF as CryptoHKDF
+
+from itoko.crypto.kdf import KDF, DerivedKey
+
+__all__ = ["HKDF", "HKDFDerivedKey"]
+
+backend = default_backend()
+
+
+class HKDFDerivedKey(DerivedKey):
+    """
+    HKDF derived key.
+    """
+
+    pass
+
+
+class HKDF(KDF):
+    """
+    Suite that uses HKDF extract-and-expand as KDF, using SHA256 as hash. It
+    performs no key stretching, so it must only be used with keys that are
+    already high-entropy, such as server-generated random keys.
+    """
+
+    __slots__ = ("info",)
+
+    default_key_length = 64
+    supported_key_lengths = (16, 32, 64)
+    derived_key_class = HKDFDerivedKey
+
+    info: bytes
+
+    def __init__(self, key_length: int, info: bytes = b"") -> None:
+        """
+        Instance the given KDF suite.
+
+        :param key_length:
+        :param info: Context string binding derived keys to their use.
+        """
+        super().__init__(key_length, iterations=0)
+        self.info = info
+
+    @property
+    def params(self) -> str:
+        return "{}:{}".format(super().params, self.info.hex())
+
+    def _derive(self, key: bytes, salt: bytes) -> bytes:
+        """
+        Derives a cryptographic fixed-length key from the given key.
+
+        :param key: High-entropy key.
+        :param salt: HKDF extract salt value.
+        """
+        kdf = CryptoHKDF(
+            algorithm=hashes.SHA256(),
+            length=self.key_length,
+            salt=salt,
+            info=self.info,
+            backend=backend,
+        )
+        return kdf.derive(key)
@@ -24,8 +24,9 @@ class PBKDF(KDF):
 
     default_key_length = 64
     supported_key_lengths = (16, 32, 64)
+    derived_key_class = PBKDFDerivedKey
 
-    def derive_key(self, key: bytes, salt: bytes) -> DerivedKey:
+    def _derive(self, key: bytes, salt: bytes) -> bytes:
         """
         Derives a cryptographic fixed-length key from the given key.
 
@@ -39,9 +40,4 @@ class PBKDF(KDF):
             iterations=self.iterations,
             backend=backend,
         )
-        return PBKDFDerivedKey(
-            key_length=self.key_length,
-            key=key,
-            salt=salt,
-            derived_key=kdf.derive(key),
-        )
+        return kdf.derive(key)
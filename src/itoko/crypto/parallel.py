@@ -0,0 +1,355 @@
+"""
+Parallel engine for suites built on a seekable cipher, such as AES in CTR mode,
+plus an HMAC. Any segment of the keystream can be computed on its own, so large
+payloads are split in segments processed by a thread pool, while the HMAC runs
+concurrently in another thread. Streamed payloads have their HMAC hashed in
+the pool a chunk behind the reads or encryption feeding it. The underlying
+primitives release the GIL, so segments really run on several cores.
+
+Output is byte-identical to a single-threaded pass.
+"""
+import hashlib
+import hmac as _hmac
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from itoko.crypto.cipher import Cipher
+from itoko.crypto.exc import DecryptionError
+
+__all__ = ["ParallelEngine", "PipelinedHMAC", "parallel_engine"]
+
+# Amount of bytes processed by a single task, a multiple of the block size
+SEGMENT_SIZE = 1024 * 1024
+
+
+class PipelinedHMAC:
+    """
+    HMAC-SHA256 over a stream of chunks, hashed in an engine thread one chunk
+    behind the caller, who reads or encrypts the next chunk meanwhile. The
+    first min_size bytes are hashed in the calling thread, small payloads
+    aren't worth the handoff. Chunks fed must be left untouched until the
+    next update() or finalize() call.
+    """
+
+    __slots__ = ("_pool", "_hmac", "_min_size", "_size", "_pending")
+
+    def __init__(
+        self, pool: ThreadPoolExecutor, hmac_key: bytes, min_size: int
+    ) -> None:
+        self._pool = pool
+        # The stdlib HMAC releases the GIL while hashing
+        self._hmac = _hmac.new(hmac_key, digestmod=hashlib.sha256)
+        self._min_size = min_size
+        self._size = 0
+        self._pending = None
+
+    def _wait(self) -> None:
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.result()
+
+    def update(self, data: bytes) -> None:
+        """
+        Feeds a chunk into the HMAC. Chunks must be fed in order.
+
+        :param data: Chunk, left untouched until the next call.
+        """
+        self._wait()
+        self._size += len(data)
+        if self._size <= self._min_size:
+            self._hmac.update(data)
+        else:
+            self._pending = self._pool.submit(self._hmac.update, data)
+
+    def finalize(self) -> bytes:
+        """
+        Finalizes the HMAC over every chunk fed so far.
+
+        :return: Computed HMAC.
+        """
+        self._wait()
+        return self._hmac.digest()
+
+    def verify(self, stored_hmac: bytes) -> None:
+        """
+        Checks the chunks fed so far against a stored HMAC. DecryptionError
+        is raised if they don't match.
+
+        :param stored_hmac: HMAC stored alongside the chunks.
+        """
+        if not _hmac.compare_digest(self.finalize(), stored_hmac):
+            raise DecryptionError
+
+
+class ParallelEngine:
+    """
+    Thread pool running cipher segments and HMACs for large payloads. The
+    engine is disabled until given a thread count, and payloads under a
+    minimum size are left to the single-threaded path, where the thread
+    handoff would cost more than it saves.
+    """
+
+    __slots__ = ("threads", "min_size", "segment_size", "_pool", "_lock")
+
+    threads: int
+    min_size: int
+    segment_size: int
+
+    _pool: Optional[ThreadPoolExecutor]
+
+    def __init__(
+        self,
+        threads: int = 0,
+        min_size: int = 16 * 1024 * 1024,
+        segment_size: int = SEGMENT_SIZE,
+    ) -> None:
+        self.threads = threads
+        self.min_size = min_size
+        self.segment_size = segment_size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threads > 0
+
+    def configure(self, threads: int, min_size: int) -> None:
+        """
+        Resizes the thread pool, which is started on first use.
+
+        :param threads: Amount of worker threads, 0 disables the engine.
+        :param min_size: Payloads under this size in bytes are processed in
+                         the calling thread.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self.threads = threads
+            self.min_size = min_size
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def accepts(self, size: int) -> bool:
+        """
+        Checks whether a payload is worth processing in parallel.
+
+        :param size: Payload size in bytes.
+        :return: Boolean indicating whether the engine should be used.
+        """
+        return self.enabled and size >= self.min_size
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.threads,
+                    thread_name_prefix="itoko-crypto",
+                )
+            return self._pool
+
+    def hmac(self, hmac_key: bytes) -> PipelinedHMAC:
+        """
+        Returns an HMAC-SHA256 hashed in the thread pool alongside the caller
+        once past the minimum size.
+
+        :param hmac_key: Derived HMAC key.
+        :return: Pipelined HMAC.
+        """
+        return PipelinedHMAC(self._get_pool(), hmac_key, self.min_size)
+
+    def verify(
+        self, hmac_key: bytes, authenticated, stored_hmac: bytes
+    ) -> None:
+        """
+        Verifies the HMAC of a payload in a streaming pass, hashing every
+        segment in the thread pool while the next one is read. Neither the
+        reads nor the hashing hold the GIL. DecryptionError is raised if
+        verification fails.
+
+        :param hmac_key: Derived HMAC key.
+        :param authenticated: Payload covered by the HMAC.
+        :param stored_hmac: HMAC stored alongside the payload.
+        """
+        h = PipelinedHMAC(self._get_pool(), hmac_key, 0)
+        # Every chunk is a new object, so it can be hashed while the next one
+        # is read
+        for chunk in authenticated.iter_chunks(
+            chunk_size=self.segment_size
+        ):
+            h.update(chunk)
+        h.verify(stored_hmac)
+
+    def _segments(self, size: int) -> Iterator[Tuple[int, int]]:
+        for start in range(0, size, self.segment_size):
+            yield start, min(start + self.segment_size, size)
+
+    @staticmethod
+    def _digest(hmac_key: bytes, data: memoryview) -> bytes:
+        # The stdlib HMAC releases the GIL while hashing, unlike the
+        # cryptography one, which would stall the cipher threads
+        h = _hmac.new(hmac_key, digestmod=hashlib.sha256)
+        for start in range(0, len(data), SEGMENT_SIZE):
+            h.update(data[start: start + SEGMENT_SIZE])
+        return h.digest()
+
+    @staticmethod
+    def _crypt_segment(
+        cipher: Cipher,
+        encrypt: bool,
+        data: memoryview,
+        out: memoryview,
+        start: int,
+        end: int,
+    ) -> None:
+        if encrypt:
+            context = cipher.encryptor_at(start)
+        else:
+            context = cipher.decryptor_at(start)
+        if len(out) - start >= cipher.buffer_size(end - start):
+            # The mode is a stream one, so only the segment itself is written
+            # even if the context is given room past it
+            context.update_into(data[start:end], out[start:])
+        else:
+            # Not enough room left past the last segment
+            out[start:end] = context.update(data[start:end])
+
+    def _crypt(
+        self, cipher: Cipher, encrypt: bool, data: memoryview, out: memoryview
+    ) -> List[Future]:
+        pool = self._get_pool()
+        return [
+            pool.submit(
+                self._crypt_segment, cipher, encrypt, data, out, start, end
+            )
+            for start, end in self._segments(len(data))
+        ]
+
+    def decrypt(
+        self,
+        cipher: Cipher,
+        hmac_key: bytes,
+        authenticated: bytes,
+        encrypted_pos: int,
+        stored_hmac: bytes,
+    ) -> bytearray:
+        """
+        Decrypts a bundle in parallel segments while verifying its HMAC in
+        another thread. The plaintext is only returned once the HMAC has been
+        verified, DecryptionError is raised otherwise.
+
+        :param cipher: Seekable cipher keyed for the ciphertext.
+        :param hmac_key: Derived HMAC key.
+        :param authenticated: Bytes covered by the HMAC, which end with the
+                              ciphertext.
+        :param encrypted_pos: Position of the ciphertext in authenticated.
+        :param stored_hmac: HMAC stored alongside the ciphertext.
+        :return: Plaintext.
+        """
+        authenticated = memoryview(authenticated)
+        encrypted = authenticated[encrypted_pos:]
+        pool = self._get_pool()
+        digest = pool.submit(self._digest, hmac_key, authenticated)
+        out = bytearray(len(encrypted))
+        for segment in self._crypt(
+            cipher, False, encrypted, memoryview(out)
+        ):
+            segment.result()
+        if not _hmac.compare_digest(digest.result(), stored_hmac):
+            raise DecryptionError
+        return out
+
+    def encrypt(
+        self,
+        cipher: Cipher,
+        hmac_key: bytes,
+        prefix: bytes,
+        plaintext: bytes,
+        header_size: int = 0,
+    ) -> Tuple[bytearray, bytes]:
+        """
+        Encrypts plaintext in parallel segments, HMACing every segment as soon
+        as it and the ones before it are done.
+
+        :param cipher: Seekable cipher keyed for the plaintext.
+        :param hmac_key: Derived HMAC key.
+        :param prefix: Bytes stored right before the ciphertext and covered by
+                       the HMAC, such as the nonce.
+        :param plaintext: Plaintext.
+        :param header_size: Amount of blank bytes to leave at the start of the
+                            bundle, for the caller to fill in place.
+        :return: Blank header, prefix and ciphertext, and the HMAC over the
+                 prefix and ciphertext.
+        """
+        plaintext = memoryview(plaintext)
+        out = bytearray(header_size + len(prefix) + len(plaintext))
+        out[header_size: header_size + len(prefix)] = prefix
+        encrypted = memoryview(out)[header_size + len(prefix):]
+        h = _hmac.new(hmac_key, digestmod=hashlib.sha256)
+        h.update(prefix)
+        segments = self._crypt(cipher, True, plaintext, encrypted)
+        for (start, end), segment in zip(
+            self._segments(len(plaintext)), segments
+        ):
+            segment.result()
+            h.update(encrypted[start:end])
+        return out, h.digest()
+
+    def iter_decrypt(
+        self,
+        cipher: Cipher,
+        source,
+        position: int,
+        start: int,
+        end: int,
+        chunk_size: int,
+    ) -> Iterator[bytes]:
+        """
+        Yields a byte range of an already verified ciphertext payload in
+        plaintext chunks, decrypting segments ahead in the thread pool. At most
+        one segment per thread is held in memory at once.
+
+        :param cipher: Seekable cipher keyed for the ciphertext.
+        :param source: Ciphertext Payload.
+        :param position: Keystream position of the first ciphertext byte.
+        :param start: First byte of the range.
+        :param end: Byte after the last byte of the range.
+        :param chunk_size: Maximum size of each yielded chunk.
+        """
+        pool = self._get_pool()
+
+        def decrypt_segment(seg_start: int, seg_end: int) -> bytes:
+            decryptor = cipher.decryptor_at(position + seg_start)
+            return decryptor.update(source.read(seg_start, seg_end))
+
+        bounds = (
+            (start + seg_start, start + seg_end)
+            for seg_start, seg_end in self._segments(end - start)
+        )
+        pending = deque()
+        try:
+            for seg_start, seg_end in bounds:
+                pending.append(
+                    pool.submit(decrypt_segment, seg_start, seg_end)
+                )
+                if len(pending) < self.threads:
+                    continue
+                yield from self._split(pending.popleft().result(), chunk_size)
+            while pending:
+                yield from self._split(pending.popleft().result(), chunk_size)
+        finally:
+            # Stop decrypting ahead if the consumer went away
+            for segment in pending:
+                segment.cancel()
+
+    @staticmethod
+    def _split(data: bytes, chunk_size: int) -> Iterator[bytes]:
+        if len(data) <= chunk_size:
+            yield data
+            return
+        view = memoryview(data)
+        for pos in range(0, len(data), chunk_size):
+            yield bytes(view[pos: pos + chunk_size])
+
+
+parallel_engine = ParallelEngine()
@@ -1,6 +1,84 @@
+import struct
 from abc import ABC, abstractmethod
+from typing import BinaryIO, Iterable, Sequence, Type, Union
 
-__all__ = ["Suite"]
+from itoko.crypto.exc import DecryptionError, UnsupportedSuiteError
+from itoko.crypto.hmac import HMAC
+from itoko.crypto.hmac.cache import verification_cache
+from itoko.crypto.parallel import parallel_engine
+from itoko.fs.payload import DEFAULT_CHUNK_SIZE, Payload, BytesPayload
+
+__all__ = ["Suite", "SuiteEncryptor"]
+
+
+class SuiteEncryptor(ABC):
+    """
+    Incremental encryption context for a suite. Ciphertext is produced chunk
+    by chunk into caller provided buffers, to be stored header_size bytes past
+    the start of the bundle. The crypto header filling those bytes is only
+    known once the context is finalized.
+    """
+
+    __slots__ = ()
+
+    @property
+    @abstractmethod
+    def header_size(self) -> int:
+        """
+        Returns the amount of bytes to reserve for the crypto header.
+        """
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def header(self) -> bytes:
+        """
+        Returns the crypto header, only available after finalize().
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def output_size(self, size: int) -> int:
+        """
+        Returns the size of a buffer able to hold the output of update_into()
+        for the given amount of plaintext bytes.
+
+        :param size: Amount of plaintext bytes to be fed.
+        :return: Buffer size in bytes.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_into(self, plaintext: bytes, buf: bytearray) -> int:
+        """
+        Encrypts a chunk of plaintext into the given buffer.
+
+        :param plaintext: Plaintext chunk, any bytes-like object.
+        :param buf: Buffer of at least output_size(len(plaintext)) bytes,
+                    left untouched until the next call, as the ciphertext
+                    may still be hashed meanwhile.
+        :return: Amount of ciphertext bytes written to the buffer.
+        """
+        raise NotImplementedError
+
+    def update(self, plaintext: bytes) -> bytes:
+        """
+        Encrypts a chunk of plaintext into a new bytes object.
+
+        :param plaintext: Plaintext chunk, any bytes-like object.
+        :return: Ciphertext.
+        """
+        buf = bytearray(self.output_size(len(plaintext)))
+        return bytes(memoryview(buf)[: self.update_into(plaintext, buf)])
+
+    @abstractmethod
+    def finalize(self) -> bytes:
+        """
+        Finishes encryption, after which the crypto header is available.
+
+        :return: Remaining ciphertext, to be stored after every chunk.
+        """
+        raise NotImplementedError
 
 
 class Suite(ABC):
@@ -11,9 +89,93 @@ class Suite(ABC):
 
     __slots__ = ("key",)
 
+    SUITE_ID: int = None
+    # Every crypto header starts with the ID of the suite that wrote it
+    SUITE_ID_FORMAT = "!H"
+    SUITE_ID_SIZE = struct.calcsize("!H")
+
     def __init__(self, key: bytes):
         self.key = key
 
+    @classmethod
+    def read_suite_id(
+        cls, ciphertext: Union[bytes, memoryview, Payload]
+    ) -> int:
+        """
+        Reads the suite ID from the crypto header of a bundle. DecryptionError
+        is raised if the bundle is too short to hold one.
+
+        :param ciphertext: Bundle including the crypto header.
+        :return: Suite ID.
+        """
+        prefix = cls._read_bundle(ciphertext, 0, cls.SUITE_ID_SIZE)
+        suite_id, = struct.unpack(cls.SUITE_ID_FORMAT, prefix)
+        return suite_id
+
+    @classmethod
+    def lookup(
+        cls, suites: Sequence[Type["Suite"]], suite_id: int
+    ) -> Type["Suite"]:
+        """
+        Finds the suite with the given ID. UnsupportedSuiteError is raised if
+        the ID isn't one of the given suites.
+
+        :param suites: Suites to look into.
+        :param suite_id: Suite ID, as read from a crypto header.
+        :return: Suite class.
+        """
+        for suite in suites:
+            if suite.SUITE_ID == suite_id:
+                return suite
+        raise UnsupportedSuiteError(suite_id)
+
+    @classmethod
+    def from_bundle(
+        cls,
+        suites: Sequence[Type["Suite"]],
+        key: bytes,
+        ciphertext: Union[bytes, memoryview, Payload],
+    ) -> "Suite":
+        """
+        Instances the suite which encrypted a bundle, as told by the suite ID
+        in its crypto header. UnsupportedSuiteError is raised if the ID isn't
+        one of the given suites.
+
+        :param suites: Suites which may have encrypted the bundle.
+        :param key: Decryption key.
+        :param ciphertext: Bundle including the crypto header.
+        :return: Suite instance able to decrypt the bundle.
+        """
+        return cls.lookup(suites, cls.read_suite_id(ciphertext))(key)
+
+    @classmethod
+    def read_tag(cls, ciphertext: Union[bytes, memoryview, Payload]) -> bytes:
+        """
+        Reads the authentication tag stored in a bundle, without any key. As
+        the tag covers the whole ciphertext, it identifies the stored bytes.
+        DecryptionError is raised if the bundle is too short to hold one.
+
+        :param ciphertext: Bundle including the crypto header.
+        :return: Stored tag.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _read_bundle(
+        ciphertext: Union[bytes, memoryview, Payload], start: int, end: int
+    ) -> bytes:
+        """
+        Reads a byte range of a bundle, whether held in memory or not.
+        DecryptionError is raised if the bundle is too short for the range.
+        """
+        if isinstance(ciphertext, Payload):
+            data = ciphertext.read(start, end)
+        else:
+            data = bytes(ciphertext[start:end])
+        if len(data) < end - start:
+            raise DecryptionError
+        return data
+
     @abstractmethod
     def encrypt(self, plaintext: bytes) -> bytes:
         """
@@ -27,3 +189,82 @@ class Suite(ABC):
         Decrypts a bundle using the suite parameters.
         """
         raise NotImplementedError
+
+    def encryptor(self) -> SuiteEncryptor:
+        """
+        Returns an incremental encryption context. Suites able to encrypt
+        incrementally should override this.
+        """
+        raise NotImplementedError("Suite can't encrypt incrementally.")
+
+    def encrypt_stream(self, chunks: Iterable[bytes], fp: BinaryIO) -> None:
+        """
+        Encrypts a sequence of plaintext chunks and writes the resulting bundle
+        to the given file object, through two buffers used in turns, so one
+        chunk is encrypted while the previous one may still be hashed. If
+        the suite has a crypto header the file object must be
+        seekable, as it is backfilled at the end. Suites unable to encrypt
+        incrementally buffer the whole plaintext.
+        """
+        try:
+            encryptor = self.encryptor()
+        except NotImplementedError:
+            fp.write(self.encrypt(b"".join(chunks)))
+            return
+        # Reserve room for the crypto header
+        header_pos = fp.tell()
+        fp.write(bytes(encryptor.header_size))
+        bufs = [bytearray(), bytearray()]
+        for i, chunk in enumerate(chunks):
+            size = encryptor.output_size(len(chunk))
+            buf = bufs[i % 2]
+            # Only grows when a larger chunk than ever before shows up
+            if len(buf) < size:
+                buf = bufs[i % 2] = bytearray(size)
+            fp.write(memoryview(buf)[: encryptor.update_into(chunk, buf)])
+        fp.write(encryptor.finalize())
+        # Backfill crypto header
+        if encryptor.header_size:
+            end_pos = fp.tell()
+            fp.seek(header_pos)
+            fp.write(encryptor.header)
+            fp.seek(end_pos)
+
+    def open(self, ciphertext: Payload, verify: bool = True) -> Payload:
+        """
+        Verifies a bundle and returns a view over its plaintext. Suites able to
+        decrypt incrementally should override this to verify in a streaming
+        pass and decrypt lazily, the default implementation decrypts the whole
+        bundle in memory.
+
+        Views opened without verification skip the pass over the whole
+        bundle, for reading a few bytes which nothing is released from. Keys
+        of unverified views aren't cached. Suites verifying as they read
+        always verify.
+        """
+        return BytesPayload(self.decrypt(ciphertext.read()))
+
+    @staticmethod
+    def _verify(hmac: HMAC, authenticated: Payload, stored_hmac: bytes):
+        """
+        Verifies the HMAC of a payload in a streaming pass. Payloads already
+        verified with the same key are remembered and not hashed again, large
+        ones are hashed by the parallel engine while being read.
+        DecryptionError is raised if verification fails.
+        """
+        identity = authenticated.identity
+        hmac_key = hmac.key.hmac_key
+        if identity is not None and verification_cache.is_verified(
+            identity, stored_hmac, hmac_key
+        ):
+            return
+        if parallel_engine.accepts(len(authenticated)):
+            parallel_engine.verify(hmac_key, authenticated, stored_hmac)
+        else:
+            for chunk in authenticated.iter_into(
+                bytearray(DEFAULT_CHUNK_SIZE)
+            ):
+                hmac.update(chunk)
+            hmac.verify(stored_hmac)
+        if identity is not None:
+            verification_cache.add(identity, stored_hmac, hmac_key)
@@ -0,0 +1,202 @@
+import os
+import struct
+from typing import Union
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+
+from itoko.crypto.exc import DecryptionError
+from itoko.crypto.kdf import DerivedKey
+from itoko.crypto.kdf.pbkdf import PBKDF
+from itoko.crypto.cipher.aesgcm import AESGCMCipher
+from itoko.crypto.hmac.cache import verification_cache
+from itoko.crypto.suite import Suite, SuiteEncryptor
+from itoko.fs.payload import DEFAULT_CHUNK_SIZE, Payload, CipherPayload
+
+backend = default_backend()
+
+
+class AESGCMSuite(Suite):
+    """
+    Handles authenticated encryption and decryption with AES-256 in GCM mode.
+    Unlike AESv2Suite, encryption and authentication happen in a single pass
+    over the data. The crypto header is the same size as the AESv2Suite one,
+    holding the salt, the IV and the GCM tag, and every field before the tag
+    is authenticated as additional data.
+    """
+
+    __slots__ = ("key",)
+
+    SUITE_ID = 6
+    HEADER_FORMAT = "!H6x16s12s4x16s16x"
+    HEADER_SIZE = struct.calcsize("!H6x16s12s4x16s16x")
+    # Header fields covered by the tag as additional data
+    AAD_SIZE = struct.calcsize("!H6x16s12s4x")
+
+    # 256-bit key, GCM uses the whole derived key
+    KEY_LENGTH = 32
+    SALT_SIZE = 16
+    IV_SIZE = AESGCMCipher.IV_SIZE
+    TAG_SIZE = AESGCMCipher.TAG_SIZE
+    ITERATION_COUNT = 100000
+
+    def _get_kdf(self):
+        return PBKDF(self.KEY_LENGTH, self.ITERATION_COUNT)
+
+    @classmethod
+    def read_tag(cls, ciphertext: Union[bytes, memoryview, Payload]) -> bytes:
+        """
+        Reads the GCM tag from the crypto header of a bundle.
+        """
+        header = cls._read_bundle(ciphertext, 0, cls.HEADER_SIZE)
+        return struct.unpack(cls.HEADER_FORMAT, header)[-1]
+
+    def _build_header(self, salt: bytes, iv: bytes, tag: bytes) -> bytes:
+        return struct.pack(self.HEADER_FORMAT, self.SUITE_ID, salt, iv, tag)
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        """
+        Encrypts plaintext with AES in GCM mode. The key is derived through
+        PBKDF2 over the provided key. Returns a bundle including the crypto
+        header and the ciphertext.
+        """
+        salt = os.urandom(self.SALT_SIZE)
+        iv = os.urandom(self.IV_SIZE)
+        dk = self._get_kdf().derive_key(self.key, salt)
+        encryptor = AESGCMCipher(dk, iv=iv).encryptor()
+        header = self._build_header(salt, iv, bytes(self.TAG_SIZE))
+        encryptor.authenticate_additional_data(header[: self.AAD_SIZE])
+        encrypted = encryptor.update(plaintext) + encryptor.finalize()
+        return self._build_header(salt, iv, encryptor.tag) + encrypted
+
+    def encryptor(self) -> "AESGCMEncryptor":
+        """
+        Returns an incremental context which encrypts and authenticates
+        plaintext chunks with AES in GCM mode in a single pass.
+        """
+        return AESGCMEncryptor(self)
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        """
+        Decrypts a bundle using the provided key. The PBKDF2 salt is taken from
+        the bundle. If the provided key and salt fail to verify the GCM tag
+        DecryptionError is raised, and no plaintext is returned.
+        """
+        header = bytes(ciphertext[: self.HEADER_SIZE])
+        if len(header) < self.HEADER_SIZE:
+            raise DecryptionError
+        _, salt, iv, tag = struct.unpack(self.HEADER_FORMAT, header)
+        kdf = self._get_kdf()
+        dk = kdf.derive_key(self.key, salt, cached=True)
+        decryptor = AESGCMCipher(dk, iv=iv).decryptor()
+        decryptor.authenticate_additional_data(header[: self.AAD_SIZE])
+        plaintext = decryptor.update(ciphertext[self.HEADER_SIZE:])
+        try:
+            decryptor.finalize_with_tag(tag)
+        except InvalidTag as e:
+            raise DecryptionError from e
+        kdf.cache_key(dk)
+        return plaintext
+
+    def open(self, ciphertext: Payload, verify: bool = True) -> Payload:
+        """
+        Verifies the GCM tag of a bundle in a streaming pass, then returns a
+        view that decrypts the bundle lazily. If the provided key and salt fail
+        to verify the tag DecryptionError is raised.
+
+        The ciphertext is thus decrypted twice, once to verify the tag and once
+        more as the view is read. Spooling the plaintext of the first pass
+        would save the second one, but not for range reads, which only decrypt
+        the requested bytes, and it would cost a write and read of the whole
+        plaintext instead.
+        """
+        header = ciphertext.read(0, self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            raise DecryptionError
+        _, salt, iv, tag = struct.unpack(self.HEADER_FORMAT, header)
+        kdf = self._get_kdf()
+        dk = kdf.derive_key(self.key, salt, cached=True)
+        cipher = AESGCMCipher(dk, iv=iv)
+        encrypted = ciphertext.slice(self.HEADER_SIZE)
+        if verify:
+            # Check the tag before releasing anything
+            self._verify_tag(
+                cipher, dk, header[: self.AAD_SIZE], encrypted, tag
+            )
+            kdf.cache_key(dk)
+        return CipherPayload(encrypted, cipher)
+
+    @staticmethod
+    def _verify_tag(
+        cipher: AESGCMCipher,
+        dk: DerivedKey,
+        aad: bytes,
+        encrypted: Payload,
+        tag: bytes,
+    ) -> None:
+        """
+        Verifies the GCM tag of a payload in a streaming pass, discarding the
+        plaintext, as the GHASH can't be computed without decrypting. Payloads
+        already verified with the same key are remembered and not processed
+        again. DecryptionError is raised if verification fails.
+        """
+        identity = encrypted.identity
+        if identity is not None and verification_cache.is_verified(
+            identity, tag, dk.derived_key
+        ):
+            return
+        decryptor = cipher.decryptor()
+        decryptor.authenticate_additional_data(aad)
+        # The plaintext is thrown away, keep overwriting the same buffers
+        scratch = bytearray(DEFAULT_CHUNK_SIZE)
+        discard = bytearray(cipher.buffer_size(DEFAULT_CHUNK_SIZE))
+        for chunk in encrypted.iter_into(scratch):
+            decryptor.update_into(chunk, discard)
+        try:
+            decryptor.finalize_with_tag(tag)
+        except InvalidTag as e:
+            raise DecryptionError from e
+        if identity is not None:
+            verification_cache.add(identity, tag, dk.derived_key)
+
+
+class AESGCMEncryptor(SuiteEncryptor):
+    """
+    Incremental encryption context for AESGCMSuite bundles.
+    """
+
+    __slots__ = ("_suite", "_salt", "_iv", "_cipher", "_gcm", "_header")
+
+    def __init__(self, suite: AESGCMSuite) -> None:
+        self._suite = suite
+        self._salt = os.urandom(suite.SALT_SIZE)
+        self._iv = os.urandom(suite.IV_SIZE)
+        dk = suite._get_kdf().derive_key(suite.key, self._salt)
+        self._cipher = AESGCMCipher(dk, iv=self._iv)
+        self._gcm = self._cipher.encryptor()
+        header = suite._build_header(
+            self._salt, self._iv, bytes(suite.TAG_SIZE)
+        )
+        self._gcm.authenticate_additional_data(header[: suite.AAD_SIZE])
+        self._header = None
+
+    @property
+    def header_size(self) -> int:
+        return self._suite.HEADER_SIZE
+
+    @property
+    def header(self) -> bytes:
+        return self._header
+
+    def output_size(self, size: int) -> int:
+        return self._cipher.buffer_size(size)
+
+    def update_into(self, plaintext: bytes, buf: bytearray) -> int:
+        return self._gcm.update_into(plaintext, buf)
+
+    def finalize(self) -> bytes:
+        encrypted = self._gcm.finalize()
+        self._header = self._suite._build_header(
+            self._salt, self._iv, self._gcm.tag
+        )
+        return encrypted
@@ -0,0 +1,19 @@
+from itoko.crypto.kdf.hkdf import HKDF
+from itoko.crypto.suite.aesgcm import AESGCMSuite
+
+
+class AESGCMHKDFSuite(AESGCMSuite):
+    """
+    Handles authenticated encryption and decryption with AES-256 in GCM mode,
+    with the same layout as AESGCMSuite. Keys are derived through HKDF instead
+    of PBKDF2. Only meant for server-generated keys, which already have enough
+    entropy.
+    """
+
+    __slots__ = ()
+
+    SUITE_ID = 7
+    HKDF_INFO = b"itoko AES-256-GCM"
+
+    def _get_kdf(self):
+        return HKDF(self.KEY_LENGTH, info=self.HKDF_INFO)
@@ -1,11 +1,14 @@
 import os
+from typing import Union
 
 from cryptography.hazmat.backends import default_backend
 
+from itoko.crypto.exc import DecryptionError
 from itoko.crypto.kdf.pbkdf import PBKDF
 from itoko.crypto.cipher.aesctr import AESCTRCipher
 from itoko.crypto.hmac.sha256 import SHA256HMAC
 from itoko.crypto.suite import Suite
+from itoko.fs.payload import Payload, CipherPayload
 
 backend = default_backend()
 
@@ -27,6 +30,18 @@ class AESv1Suite(Suite):
     def _get_kdf(self):
         return PBKDF(self.KEY_LENGTH * 2, self.ITERATION_COUNT)
 
+    @classmethod
+    def read_tag(cls, ciphertext: Union[bytes, memoryview, Payload]) -> bytes:
+        """
+        Reads the HMAC from the footer of a bundle.
+        """
+        footer_pos = len(ciphertext) - cls.SALT_SIZE - SHA256HMAC.digest_size
+        if footer_pos < 0:
+            raise DecryptionError
+        return cls._read_bundle(
+            ciphertext, footer_pos, footer_pos + SHA256HMAC.digest_size
+        )
+
     def encrypt(self, plaintext: bytes) -> bytes:
         """
         Encrypts-then-HMACs plaintext with AES in CTR mode. The key is derived
@@ -52,22 +67,47 @@ class AESv1Suite(Suite):
         the bundle. If the provided key and salt fail to verify the HMAC
         AESCipherException is raised.
         """
+        # Bundles may be memoryviews, only copy the small fields
         payload, hh, salt = (
             ciphertext[: -(self.SALT_SIZE + SHA256HMAC.digest_size)],
-            ciphertext[
+            bytes(ciphertext[
                 -(self.SALT_SIZE + SHA256HMAC.digest_size): -self.SALT_SIZE
-            ],
-            ciphertext[-self.SALT_SIZE:],
+            ]),
+            bytes(ciphertext[-self.SALT_SIZE:]),
         )
         kdf = self._get_kdf()
-        dk = kdf.derive_key(self.key, salt)
+        dk = kdf.derive_key(self.key, salt, cached=True)
         # Check the HMAC before going further
         hmac = SHA256HMAC(dk)
         hmac.check(payload, hh)
+        kdf.cache_key(dk)
         # CTR nonce is the first block
         nonce, encrypted = (
-            payload[: self.BLOCK_SIZE],
+            bytes(payload[: self.BLOCK_SIZE]),
             payload[self.BLOCK_SIZE:],
         )
         cipher = AESCTRCipher(dk, nonce=nonce)
         return cipher.decrypt(encrypted)
+
+    def open(self, ciphertext: Payload, verify: bool = True) -> Payload:
+        """
+        Verifies the HMAC of a bundle in a streaming pass, then returns a view
+        that decrypts the bundle lazily. If the provided key and salt fail to
+        verify the HMAC DecryptionError is raised.
+        """
+        footer_size = self.SALT_SIZE + SHA256HMAC.digest_size
+        footer_pos = len(ciphertext) - footer_size
+        hh = ciphertext.read(footer_pos, len(ciphertext) - self.SALT_SIZE)
+        salt = ciphertext.read(len(ciphertext) - self.SALT_SIZE)
+        kdf = self._get_kdf()
+        dk = kdf.derive_key(self.key, salt, cached=True)
+        if verify:
+            # Check the HMAC before releasing anything
+            self._verify(SHA256HMAC(dk), ciphertext.slice(0, footer_pos), hh)
+            kdf.cache_key(dk)
+        # CTR nonce is the first block
+        nonce = ciphertext.read(0, self.BLOCK_SIZE)
+        return CipherPayload(
+            ciphertext.slice(self.BLOCK_SIZE, footer_pos),
+            AESCTRCipher(dk, nonce=nonce),
+        )
@@ -1,12 +1,15 @@
 import os
 import struct
+from typing import Union
 
 from cryptography.hazmat.backends import default_backend
 
 from itoko.crypto.kdf.pbkdf import PBKDF
 from itoko.crypto.cipher.aesctr import AESCTRCipher
 from itoko.crypto.hmac.sha256 import SHA256HMAC
-from itoko.crypto.suite import Suite
+from itoko.crypto.parallel import parallel_engine
+from itoko.crypto.suite import Suite, SuiteEncryptor
+from itoko.fs.payload import Payload, CipherPayload
 
 backend = default_backend()
 
@@ -33,6 +36,14 @@ class AESv2Suite(Suite):
     def _get_kdf(self):
         return PBKDF(self.KEY_LENGTH * 2, self.ITERATION_COUNT)
 
+    @classmethod
+    def read_tag(cls, ciphertext: Union[bytes, memoryview, Payload]) -> bytes:
+        """
+        Reads the HMAC from the crypto header of a bundle.
+        """
+        header = cls._read_bundle(ciphertext, 0, cls.HEADER_SIZE)
+        return struct.unpack(cls.HEADER_FORMAT, header)[-1]
+
     def encrypt(self, plaintext: bytes) -> bytes:
         """
         Encrypts-then-HMACs plaintext with AES in CTR mode. The key is derived
@@ -45,6 +56,14 @@ class AESv2Suite(Suite):
         kdf = self._get_kdf()
         dk = kdf.derive_key(self.key, salt)
         cipher = AESCTRCipher(dk, nonce=nonce)
+        if parallel_engine.accepts(len(plaintext)):
+            bundle, hh = parallel_engine.encrypt(
+                cipher, dk.hmac_key, nonce, plaintext, self.HEADER_SIZE
+            )
+            bundle[: self.HEADER_SIZE] = struct.pack(
+                self.HEADER_FORMAT, self.SUITE_ID, salt, hh
+            )
+            return bundle
         encrypted = cipher.encrypt(plaintext)
         # Make the CTR nonce the first block and use the HMAC to verify it too
         encrypted = nonce + encrypted
@@ -54,6 +73,14 @@ class AESv2Suite(Suite):
         header = struct.pack(self.HEADER_FORMAT, self.SUITE_ID, salt, hh)
         return header + encrypted
 
+    def encryptor(self) -> "AESv2Encryptor":
+        """
+        Returns an incremental context which encrypts-then-HMACs plaintext
+        chunks with AES in CTR mode, hashing each ciphertext chunk as it is
+        produced. The crypto header holds the CTR nonce as its last block.
+        """
+        return AESv2Encryptor(self)
+
     def decrypt(self, ciphertext: bytes) -> bytes:
         """
         Decrypts a bundle using the provided key. The PBKDF2 salt is taken from
@@ -66,14 +93,105 @@ class AESv2Suite(Suite):
         )
         _, salt, hh = struct.unpack(self.HEADER_FORMAT, header)
         kdf = self._get_kdf()
-        dk = kdf.derive_key(self.key, salt)
-        # Check the HMAC before going further
-        hmac = SHA256HMAC(dk)
-        hmac.check(payload, hh)
+        dk = kdf.derive_key(self.key, salt, cached=True)
         # CTR nonce is the first block
         nonce, encrypted = (
-            payload[: self.BLOCK_SIZE],
+            bytes(payload[: self.BLOCK_SIZE]),
             payload[self.BLOCK_SIZE:],
         )
         cipher = AESCTRCipher(dk, nonce=nonce)
+        if parallel_engine.accepts(len(encrypted)):
+            # Verifies the HMAC alongside, nothing is returned before it's done
+            plaintext = parallel_engine.decrypt(
+                cipher, dk.hmac_key, payload, self.BLOCK_SIZE, hh
+            )
+            kdf.cache_key(dk)
+            return plaintext
+        # Check the HMAC before going further
+        hmac = SHA256HMAC(dk)
+        hmac.check(payload, hh)
+        kdf.cache_key(dk)
         return cipher.decrypt(encrypted)
+
+    def open(self, ciphertext: Payload, verify: bool = True) -> Payload:
+        """
+        Verifies the HMAC of a bundle in a streaming pass, then returns a view
+        that decrypts the bundle lazily. If the provided key and salt fail to
+        verify the HMAC DecryptionError is raised.
+        """
+        header = ciphertext.read(0, self.HEADER_SIZE)
+        _, salt, hh = struct.unpack(self.HEADER_FORMAT, header)
+        kdf = self._get_kdf()
+        dk = kdf.derive_key(self.key, salt, cached=True)
+        if verify:
+            # Check the HMAC before releasing anything
+            self._verify(
+                SHA256HMAC(dk), ciphertext.slice(self.HEADER_SIZE), hh
+            )
+            kdf.cache_key(dk)
+        # CTR nonce is the first block
+        nonce = ciphertext.read(
+            self.HEADER_SIZE, self.HEADER_SIZE + self.BLOCK_SIZE
+        )
+        return CipherPayload(
+            ciphertext.slice(self.HEADER_SIZE + self.BLOCK_SIZE),
+            AESCTRCipher(dk, nonce=nonce),
+        )
+
+
+class AESv2Encryptor(SuiteEncryptor):
+    """
+    Incremental encryption context for AESv2Suite bundles.
+    """
+
+    __slots__ = (
+        "_suite",
+        "_salt",
+        "_nonce",
+        "_cipher",
+        "_ctr",
+        "_hmac",
+        "_header",
+    )
+
+    def __init__(self, suite: AESv2Suite) -> None:
+        self._suite = suite
+        self._salt = os.urandom(suite.SALT_SIZE)
+        self._nonce = os.urandom(suite.BLOCK_SIZE)
+        dk = suite._get_kdf().derive_key(suite.key, self._salt)
+        self._cipher = AESCTRCipher(dk, nonce=self._nonce)
+        self._ctr = self._cipher.encryptor()
+        # CTR nonce is still the first block and covered by the HMAC. Large
+        # uploads are hashed by the parallel engine while being encrypted
+        if parallel_engine.enabled:
+            self._hmac = parallel_engine.hmac(dk.hmac_key)
+        else:
+            self._hmac = SHA256HMAC(dk)
+        self._hmac.update(self._nonce)
+        self._header = None
+
+    @property
+    def header_size(self) -> int:
+        return self._suite.HEADER_SIZE + self._suite.BLOCK_SIZE
+
+    @property
+    def header(self) -> bytes:
+        return self._header
+
+    def output_size(self, size: int) -> int:
+        return self._cipher.buffer_size(size)
+
+    def update_into(self, plaintext: bytes, buf: bytearray) -> int:
+        written = self._ctr.update_into(plaintext, buf)
+        self._hmac.update(memoryview(buf)[:written])
+        return written
+
+    def finalize(self) -> bytes:
+        encrypted = self._ctr.finalize()
+        self._hmac.update(encrypted)
+        hh = self._hmac.finalize()
+        suite = self._suite
+        self._header = struct.pack(
+            suite.HEADER_FORMAT, suite.SUITE_ID, self._salt, hh
+        ) + self._nonce
+        return encrypted
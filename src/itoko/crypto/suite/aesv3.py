@@ -0,0 +1,388 @@
+import hmac as _hmac
+import io
+import os
+import struct
+from typing import Iterator, Union
+
+from cryptography.hazmat.backends import default_backend
+
+from itoko.crypto.exc import DecryptionError
+from itoko.crypto.kdf import DerivedKey
+from itoko.crypto.kdf.pbkdf import PBKDF
+from itoko.crypto.cipher.aesctr import AESCTRCipher
+from itoko.crypto.hmac.sha256 import SHA256HMAC
+from itoko.crypto.suite import Suite, SuiteEncryptor
+from itoko.fs.payload import DEFAULT_CHUNK_SIZE, Payload, BytesPayload
+
+backend = default_backend()
+
+
+class AESv3Suite(Suite):
+    """
+    Handles encryption and decryption with AES-256-HMAC in CTR mode, split in
+    fixed-size chunks which are authenticated on their own. Any chunk can be
+    verified and decrypted without touching the rest of the bundle.
+
+    The crypto header stores the chunk size and plaintext length, which act
+    as the chunk index, and is authenticated by its own HMAC. Each chunk is
+    stored as its HMAC followed by its ciphertext. The chunk HMAC covers the
+    nonce, the chunk index and whether it's the last chunk, so chunks can't
+    be reordered, dropped or moved between files.
+    """
+
+    __slots__ = ("key", "chunk_size")
+
+    SUITE_ID = 3
+    HEADER_FORMAT = "!H6x16s16sI4xQ32s"
+    HEADER_SIZE = struct.calcsize("!H6x16s16sI4xQ32s")
+    CHUNK_TAG_FORMAT = "!16sQ?"
+
+    # 256-bit key
+    KEY_LENGTH = 32
+    # AES blocks are always 128 bits
+    SALT_SIZE = 16
+    BLOCK_SIZE = 16
+    TAG_SIZE = SHA256HMAC.digest_size
+    ITERATION_COUNT = 100000
+
+    def __init__(self, key: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        super().__init__(key)
+        self.chunk_size = chunk_size
+
+    def _get_kdf(self):
+        return PBKDF(self.KEY_LENGTH * 2, self.ITERATION_COUNT)
+
+    @classmethod
+    def read_tag(cls, ciphertext: Union[bytes, memoryview, Payload]) -> bytes:
+        """
+        Reads the header HMAC from the crypto header of a bundle. It covers the
+        random nonce every chunk HMAC is bound to, so it identifies the bundle.
+        """
+        header = cls._read_bundle(ciphertext, 0, cls.HEADER_SIZE)
+        return struct.unpack(cls.HEADER_FORMAT, header)[-1]
+
+    @classmethod
+    def _chunk_tag(
+        cls,
+        dk: DerivedKey,
+        nonce: bytes,
+        index: int,
+        last: bool,
+        encrypted: bytes,
+    ) -> bytes:
+        hmac = SHA256HMAC(dk)
+        hmac.update(struct.pack(cls.CHUNK_TAG_FORMAT, nonce, index, last))
+        hmac.update(encrypted)
+        return hmac.finalize()
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        """
+        Encrypts-then-HMACs plaintext chunk by chunk with AES in CTR mode. The
+        key is derived through PBKDF2 over the provided key. Returns a bundle
+        including the crypto header and the authenticated chunks.
+        """
+        bundle = io.BytesIO()
+        self.encrypt_stream([plaintext], bundle)
+        return bundle.getvalue()
+
+    def encryptor(self) -> "AESv3Encryptor":
+        """
+        Returns an incremental context which splits plaintext in chunks and
+        encrypts-then-HMACs each of them, emitting every chunk tag right before
+        its ciphertext. The crypto header is known once the plaintext length
+        is.
+        """
+        return AESv3Encryptor(self)
+
+    def _build_header(
+        self, dk: DerivedKey, salt: bytes, nonce: bytes, length: int
+    ) -> bytes:
+        header = struct.pack(
+            self.HEADER_FORMAT,
+            self.SUITE_ID,
+            salt,
+            nonce,
+            self.chunk_size,
+            length,
+            bytes(self.TAG_SIZE),
+        )
+        hh = SHA256HMAC(dk).build(header[: -self.TAG_SIZE])
+        return header[: -self.TAG_SIZE] + hh
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        """
+        Decrypts a bundle using the provided key. The PBKDF2 salt is taken from
+        the bundle. If the provided key and salt fail to verify the header or
+        any chunk HMAC DecryptionError is raised.
+        """
+        return self.open(BytesPayload(ciphertext)).read()
+
+    def open(self, ciphertext: Payload, verify: bool = True) -> Payload:
+        """
+        Verifies the crypto header of a bundle and returns a view that
+        verifies and decrypts chunks only as they are read. If the provided
+        key and salt fail to verify the header DecryptionError is raised,
+        failing chunks raise DecryptionError when read. Verification is
+        already this cheap, so it's never skipped.
+        """
+        header = ciphertext.read(0, self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            raise DecryptionError
+        _, salt, nonce, chunk_size, length, hh = struct.unpack(
+            self.HEADER_FORMAT, header
+        )
+        kdf = self._get_kdf()
+        dk = kdf.derive_key(self.key, salt, cached=True)
+        # Authenticating the header also authenticates the chunk index
+        hmac = SHA256HMAC(dk)
+        hmac.update(header[: -self.TAG_SIZE])
+        hmac.verify(hh)
+        kdf.cache_key(dk)
+        if not chunk_size:
+            raise DecryptionError
+        chunks = (length + chunk_size - 1) // chunk_size
+        expected = self.HEADER_SIZE + chunks * self.TAG_SIZE + length
+        if len(ciphertext) != expected:
+            raise DecryptionError
+        return AESv3Payload(
+            ciphertext.slice(self.HEADER_SIZE),
+            dk,
+            nonce,
+            chunk_size,
+            length,
+        )
+
+
+class AESv3Payload(Payload):
+    """
+    Plaintext view over the chunks of an AESv3Suite bundle. Only the chunks
+    overlapping a read are verified and decrypted, and no plaintext from a
+    chunk is released before its HMAC is verified.
+    """
+
+    __slots__ = (
+        "_source",
+        "_dk",
+        "_nonce",
+        "_chunk_size",
+        "_length",
+        "_cipher",
+        "_start",
+        "_end",
+    )
+
+    def __init__(
+        self,
+        source: Payload,
+        dk: DerivedKey,
+        nonce: bytes,
+        chunk_size: int,
+        length: int,
+        start: int = 0,
+        end: int = None,
+    ) -> None:
+        self._source = source
+        self._dk = dk
+        self._nonce = nonce
+        self._chunk_size = chunk_size
+        self._length = length
+        self._cipher = AESCTRCipher(dk, nonce=nonce)
+        self._start = start
+        self._end = length if end is None else end
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def slice(self, start: int = 0, end: int = None) -> "AESv3Payload":
+        start, end = self._bounds(start, end)
+        return AESv3Payload(
+            self._source,
+            self._dk,
+            self._nonce,
+            self._chunk_size,
+            self._length,
+            self._start + start,
+            self._start + end,
+        )
+
+    def _read_chunk_into(
+        self, index: int, scratch: bytearray, out: bytearray
+    ) -> memoryview:
+        """
+        Verifies and decrypts a chunk, reading its ciphertext into scratch and
+        its plaintext into out. Scratch must fit a tagged chunk and out must
+        fit a decrypted chunk.
+        """
+        cs = self._chunk_size
+        tag_size = AESv3Suite.TAG_SIZE
+        pos = index * (cs + tag_size)
+        chunk_len = min(cs, self._length - index * cs)
+        size = tag_size + chunk_len
+        blob = next(
+            self._source.iter_into(scratch, pos, pos + size),
+            memoryview(b""),
+        )
+        if len(blob) < size:
+            # Short read, fall back to gathering the whole chunk
+            blob = memoryview(self._source.read(pos, pos + size))
+        tag, encrypted = blob[:tag_size], blob[tag_size:]
+        last = (index + 1) * cs >= self._length
+        expected = AESv3Suite._chunk_tag(
+            self._dk, self._nonce, index, last, encrypted
+        )
+        if len(encrypted) != chunk_len or not _hmac.compare_digest(
+            tag, expected
+        ):
+            raise DecryptionError
+        decryptor = self._cipher.decryptor_at(index * cs)
+        return memoryview(out)[: decryptor.update_into(encrypted, out)]
+
+    def _iter_plaintext(
+        self, start: int, end: int, out: bytearray
+    ) -> Iterator[memoryview]:
+        # Yields the decrypted part of every chunk overlapping the range
+        start, end = self._bounds(start, end)
+        start, end = self._start + start, self._start + end
+        cs = self._chunk_size
+        scratch = bytearray(AESv3Suite.TAG_SIZE + cs)
+        for index in range(start // cs, (end + cs - 1) // cs):
+            plaintext = self._read_chunk_into(index, scratch, out)
+            lo = max(start - index * cs, 0)
+            hi = min(end - index * cs, len(plaintext))
+            yield plaintext[lo:hi]
+
+    def iter_chunks(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        out = bytearray(self._cipher.buffer_size(self._chunk_size))
+        for plaintext in self._iter_plaintext(start, end, out):
+            for pos in range(0, len(plaintext), chunk_size):
+                yield bytes(plaintext[pos: pos + chunk_size])
+
+    def iter_into(
+        self, buf: bytearray, start: int = 0, end: int = None
+    ) -> Iterator[memoryview]:
+        size = self._cipher.buffer_size(self._chunk_size)
+        if len(buf) >= size:
+            # Whole chunks fit, decrypt straight into the caller's buffer
+            yield from self._iter_plaintext(start, end, buf)
+            return
+        view = memoryview(buf)
+        for plaintext in self._iter_plaintext(start, end, bytearray(size)):
+            for pos in range(0, len(plaintext), len(buf)):
+                piece = plaintext[pos: pos + len(buf)]
+                view[: len(piece)] = piece
+                yield view[: len(piece)]
+
+    def close(self) -> None:
+        self._source.close()
+
+
+class AESv3Encryptor(SuiteEncryptor):
+    """
+    Incremental encryption context for AESv3Suite bundles. A full chunk is
+    held back until more plaintext shows up, so it's known whether it's the
+    last one.
+    """
+
+    __slots__ = (
+        "_suite",
+        "_salt",
+        "_nonce",
+        "_dk",
+        "_cipher",
+        "_ctr",
+        "_pending",
+        "_filled",
+        "_index",
+        "_length",
+        "_header",
+    )
+
+    def __init__(self, suite: AESv3Suite) -> None:
+        self._suite = suite
+        self._salt = os.urandom(suite.SALT_SIZE)
+        self._nonce = os.urandom(suite.BLOCK_SIZE)
+        self._dk = suite._get_kdf().derive_key(suite.key, self._salt)
+        # A single keystream, each chunk sits at its plaintext offset in it
+        self._cipher = AESCTRCipher(self._dk, nonce=self._nonce)
+        self._ctr = self._cipher.encryptor()
+        self._pending = bytearray(suite.chunk_size)
+        self._filled = 0
+        self._index = 0
+        self._length = 0
+        self._header = None
+
+    @property
+    def header_size(self) -> int:
+        return self._suite.HEADER_SIZE
+
+    @property
+    def header(self) -> bytes:
+        return self._header
+
+    def output_size(self, size: int) -> int:
+        cs = self._suite.chunk_size
+        chunks = (self._filled + size) // cs
+        return self._cipher.buffer_size(
+            chunks * (self._suite.TAG_SIZE + cs)
+        )
+
+    def _emit(self, chunk: memoryview, last: bool, out: memoryview) -> int:
+        tag_size = self._suite.TAG_SIZE
+        written = self._ctr.update_into(chunk, out[tag_size:])
+        out[:tag_size] = self._suite._chunk_tag(
+            self._dk,
+            self._nonce,
+            self._index,
+            last,
+            out[tag_size: tag_size + written],
+        )
+        self._index += 1
+        self._length += len(chunk)
+        return tag_size + written
+
+    def update_into(self, plaintext: bytes, buf: bytearray) -> int:
+        cs = self._suite.chunk_size
+        plaintext = memoryview(plaintext)
+        out = memoryview(buf)
+        pos = 0
+        while plaintext:
+            if self._filled == cs:
+                # More plaintext showed up, the held back chunk isn't the last
+                pos += self._emit(memoryview(self._pending), False, out[pos:])
+                self._filled = 0
+            if not self._filled and len(plaintext) > cs:
+                # Encrypt straight from the input when possible
+                pos += self._emit(plaintext[:cs], False, out[pos:])
+                plaintext = plaintext[cs:]
+                continue
+            size = min(cs - self._filled, len(plaintext))
+            self._pending[self._filled: self._filled + size] = (
+                plaintext[:size]
+            )
+            self._filled += size
+            plaintext = plaintext[size:]
+        return pos
+
+    def finalize(self) -> bytes:
+        suite = self._suite
+        buf = bytearray(
+            self._cipher.buffer_size(suite.TAG_SIZE + self._filled)
+        )
+        written = 0
+        if self._filled:
+            written = self._emit(
+                memoryview(self._pending)[: self._filled],
+                True,
+                memoryview(buf),
+            )
+        self._filled = 0
+        self._ctr.finalize()
+        self._header = suite._build_header(
+            self._dk, self._salt, self._nonce, self._length
+        )
+        return bytes(memoryview(buf)[:written])
@@ -0,0 +1,19 @@
+from itoko.crypto.kdf.hkdf import HKDF
+from itoko.crypto.suite.aesv3 import AESv3Suite
+
+
+class AESv3HKDFSuite(AESv3Suite):
+    """
+    Handles chunked encryption and decryption with AES-256-HMAC in CTR mode,
+    with the same layout as AESv3Suite. Keys are derived through HKDF instead
+    of PBKDF2. Only meant for server-generated keys, which already have
+    enough entropy.
+    """
+
+    __slots__ = ()
+
+    SUITE_ID = 5
+    HKDF_INFO = b"itoko chunked AES-256-CTR HMAC-SHA256"
+
+    def _get_kdf(self):
+        return HKDF(self.KEY_LENGTH * 2, info=self.HKDF_INFO)
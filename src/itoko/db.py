@@ -12,3 +12,33 @@ def init_db():
       filename TEXT UNIQUE NOT NULL
     )
     """)
+    # Metadata of every stored file, so it can be looked up without probing
+    # or parsing the file. Filename, MIME type and payload digest are NULL
+    # when encrypted, the digest also when unknown.
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS files (
+      fs_filename TEXT PRIMARY KEY,
+      storage_type INTEGER NOT NULL,
+      size INTEGER NOT NULL,
+      version INTEGER NOT NULL,
+      suite_id INTEGER,
+      is_encrypted INTEGER NOT NULL,
+      filename TEXT,
+      mime_type TEXT,
+      created_at REAL NOT NULL,
+      accessed_at REAL,
+      digest TEXT
+    )
+    """)
+    # Payload digests came later, for strong entity tags
+    columns = {row["name"] for row in db.query("PRAGMA table_info(files)")}
+    if "digest" not in columns:
+        db.execute("ALTER TABLE files ADD COLUMN digest TEXT")
+    # Deduplicated payloads, deleted once no stored file references them
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+      digest TEXT PRIMARY KEY,
+      size INTEGER NOT NULL,
+      refs INTEGER NOT NULL
+    )
+    """)
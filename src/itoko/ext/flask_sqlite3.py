@@ -2,6 +2,7 @@
 Copy-pasted from http://flask.pocoo.org/docs/1.0/extensiondev/
 """
 import sqlite3
+from contextlib import contextmanager
 from flask import current_app, g
 
 __all__ = ["SQLite3"]
@@ -51,3 +52,19 @@ class SQLite3(object):
     def execute(self, query: str, args=()):
         self.connection.execute(query, args)
         self.connection.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements issued through the yielded connection in a single
+        transaction, which holds the database write lock from the start, so
+        concurrent processes can't interleave. Rolled back on exceptions.
+        """
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
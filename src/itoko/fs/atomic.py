@@ -0,0 +1,103 @@
+"""
+Atomic creation of files. A file is written under a hidden name and only
+linked under its final name once complete, so readers never see it half
+written, and linking fails instead of replacing an existing file unless told
+to.
+"""
+import os
+from enum import Enum
+from typing import BinaryIO, Optional
+
+__all__ = ["FSyncPolicy", "PARTIAL_PREFIX", "PartialFile"]
+
+# Files being written are hidden until complete
+PARTIAL_PREFIX = "."
+PARTIAL_SUFFIX = ".part"
+
+
+class FSyncPolicy(Enum):
+    # Leave flushing to the OS, a crash may lose or truncate recent files
+    NONE = "none"
+    # Flush file contents before the file shows up under its name
+    FILE = "file"
+    # Flush the folder too, so the name itself survives a crash
+    FULL = "full"
+
+
+class PartialFile:
+    """
+    File being written under a hidden name. The hidden name is always removed
+    on exit, whether the file was published or not.
+    """
+
+    __slots__ = ("partial_path", "fsync", "fp")
+
+    partial_path: str
+    fsync: FSyncPolicy
+    fp: Optional[BinaryIO]
+
+    def __init__(self, folder: str, name: str, fsync: FSyncPolicy) -> None:
+        """
+        :param folder: Folder to write the file in, which must be on the same
+                       file system as the folder it's published to.
+        :param name: Name hint, the hidden name is made unique.
+        :param fsync: What to flush to disk when publishing the file.
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.partial_path = os.path.join(
+            folder,
+            "{}{}.{}{}".format(
+                PARTIAL_PREFIX, name, os.urandom(4).hex(), PARTIAL_SUFFIX
+            ),
+        )
+        self.fsync = fsync
+        fd = os.open(
+            self.partial_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666
+        )
+        self.fp = os.fdopen(fd, "wb+")
+
+    def publish(self, path: str, replace: bool = False) -> None:
+        """
+        Flushes the file as told by the fsync policy and links it under its
+        final name.
+
+        :param path: Final path of the file.
+        :param replace: Whether to rename the file over an existing one at the
+                        path instead, readers holding the old file open keep
+                        reading it.
+        :raises FileExistsError: If a file already exists at the path and
+                                 isn't to be replaced.
+        """
+        if self.fsync != FSyncPolicy.NONE:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+        self.fp.close()
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        if replace:
+            os.replace(self.partial_path, path)
+        else:
+            # Unlike rename(), link() refuses to replace an existing file
+            os.link(self.partial_path, path)
+        if self.fsync == FSyncPolicy.FULL:
+            dir_fd = os.open(folder, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def discard(self) -> None:
+        """
+        Removes the hidden name, leaving the published file if any.
+        """
+        self.fp.close()
+        try:
+            os.unlink(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> "PartialFile":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.discard()
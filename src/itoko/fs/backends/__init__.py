@@ -0,0 +1,163 @@
+"""
+Storage backends keep the stored files of both storage types as opaque
+objects named after their filename in-server. Formats, deduplication,
+compression and the index are handled on top of them by FSStorage, so a
+backend only has to store, list and read back bytes.
+
+Backends are picked with ITOKO_STORAGE.backend and built once per app from
+the ITOKO_STORAGE configuration with from_config().
+"""
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import ContextManager, BinaryIO, Iterator, NamedTuple
+
+from itoko.fs.payload import Payload
+
+__all__ = [
+    "FSStorageType",
+    "ObjectStat",
+    "ObjectEntry",
+    "StorageBackend",
+]
+
+
+class FSStorageType(Enum):
+    TEMPORARY_STORAGE = 1
+    PERMANENT_STORAGE = 2
+
+
+class ObjectStat(NamedTuple):
+    """
+    Status of a stored object, named after the os.stat_result fields.
+    """
+
+    st_size: int
+    st_mtime_ns: int
+
+    @property
+    def st_mtime(self) -> float:
+        return self.st_mtime_ns / 1e9
+
+
+class ObjectEntry:
+    """
+    Listed stored object, shaped like an os.DirEntry.
+    """
+
+    __slots__ = ("name", "_stat")
+
+    name: str
+
+    def __init__(self, name: str, stat: ObjectStat) -> None:
+        self.name = name
+        self._stat = stat
+
+    def stat(self) -> ObjectStat:
+        return self._stat
+
+
+class StorageBackend(ABC):
+    """
+    Stores the files of both storage types. Stored files are written once and
+    never modified, only removed.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    @abstractmethod
+    def from_config(cls, config: dict) -> "StorageBackend":
+        """
+        Builds the backend from the ITOKO_STORAGE configuration.
+
+        :param config: ITOKO_STORAGE configuration.
+        :return: Storage backend.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stat(self, st: FSStorageType, filename: str) -> ObjectStat:
+        """
+        Returns the status of a stored file.
+
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :return: Status of the stored file.
+        :raises FileNotFoundError: If the file isn't stored.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def open(self, st: FSStorageType, filename: str) -> Payload:
+        """
+        Opens a stored file as a payload view, which reads only the byte
+        ranges asked for. The caller must close it.
+
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :return: Payload view over the stored file.
+        :raises FileNotFoundError: If the file isn't stored.
+        """
+        raise NotImplementedError
+
+    def map(self, st: FSStorageType, filename: str) -> memoryview:
+        """
+        Loads a whole stored file. Backends able to map files into memory
+        should override this, the default implementation reads the file.
+
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :return: View over the stored file.
+        :raises FileNotFoundError: If the file isn't stored.
+        """
+        payload = self.open(st, filename)
+        try:
+            return memoryview(payload.read())
+        finally:
+            payload.close()
+
+    @abstractmethod
+    def create(
+        self, st: FSStorageType, filename: str
+    ) -> ContextManager[BinaryIO]:
+        """
+        Creates a stored file atomically. The yielded file object is seekable
+        at least over what was written first, as formats patch their headers
+        once the payload is written. The file only shows up once the context
+        exits without exceptions, and is discarded otherwise.
+
+        :param st: Storage type to store the file in.
+        :param filename: Filename to store the file as in-server.
+        :return: Context manager yielding a writable file object.
+        :raises FileExistsError: If a file is already stored by that name.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, st: FSStorageType, filename: str) -> None:
+        """
+        Deletes a stored file.
+
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :raises FileNotFoundError: If the file isn't stored.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan(self, st: FSStorageType) -> Iterator[ObjectEntry]:
+        """
+        Lists the stored files of a storage type, in no particular order.
+
+        :param st: Storage type to list.
+        :return: Entries with the name and a stat() method of every file.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_shared(self) -> bool:
+        """
+        Returns whether both storage types are stored in the same place, so
+        listing either lists the files of both.
+        """
+        raise NotImplementedError
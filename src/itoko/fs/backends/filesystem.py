@@ -0,0 +1,245 @@
+import hashlib
+import mmap
+import os
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterator, Tuple
+
+from itoko.fs.atomic import FSyncPolicy, PARTIAL_PREFIX, PartialFile
+from itoko.fs.backends import FSStorageType, ObjectStat, StorageBackend
+from itoko.fs.payload import FilePayload
+
+__all__ = ["FilesystemBackend"]
+
+
+class FilesystemBackend(StorageBackend):
+    """
+    Stores files in a local folder per storage type.
+
+    Files may be spread over nested shard folders, named after the leading
+    bytes of a hash of their filename, so no folder holds more than a slice
+    of them. Files stored before sharding was enabled are still found at the
+    top of the storage folders.
+    """
+
+    __slots__ = (
+        "temporary_folder",
+        "permanent_folder",
+        "shard_depth",
+        "fsync",
+    )
+
+    temporary_folder: str
+    permanent_folder: str
+    shard_depth: int
+    fsync: FSyncPolicy
+
+    def __init__(
+        self,
+        temporary_folder: str,
+        permanent_folder: str,
+        shard_depth: int = 0,
+        fsync: FSyncPolicy = FSyncPolicy.FILE,
+    ) -> None:
+        """
+        :param shard_depth: Levels of shard folders with 256 shards each, 0
+                            stores every file flat in the storage folders.
+        :param fsync: What to flush to disk before a new file is considered
+                      stored.
+        """
+        self.temporary_folder = temporary_folder
+        self.permanent_folder = permanent_folder
+        self.shard_depth = shard_depth
+        self.fsync = fsync
+
+    @classmethod
+    def from_config(cls, config: dict) -> "FilesystemBackend":
+        # Make the storage folders if they don't exist
+        os.makedirs(config["temporary_folder"], exist_ok=True)
+        os.makedirs(config["permanent_folder"], exist_ok=True)
+        return cls(
+            temporary_folder=config["temporary_folder"],
+            permanent_folder=config["permanent_folder"],
+            shard_depth=config["shard_depth"],
+            fsync=FSyncPolicy(config["fsync"]),
+        )
+
+    def _folder(self, st: FSStorageType) -> str:
+        if st == FSStorageType.PERMANENT_STORAGE:
+            return self.permanent_folder
+        elif st == FSStorageType.TEMPORARY_STORAGE:
+            return self.temporary_folder
+        else:
+            raise TypeError("Invalid storage type provided.")
+
+    def _flat_path(self, st: FSStorageType, filename: str) -> str:
+        return os.path.join(self._folder(st), filename)
+
+    def _path(self, st: FSStorageType, filename: str) -> str:
+        """
+        Returns the path new files are stored at.
+        """
+        digest = hashlib.sha256(filename.encode("utf-8")).hexdigest()
+        shards = [digest[2 * i: 2 * i + 2] for i in range(self.shard_depth)]
+        return os.path.join(self._folder(st), *shards, filename)
+
+    def _paths(self, st: FSStorageType, filename: str) -> Tuple[str, ...]:
+        path = self._path(st, filename)
+        flat_path = self._flat_path(st, filename)
+        if path == flat_path:
+            return (path,)
+        # Flat files may be moved into their shard while being looked up, so
+        # the shard is tried again last
+        return path, flat_path, path
+
+    def _at_path(
+        self, st: FSStorageType, filename: str, func: Callable[[str], object]
+    ):
+        """
+        Calls a function over the path of a stored file, trying every layout
+        it may be stored in. FileNotFoundError is raised if none has it.
+        """
+        for path in self._paths(st, filename):
+            try:
+                return func(path)
+            except (FileNotFoundError, NotADirectoryError):
+                # Missing shard folders count as missing files
+                continue
+        raise FileNotFoundError(self._path(st, filename))
+
+    @staticmethod
+    def _is_shard(name: str) -> bool:
+        return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+    def scan(
+        self, st: FSStorageType, sharded: bool = True
+    ) -> Iterator[os.DirEntry]:
+        """
+        Lists the files in a storage folder, in no particular order.
+
+        :param st: Storage type to list.
+        :param sharded: Whether to list the files in shard folders too, or
+                        only the ones stored flat.
+        :return: Directory entries of the stored files.
+        """
+        depth = self.shard_depth if sharded else 0
+        return self._scan(self._folder(st), depth, top=True)
+
+    def _scan(
+        self, path: str, depth: int, top: bool = False
+    ) -> Iterator[os.DirEntry]:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith(PARTIAL_PREFIX):
+                    continue
+                elif entry.is_file(follow_symlinks=False):
+                    # Only flat files and files in the last level of shards
+                    if top or not depth:
+                        yield entry
+                elif (
+                    depth
+                    and self._is_shard(entry.name)
+                    and entry.is_dir(follow_symlinks=False)
+                ):
+                    yield from self._scan(entry.path, depth - 1)
+
+    def is_shared(self) -> bool:
+        return os.path.samefile(self.temporary_folder, self.permanent_folder)
+
+    def stat(self, st: FSStorageType, filename: str) -> ObjectStat:
+        stat = self._at_path(st, filename, os.stat)
+        return ObjectStat(stat.st_size, stat.st_mtime_ns)
+
+    def open(self, st: FSStorageType, filename: str) -> FilePayload:
+        return FilePayload(self._at_path(st, filename, self._open))
+
+    def map(self, st: FSStorageType, filename: str) -> memoryview:
+        # Map the file instead of reading it, the readers slice memoryviews
+        # over the mapping so the payload is never copied
+        with self._at_path(st, filename, self._open) as f:
+            if not os.fstat(f.fileno()).st_size:
+                return memoryview(b"")
+            return memoryview(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+
+    @contextmanager
+    def create(self, st: FSStorageType, filename: str) -> Iterator[BinaryIO]:
+        """
+        Creates a stored file atomically. The file is written under a hidden
+        name next to its final path, flushed as told by the fsync policy and
+        only then linked under its name, so readers never see it incomplete.
+        Linking fails if the name is taken, so files are never overwritten.
+
+        :raises FileExistsError: If a file is already stored by that name.
+        """
+        path = self._path(st, filename)
+        with PartialFile(
+            os.path.dirname(path), filename, self.fsync
+        ) as partial:
+            yield partial.fp
+            # Files stored before sharding was enabled hold names too
+            flat_path = self._flat_path(st, filename)
+            if flat_path != path and os.path.lexists(flat_path):
+                raise FileExistsError(flat_path)
+            partial.publish(path)
+
+    @contextmanager
+    def replace(self, st: FSStorageType, filename: str) -> Iterator[BinaryIO]:
+        """
+        Rewrites a stored file atomically. The new file is written under a
+        hidden name next to the stored one and renamed over it, so readers
+        see either file whole, and those holding the old one open keep
+        reading it. The modification time is carried over, expiry goes by
+        it.
+
+        :raises FileNotFoundError: If the file isn't stored, or was removed
+                                   while being rewritten.
+        """
+        path, stat = self._at_path(
+            st, filename, lambda path: (path, os.stat(path))
+        )
+        with PartialFile(
+            os.path.dirname(path), filename, self.fsync
+        ) as partial:
+            yield partial.fp
+            partial.fp.flush()
+            os.utime(
+                partial.fp.fileno(), ns=(stat.st_atime_ns, stat.st_mtime_ns)
+            )
+            # Don't bring back a file swept or moved in the meantime, the
+            # window left is a single stat() wide
+            if os.stat(path).st_ino != stat.st_ino:
+                raise FileNotFoundError(path)
+            partial.publish(path, replace=True)
+
+    def move_to_shard(self, st: FSStorageType, filename: str) -> bool:
+        """
+        Moves a file stored flat into its shard folder. The move is a single
+        rename and lookups fall back to the flat layout, so files can be moved
+        while being served.
+
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :return: Boolean indicating whether the file was moved, which it
+                 isn't if sharding is disabled.
+        :raises FileNotFoundError: If the file isn't stored flat.
+        :raises FileExistsError: If the shard already holds a file by the same
+                                 name.
+        """
+        path = self._path(st, filename)
+        flat_path = self._flat_path(st, filename)
+        if path == flat_path:
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # rename() would silently replace it
+        if os.path.lexists(path):
+            raise FileExistsError(path)
+        os.rename(flat_path, path)
+        return True
+
+    def remove(self, st: FSStorageType, filename: str) -> None:
+        self._at_path(st, filename, os.unlink)
+
+    @staticmethod
+    def _open(path: str) -> BinaryIO:
+        return open(path, "rb")
@@ -0,0 +1,79 @@
+import io
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, Tuple
+
+from itoko.fs.backends import (
+    FSStorageType,
+    ObjectEntry,
+    ObjectStat,
+    StorageBackend,
+)
+from itoko.fs.payload import BytesPayload
+
+__all__ = ["MemoryBackend"]
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Stores files in memory, for tests. Files are lost with the process and
+    aren't shared between processes.
+    """
+
+    __slots__ = ("_objects", "_lock")
+
+    _objects: Dict[FSStorageType, Dict[str, Tuple[bytes, int]]]
+
+    def __init__(self) -> None:
+        self._objects = {st: {} for st in FSStorageType}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "MemoryBackend":
+        return cls()
+
+    def _get(self, st: FSStorageType, filename: str) -> Tuple[bytes, int]:
+        try:
+            return self._objects[st][filename]
+        except KeyError:
+            raise FileNotFoundError(filename) from None
+
+    def stat(self, st: FSStorageType, filename: str) -> ObjectStat:
+        data, mtime_ns = self._get(st, filename)
+        return ObjectStat(len(data), mtime_ns)
+
+    def open(self, st: FSStorageType, filename: str) -> BytesPayload:
+        data, _ = self._get(st, filename)
+        return BytesPayload(data)
+
+    def map(self, st: FSStorageType, filename: str) -> memoryview:
+        data, _ = self._get(st, filename)
+        return memoryview(data)
+
+    @contextmanager
+    def create(self, st: FSStorageType, filename: str) -> Iterator[BinaryIO]:
+        with io.BytesIO() as f:
+            yield f
+            with self._lock:
+                if filename in self._objects[st]:
+                    raise FileExistsError(filename)
+                self._objects[st][filename] = (
+                    f.getvalue(),
+                    int(time.time() * 10 ** 9),
+                )
+
+    def remove(self, st: FSStorageType, filename: str) -> None:
+        with self._lock:
+            self._get(st, filename)
+            del self._objects[st][filename]
+
+    def scan(self, st: FSStorageType) -> Iterator[ObjectEntry]:
+        # Files may come and go while being listed
+        with self._lock:
+            objects = list(self._objects[st].items())
+        for filename, (data, mtime_ns) in objects:
+            yield ObjectEntry(filename, ObjectStat(len(data), mtime_ns))
+
+    def is_shared(self) -> bool:
+        return False
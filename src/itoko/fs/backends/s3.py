@@ -0,0 +1,445 @@
+"""
+Storage backend for S3 and S3-compatible object stores, so nodes can store
+files without sharing a disk. Requires boto3, see the s3 extra.
+
+Uploads are streamed in multipart uploads, reads are ranged GETs, so neither
+ever holds a whole file. Point endpoint_url at a local stand-in server, such
+as MinIO or moto, to try it out without AWS.
+"""
+import io
+import os
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from itoko.fs.backends import (
+    FSStorageType,
+    ObjectEntry,
+    ObjectStat,
+    StorageBackend,
+)
+from itoko.fs.payload import (
+    DEFAULT_CHUNK_SIZE,
+    PREFETCH_SIZE,
+    BytesPayload,
+    Payload,
+)
+
+__all__ = ["S3Backend", "S3Payload"]
+
+# Parts but the last must be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+NOT_FOUND_CODES = ("404", "NoSuchKey", "NotFound")
+EXISTS_CODES = ("412", "PreconditionFailed")
+# Empty objects have no byte range to get
+EMPTY_CODES = ("416", "InvalidRange")
+
+
+def _error_code(e: ClientError) -> str:
+    return e.response.get("Error", {}).get("Code", "")
+
+
+class S3Payload(Payload):
+    """
+    Payload stored in a byte range of an object. Every range is fetched with
+    a single ranged GET, streamed in chunks.
+    """
+
+    __slots__ = ("_client", "_bucket", "_key", "_offset", "_length", "_head")
+
+    _bucket: str
+    _key: str
+    _offset: int
+    _length: int
+    _head: bytes
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        key: str,
+        offset: int,
+        length: int,
+        head: bytes = b"",
+    ) -> None:
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._offset = offset
+        self._length = length
+        self._head = head
+
+    def __len__(self) -> int:
+        return self._length
+
+    def slice(self, start: int = 0, end: int = None) -> "S3Payload":
+        start, end = self._bounds(start, end)
+        return S3Payload(
+            self._client,
+            self._bucket,
+            self._key,
+            self._offset + start,
+            end - start,
+            self._head[start:end],
+        )
+
+    def prefetch(self, size: int = PREFETCH_SIZE) -> "S3Payload":
+        if len(self._head) >= min(size, self._length):
+            return self
+        return S3Payload(
+            self._client,
+            self._bucket,
+            self._key,
+            self._offset,
+            self._length,
+            self.read(0, size),
+        )
+
+    def iter_chunks(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        start, end = self._bounds(start, end)
+        if start == end:
+            return
+        elif end <= len(self._head):
+            # Served from the prefetched bytes
+            yield from BytesPayload(self._head).iter_chunks(
+                start, end, chunk_size
+            )
+            return
+        try:
+            response = self._client.get_object(
+                Bucket=self._bucket,
+                Key=self._key,
+                Range="bytes={}-{}".format(
+                    self._offset + start, self._offset + end - 1
+                ),
+            )
+        except ClientError as e:
+            if _error_code(e) in NOT_FOUND_CODES:
+                raise FileNotFoundError(self._key) from e
+            raise
+        body = response["Body"]
+        try:
+            read = 0
+            for chunk in body.iter_chunks(chunk_size):
+                read += len(chunk)
+                yield chunk
+        finally:
+            body.close()
+        if read != end - start:
+            raise EOFError("Object truncated while reading.")
+
+
+class MultipartWriter:
+    """
+    Write-only file object uploading an object as it's written. Every part
+    is sent once full, but the first one, which is held back until the end
+    so the headers formats patch once the payload is written can still be
+    seeked to. Objects fitting in a single part are sent in a single PUT.
+    """
+
+    __slots__ = (
+        "_client",
+        "_bucket",
+        "_key",
+        "_part_size",
+        "_head",
+        "_tail",
+        "_position",
+        "_size",
+        "_upload_id",
+        "_parts",
+    )
+
+    _upload_id: Optional[str]
+    _parts: List[dict]
+
+    def __init__(self, client, bucket: str, key: str, part_size: int):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = part_size
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._position = 0
+        self._size = 0
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset != self._size and not 0 <= offset <= len(self._head):
+            raise io.UnsupportedOperation("Can only seek in the first part.")
+        self._position = offset
+        return offset
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        written = len(data)
+        if self._position < self._size:
+            end = self._position + written
+            if end > len(self._head):
+                raise io.UnsupportedOperation(
+                    "Can only overwrite the first part."
+                )
+            self._head[self._position: end] = data
+            self._position = end
+            return written
+        if len(self._head) < self._part_size:
+            room = self._part_size - len(self._head)
+            self._head += data[:room]
+            data = data[room:]
+        self._tail += data
+        while len(self._tail) >= self._part_size:
+            self._upload_part(self._tail[: self._part_size])
+            del self._tail[: self._part_size]
+        self._size += written
+        self._position = self._size
+        return written
+
+    def flush(self) -> None:
+        pass
+
+    def _upload_part(self, data: bytearray) -> None:
+        if self._upload_id is None:
+            self._upload_id = self._client.create_multipart_upload(
+                Bucket=self._bucket, Key=self._key
+            )["UploadId"]
+        # Part 1 is the head, sent last
+        number = len(self._parts) + 2
+        response = self._client.upload_part(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            PartNumber=number,
+            Body=bytes(data),
+        )
+        self._parts.append(dict(PartNumber=number, ETag=response["ETag"]))
+
+    def complete(self) -> None:
+        """
+        Publishes the object, unless one already exists by its name.
+
+        :raises FileExistsError: If an object already exists by the name.
+        """
+        try:
+            if self._upload_id is None:
+                self._client.put_object(
+                    Bucket=self._bucket,
+                    Key=self._key,
+                    Body=bytes(self._head),
+                    IfNoneMatch="*",
+                )
+                return
+            if self._tail:
+                self._upload_part(self._tail)
+            response = self._client.upload_part(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                PartNumber=1,
+                Body=bytes(self._head),
+            )
+            parts = [dict(PartNumber=1, ETag=response["ETag"])]
+            self._client.complete_multipart_upload(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                MultipartUpload=dict(Parts=parts + self._parts),
+                IfNoneMatch="*",
+            )
+        except ClientError as e:
+            if _error_code(e) in EXISTS_CODES:
+                raise FileExistsError(self._key) from e
+            raise
+
+    def abort(self) -> None:
+        """
+        Drops the parts uploaded so far.
+        """
+        if self._upload_id is not None:
+            self._client.abort_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id
+            )
+
+
+class S3Backend(StorageBackend):
+    """
+    Stores files as objects in a bucket, under a key prefix per storage type.
+    Objects are only created if missing, on stores supporting conditional
+    writes.
+    """
+
+    __slots__ = (
+        "bucket",
+        "temporary_prefix",
+        "permanent_prefix",
+        "part_size",
+        "client_options",
+        "_client",
+        "_pid",
+        "_lock",
+    )
+
+    bucket: str
+    temporary_prefix: str
+    permanent_prefix: str
+    part_size: int
+    client_options: dict
+
+    def __init__(
+        self,
+        bucket: str,
+        temporary_prefix: str = "temporary/",
+        permanent_prefix: str = "permanent/",
+        part_size: int = DEFAULT_PART_SIZE,
+        **client_options
+    ) -> None:
+        """
+        :param bucket: Bucket to store files in.
+        :param temporary_prefix: Key prefix of temporary files.
+        :param permanent_prefix: Key prefix of permanent files.
+        :param part_size: Size of the parts of multipart uploads, which are
+                          held in memory while being uploaded.
+        :param client_options: Options for the boto3 S3 client, such as
+                               endpoint_url or region_name.
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(
+                "Parts must be at least {} bytes.".format(MIN_PART_SIZE)
+            )
+        self.bucket = bucket
+        self.temporary_prefix = temporary_prefix
+        self.permanent_prefix = permanent_prefix
+        self.part_size = part_size
+        self.client_options = client_options
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "S3Backend":
+        return cls(**config["s3"])
+
+    @property
+    def client(self):
+        """
+        Returns the S3 client of the current process. Clients aren't shared
+        with forked processes, which would share their connections too.
+        """
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = boto3.session.Session().client(
+                    "s3", **self.client_options
+                )
+                self._pid = os.getpid()
+            return self._client
+
+    def _key(self, st: FSStorageType, filename: str) -> str:
+        if st == FSStorageType.PERMANENT_STORAGE:
+            return self.permanent_prefix + filename
+        elif st == FSStorageType.TEMPORARY_STORAGE:
+            return self.temporary_prefix + filename
+        else:
+            raise TypeError("Invalid storage type provided.")
+
+    def stat(self, st: FSStorageType, filename: str) -> ObjectStat:
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=self._key(st, filename)
+            )
+        except ClientError as e:
+            if _error_code(e) in NOT_FOUND_CODES:
+                raise FileNotFoundError(self._key(st, filename)) from e
+            raise
+        return ObjectStat(
+            response["ContentLength"],
+            int(response["LastModified"].timestamp()) * 10 ** 9,
+        )
+
+    def open(self, st: FSStorageType, filename: str) -> S3Payload:
+        # A single ranged GET fetches the headers and tells the size
+        key = self._key(st, filename)
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                Range="bytes=0-{}".format(PREFETCH_SIZE - 1),
+            )
+        except ClientError as e:
+            if _error_code(e) in NOT_FOUND_CODES:
+                raise FileNotFoundError(key) from e
+            elif _error_code(e) in EMPTY_CODES:
+                return S3Payload(self.client, self.bucket, key, 0, 0)
+            raise
+        body = response["Body"]
+        try:
+            head = body.read(PREFETCH_SIZE)
+        finally:
+            body.close()
+        content_range = response.get("ContentRange")
+        if content_range:
+            size = int(content_range.rsplit("/", 1)[1])
+        else:
+            # Ranges aren't supported, the whole object was sent
+            size = response["ContentLength"]
+        return S3Payload(self.client, self.bucket, key, 0, size, head)
+
+    @contextmanager
+    def create(self, st: FSStorageType, filename: str) -> Iterator[BinaryIO]:
+        writer = MultipartWriter(
+            self.client, self.bucket, self._key(st, filename), self.part_size
+        )
+        try:
+            yield writer
+            writer.complete()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def remove(self, st: FSStorageType, filename: str) -> None:
+        # Deleting missing objects succeeds, tell the caller anyway
+        self.stat(st, filename)
+        self.client.delete_object(
+            Bucket=self.bucket, Key=self._key(st, filename)
+        )
+
+    def scan(self, st: FSStorageType) -> Iterator[ObjectEntry]:
+        prefix = self._key(st, "")
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", ()):
+                yield ObjectEntry(
+                    obj["Key"][len(prefix):],
+                    ObjectStat(
+                        obj["Size"],
+                        int(obj["LastModified"].timestamp()) * 10 ** 9,
+                    ),
+                )
+
+    def is_shared(self) -> bool:
+        # Listing a prefix lists every prefix it starts
+        return self.temporary_prefix.startswith(
+            self.permanent_prefix
+        ) or self.permanent_prefix.startswith(self.temporary_prefix)
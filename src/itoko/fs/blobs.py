@@ -0,0 +1,133 @@
+"""
+Content-addressed store for unencrypted payloads. Identical payloads are
+stored once, as a blob named after their SHA-256, and stored files only hold
+a reference to it. Blobs are reference counted in the database, and deleted
+along with their last reference.
+
+Reference counts are only updated in transactions holding the database
+write lock, and blobs are created and deleted within those transactions, so
+a blob can't be deleted while another process is taking a reference to it.
+"""
+import hashlib
+import mmap
+import os
+from typing import BinaryIO
+
+from itoko.fs.atomic import FSyncPolicy, PartialFile
+from itoko.fs.payload import DEFAULT_CHUNK_SIZE, FilePayload, iter_stream
+
+__all__ = ["BlobStore"]
+
+
+class BlobStore:
+    """
+    Reads and writes blobs in a folder, sharded in two levels of 256 folders.
+    """
+
+    __slots__ = ("folder", "db", "fsync")
+
+    folder: str
+    fsync: FSyncPolicy
+
+    def __init__(
+        self, folder: str, db, fsync: FSyncPolicy = FSyncPolicy.FILE
+    ) -> None:
+        """
+        :param folder: Folder to store blobs in.
+        :param db: Database connector, as in itoko.db.
+        :param fsync: What to flush to disk before a blob is stored.
+        """
+        self.folder = folder
+        self.db = db
+        self.fsync = fsync
+
+    def path(self, digest: str) -> str:
+        """
+        Returns the path of a blob.
+
+        :param digest: SHA-256 hex digest of the blob.
+        :return: Path of the blob.
+        """
+        return os.path.join(self.folder, digest[:2], digest[2:4], digest)
+
+    def open(self, digest: str) -> FilePayload:
+        """
+        Opens a blob as a payload view, which the caller must close.
+
+        :param digest: SHA-256 hex digest of the blob.
+        :return: Payload view over the blob.
+        """
+        return FilePayload(open(self.path(digest), "rb"))
+
+    def map(self, digest: str) -> memoryview:
+        """
+        Maps a blob into memory.
+
+        :param digest: SHA-256 hex digest of the blob.
+        :return: View over the mapped blob.
+        """
+        with open(self.path(digest), "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return memoryview(b"")
+            return memoryview(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+
+    def put(
+        self, stream: BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> str:
+        """
+        Stores the contents of a stream as a blob, or takes another reference
+        to the blob already holding them.
+
+        :param stream: Readable file object with the payload.
+        :param chunk_size: Amount of bytes to process at once.
+        :return: SHA-256 hex digest of the blob.
+        """
+        h = hashlib.sha256()
+        size = 0
+        # The digest is only known at the end, write aside meanwhile
+        with PartialFile(self.folder, "blob", self.fsync) as partial:
+            for chunk in iter_stream(stream, bytearray(chunk_size)):
+                h.update(chunk)
+                partial.fp.write(chunk)
+                size += len(chunk)
+            digest = h.hexdigest()
+            with self.db.transaction() as connection:
+                updated = connection.execute(
+                    "UPDATE blobs SET refs = refs + 1 WHERE digest = ?",
+                    (digest,),
+                ).rowcount
+                if not updated:
+                    try:
+                        partial.publish(self.path(digest))
+                    except FileExistsError:
+                        # Left behind by a crash, same contents by its name
+                        pass
+                    connection.execute(
+                        "INSERT INTO blobs (digest, size, refs) "
+                        "VALUES (?, ?, 1)",
+                        (digest, size),
+                    )
+        return digest
+
+    def release(self, digest: str) -> None:
+        """
+        Drops a reference to a blob, deleting it if it was the last one.
+
+        :param digest: SHA-256 hex digest of the blob.
+        """
+        with self.db.transaction() as connection:
+            connection.execute(
+                "UPDATE blobs SET refs = refs - 1 WHERE digest = ?",
+                (digest,),
+            )
+            deleted = connection.execute(
+                "DELETE FROM blobs WHERE digest = ? AND refs <= 0",
+                (digest,),
+            ).rowcount
+            if deleted:
+                try:
+                    os.unlink(self.path(digest))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,434 @@
+"""
+Cache of small, frequently downloaded unencrypted files, shared by every
+worker process of a node.
+
+Cached files are copied into a folder, which should be on a tmpfs such as
+/dev/shm, as ready to serve v2 files with the status of the stored file in
+front. Workers open them from there instead of the storage backend, so the
+page cache holds a single copy shared by all of them, v1 files aren't
+sniffed again and remote backends aren't asked anything.
+
+A file is only cached once it's been missed a few times, counted in a
+frequency sketch shared through a state file in the folder, so files served
+once don't push popular ones out. The state file also accounts for the bytes
+cached, the folder is only scanned once over budget, evicting the least
+recently served files in a batch down to a low watermark.
+
+Encrypted files are never cached, their plaintext must not be left around.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+from itoko.fs.atomic import FSyncPolicy, PARTIAL_PREFIX, PartialFile
+from itoko.fs.backends import ObjectStat
+from itoko.fs.format import FormatFile
+from itoko.fs.format.v2 import ItokoV2FormatFile
+from itoko.fs.payload import FilePayload
+
+__all__ = ["HotFileCache", "hot_file_cache"]
+
+"""
+typedef struct header {
+    char magic[4];
+    uint64_t st_size;
+    uint64_t st_mtime_ns;
+} header;
+"""
+HEADER_FORMAT = "!4sQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAGIC = b"ITKC"
+
+"""
+typedef struct state {
+    uint64_t size;
+    uint64_t additions;
+    uint8_t counters[SKETCH_SIZE];
+} state;
+"""
+STATE_FIELD_FORMAT = "!Q"
+SIZE_OFFSET = 0
+ADDITIONS_OFFSET = struct.calcsize(STATE_FIELD_FORMAT)
+STATE_HEADER_SIZE = 2 * ADDITIONS_OFFSET
+# Counters of the sketch, each miss increments one in each of two rows
+SKETCH_SIZE = 65536
+SKETCH_DEPTH = 2
+# Counters are halved every so many misses, so past popularity fades and
+# few enough counters are set for unrelated names to rarely share all theirs
+SKETCH_SAMPLE = SKETCH_SIZE // 2
+AGING_MASK = int.from_bytes(b"\x7f" * SKETCH_SIZE, "big")
+STATE_SIZE = STATE_HEADER_SIZE + SKETCH_SIZE
+
+LOCK_NAME = PARTIAL_PREFIX + "lock"
+STATE_NAME = PARTIAL_PREFIX + "state"
+
+# Share of the budget left taken up after an eviction batch
+LOW_WATERMARK = 0.75
+# Cached files served within that many nanoseconds of their last touch keep
+# their modification time, sparing an inode update on most hits
+TOUCH_INTERVAL_NS = 10 * 10 ** 9
+
+
+class HotFileCache:
+    """
+    Byte-budgeted cache of served files, kept as files in a folder shared by
+    the worker processes. Counters are per process.
+    """
+
+    __slots__ = (
+        "folder",
+        "max_size",
+        "max_file_size",
+        "admission_misses",
+        "hits",
+        "misses",
+        "fills",
+        "rejections",
+        "evictions",
+        "invalidations",
+        "_state",
+    )
+
+    folder: str
+    max_size: int
+    max_file_size: int
+    admission_misses: int
+
+    def __init__(
+        self,
+        folder: str = "",
+        max_size: int = 0,
+        max_file_size: int = 0,
+        admission_misses: int = 2,
+    ) -> None:
+        """
+        :param folder: Folder to keep cached files in, empty disables the
+                       cache.
+        :param max_size: Bytes all cached files may take up.
+        :param max_file_size: Bytes a single cached file may take up.
+        :param admission_misses: Times a file must be missed before it's
+                                 cached.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.rejections = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._state = None
+        self.configure(folder, max_size, max_file_size, admission_misses)
+
+    def configure(
+        self,
+        folder: str,
+        max_size: int,
+        max_file_size: int,
+        admission_misses: int = 2,
+    ) -> None:
+        """
+        Sets the cache folder and budget, making the folder if needed. Files
+        cached already are kept, and evicted on the next fill if over budget.
+        """
+        if self._state is not None:
+            self._state.close()
+            self._state = None
+        self.folder = folder
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        self.admission_misses = admission_misses
+        if self.enabled:
+            os.makedirs(folder, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.folder) and self.max_size > 0
+
+    def _digest(self, filename: str) -> bytes:
+        # Filenames come from URLs, don't let them pick paths
+        return hashlib.blake2b(
+            filename.encode("utf-8"), digest_size=16
+        ).digest()
+
+    def _path(self, digest: bytes) -> str:
+        return os.path.join(self.folder, digest.hex())
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # Serializes fills across processes, so the budget holds
+        fd = os.open(
+            os.path.join(self.folder, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o666
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _open_state(self) -> mmap.mmap:
+        """
+        Maps the state file, made on first use. Shared mappings stay shared
+        in forked workers, so it's mapped once per configuration.
+        """
+        if self._state is not None:
+            return self._state
+        with self._locked():
+            fd = os.open(
+                os.path.join(self.folder, STATE_NAME),
+                os.O_RDWR | os.O_CREAT,
+                0o666,
+            )
+            try:
+                new = os.fstat(fd).st_size < STATE_SIZE
+                if new:
+                    os.ftruncate(fd, STATE_SIZE)
+                state = mmap.mmap(fd, STATE_SIZE)
+            finally:
+                os.close(fd)
+            if new:
+                # Files may be left from before, account for them
+                self._set_size(state, self._scan_size())
+        self._state = state
+        return state
+
+    def _counters(self, digest: bytes) -> Iterator[int]:
+        for row in range(SKETCH_DEPTH):
+            (index,) = struct.unpack_from("!I", digest, row * 4)
+            yield STATE_HEADER_SIZE + index % SKETCH_SIZE
+
+    def _count_miss(self, digest: bytes) -> int:
+        """
+        Counts a miss of a file in the sketch, only bumping its lowest
+        counters. Updates aren't locked, a lost one only delays admission.
+
+        :return: Estimated misses of the file, this one included.
+        """
+        state = self._open_state()
+        counters = list(self._counters(digest))
+        estimate = min(state[i] for i in counters)
+        if estimate < 255:
+            estimate += 1
+            for i in counters:
+                if state[i] < estimate:
+                    state[i] = estimate
+        (additions,) = struct.unpack_from(
+            STATE_FIELD_FORMAT, state, ADDITIONS_OFFSET
+        )
+        struct.pack_into(
+            STATE_FIELD_FORMAT, state, ADDITIONS_OFFSET, additions + 1
+        )
+        if additions + 1 >= SKETCH_SAMPLE:
+            self._age(state)
+        return estimate
+
+    def _age(self, state: mmap.mmap) -> None:
+        with self._locked():
+            # Another worker may have aged them already
+            (additions,) = struct.unpack_from(
+                STATE_FIELD_FORMAT, state, ADDITIONS_OFFSET
+            )
+            if additions < SKETCH_SAMPLE:
+                return
+            counters = int.from_bytes(state[STATE_HEADER_SIZE:], "big")
+            state[STATE_HEADER_SIZE:] = (
+                (counters >> 1) & AGING_MASK
+            ).to_bytes(SKETCH_SIZE, "big")
+            struct.pack_into(STATE_FIELD_FORMAT, state, ADDITIONS_OFFSET, 0)
+
+    @staticmethod
+    def _size(state: mmap.mmap) -> int:
+        return struct.unpack_from(STATE_FIELD_FORMAT, state, SIZE_OFFSET)[0]
+
+    @staticmethod
+    def _set_size(state: mmap.mmap, size: int) -> None:
+        # Only ever called under the lock
+        struct.pack_into(STATE_FIELD_FORMAT, state, SIZE_OFFSET, max(size, 0))
+
+    def get(self, filename: str) -> Optional[Tuple[FormatFile, ObjectStat]]:
+        """
+        Opens a cached file, marking it as recently served.
+
+        :param filename: Filename of the file stored in-server.
+        :return: Cached file, to be closed by the caller, and the status of
+                 the stored file, or None if not cached.
+        """
+        if not self.enabled:
+            return None
+        try:
+            fp = open(self._path(self._digest(filename)), "rb")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            payload = FilePayload(fp).prefetch()
+            magic, st_size, st_mtime_ns = struct.unpack(
+                HEADER_FORMAT, payload.read(0, HEADER_SIZE)
+            )
+            if magic != MAGIC:
+                raise ValueError("Not a cached file.")
+            file = ItokoV2FormatFile.open(
+                filename, payload.slice(HEADER_SIZE)
+            )
+            # Eviction goes by modification time, atime is often not updated
+            touched = os.fstat(fp.fileno()).st_mtime_ns
+            if touched < time.time_ns() - TOUCH_INTERVAL_NS:
+                os.utime(fp.fileno())
+        except (ValueError, struct.error):
+            fp.close()
+            self.misses += 1
+            return None
+        self.hits += 1
+        return file, ObjectStat(st_size, st_mtime_ns)
+
+    def put(self, filename: str, file: FormatFile, stat: ObjectStat) -> bool:
+        """
+        Caches a file about to be served, if small enough, unencrypted and
+        missed often enough. Compressed files are cached compressed. The
+        file is left open and unread, as far as the caller is concerned.
+
+        :param filename: Filename of the file stored in-server.
+        :param file: Stored file, opened but not decrypted.
+        :param stat: Status of the stored file.
+        :return: Boolean indicating whether the file was cached.
+        """
+        if (
+            not self.enabled
+            or file.is_encrypted
+            or stat.st_size > self.max_file_size
+        ):
+            return False
+        digest = self._digest(filename)
+        if self._count_miss(digest) < self.admission_misses:
+            self.rejections += 1
+            return False
+        view = file.view
+        entry = ItokoV2FormatFile(
+            # Compressed payloads are copied as stored
+            payload=view if file.encoding is not None else view.read(),
+            fs_filename=filename,
+            filename=file.filename,
+            mime_type=file.mime_type,
+        )
+        data = b"".join([
+            struct.pack(HEADER_FORMAT, MAGIC, stat.st_size, stat.st_mtime_ns),
+            entry.file,
+        ])
+        if len(data) > self.max_file_size:
+            return False
+        state = self._open_state()
+        with self._locked():
+            if self._size(state) + len(data) > self.max_size:
+                self._evict(
+                    state, int(self.max_size * LOW_WATERMARK) - len(data)
+                )
+            with PartialFile(
+                self.folder, "cache", FSyncPolicy.NONE
+            ) as partial:
+                partial.fp.write(data)
+                try:
+                    partial.publish(self._path(digest))
+                except FileExistsError:
+                    # Another worker got there first
+                    return False
+            self._set_size(state, self._size(state) + len(data))
+        self.fills += 1
+        return True
+
+    def invalidate(self, filename: str) -> None:
+        """
+        Drops a file from the cache, if cached. Workers serving it already
+        keep reading their copy.
+
+        :param filename: Filename of the file stored in-server.
+        """
+        if not self.enabled:
+            return
+        path = self._path(self._digest(filename))
+        state = self._open_state()
+        with self._locked():
+            try:
+                size = os.stat(path).st_size
+                os.unlink(path)
+            except FileNotFoundError:
+                return
+            self._set_size(state, self._size(state) - size)
+        self.invalidations += 1
+
+    def _scan(self) -> Iterator[os.DirEntry]:
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.startswith(PARTIAL_PREFIX):
+                    yield entry
+
+    def _scan_size(self) -> int:
+        size = 0
+        for entry in self._scan():
+            try:
+                size += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+        return size
+
+    def _evict(self, state: mmap.mmap, size: int) -> None:
+        """
+        Evicts the least recently served files until the cached files take
+        up no more than the given bytes, under the lock. The bytes cached
+        are counted again on the way, fixing any drift.
+        """
+        files = []
+        total = 0
+        for entry in self._scan():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime_ns, entry.path, stat.st_size))
+            total += stat.st_size
+        files.sort()
+        for _, path, file_size in files:
+            if total <= size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            else:
+                self.evictions += 1
+            total -= file_size
+        self._set_size(state, total)
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters of this process, and how much the cache
+        holds across all of them.
+        """
+        files = 0
+        size = 0
+        if self.enabled:
+            for entry in self._scan():
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+                files += 1
+        lookups = self.hits + self.misses
+        return dict(
+            enabled=self.enabled,
+            files=files,
+            size=size,
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / lookups if lookups else 0.0,
+            fills=self.fills,
+            rejections=self.rejections,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+
+hot_file_cache = HotFileCache()
@@ -0,0 +1,143 @@
+"""
+Codecs for payloads compressed at rest. Encodings are named after the HTTP
+content codings producing the same bytes, so stored gzip streams can be sent
+as they are to clients accepting them.
+"""
+import lzma
+import zlib
+from typing import Iterable, Iterator, Optional
+
+__all__ = [
+    "ENCODINGS",
+    "compressor",
+    "decompressor",
+    "iter_decompress",
+    "should_compress",
+]
+
+ENCODINGS = ("gzip", "xz")
+
+# zlib writes gzip streams, with their header and trailer, with these bits
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Compressed payloads must shrink to this fraction of their size to be kept
+MIN_COMPRESSION_RATIO = 0.9
+# Below this size, headers and trailers eat up whatever is saved
+MIN_COMPRESSION_SIZE = 256
+
+# Payloads of these types are compressed already, don't bother trying
+COMPRESSED_MIME_TYPES = frozenset([
+    "application/epub+zip",
+    "application/gzip",
+    "application/java-archive",
+    "application/pdf",
+    "application/vnd.rar",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-gzip",
+    "application/x-lzip",
+    "application/x-lzma",
+    "application/x-rar",
+    "application/x-xz",
+    "application/zip",
+    "application/zstd",
+    "font/woff",
+    "font/woff2",
+])
+COMPRESSED_MIME_PREFIXES = (
+    "application/vnd.openxmlformats-officedocument.",
+    "application/vnd.oasis.opendocument.",
+)
+# Of images, audio and video only these are stored uncompressed
+UNCOMPRESSED_MEDIA_TYPES = frozenset([
+    "audio/wav",
+    "audio/x-wav",
+    "image/bmp",
+    "image/svg+xml",
+    "image/tiff",
+    "image/x-ms-bmp",
+])
+
+
+def compressor(encoding: str):
+    """
+    Makes a streaming compressor for an encoding.
+
+    :param encoding: One of ENCODINGS.
+    :return: Object with compress() and flush() methods.
+    """
+    if encoding == "gzip":
+        return zlib.compressobj(wbits=GZIP_WBITS)
+    elif encoding == "xz":
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+    raise ValueError("Unknown encoding {}.".format(encoding))
+
+
+def decompressor(encoding: str):
+    """
+    Makes a streaming decompressor for an encoding.
+
+    :param encoding: One of ENCODINGS.
+    :return: Object with a decompress(data, max_length) method.
+    """
+    if encoding == "gzip":
+        return zlib.decompressobj(wbits=GZIP_WBITS)
+    elif encoding == "xz":
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    raise ValueError("Unknown encoding {}.".format(encoding))
+
+
+def iter_decompress(
+    encoding: str, chunks: Iterable[bytes], max_length: int
+) -> Iterator[bytes]:
+    """
+    Decompresses a stream given in chunks, never yielding more than
+    max_length bytes at once, however well the stream compressed.
+
+    :param encoding: One of ENCODINGS.
+    :param chunks: Compressed stream.
+    :param max_length: Maximum size of each yielded chunk.
+    """
+    d = decompressor(encoding)
+    for chunk in chunks:
+        if encoding == "gzip":
+            while chunk:
+                data = d.decompress(chunk, max_length)
+                if data:
+                    yield data
+                chunk = d.unconsumed_tail
+        else:
+            if d.eof:
+                return
+            data = d.decompress(chunk, max_length)
+            while data:
+                yield data
+                if d.needs_input or d.eof:
+                    break
+                data = d.decompress(b"", max_length)
+
+
+def should_compress(mime_type: Optional[str], sample: bytes) -> bool:
+    """
+    Tells whether compressing a payload pays off, judging by its MIME type and
+    by how well a sample from its start compresses with a fast setting.
+
+    :param mime_type: MIME type of the payload.
+    :param sample: Start of the payload.
+    :return: Boolean indicating whether to compress the payload.
+    """
+    mime_type = (mime_type or "").lower()
+    major = mime_type.partition("/")[0]
+    if (
+        mime_type in COMPRESSED_MIME_TYPES
+        or mime_type.startswith(COMPRESSED_MIME_PREFIXES)
+        or (
+            major in ("image", "audio", "video")
+            and mime_type not in UNCOMPRESSED_MEDIA_TYPES
+        )
+    ):
+        return False
+    if len(sample) < MIN_COMPRESSION_SIZE:
+        return False
+    compressed = zlib.compress(sample, 1)
+    return len(compressed) <= len(sample) * MIN_COMPRESSION_RATIO
@@ -1,22 +1,45 @@
+import struct
 from abc import ABC, abstractmethod
-from typing import Optional
-
-import magic
+from typing import BinaryIO, Iterator, Optional, Union
 
+from itoko.crypto.exc import DecryptionError
 from itoko.fs.generators import default_filename_generator
+from itoko.fs.mime import MIME_SNIFF_SIZE, mime_sniffer
+from itoko.fs.payload import (
+    DEFAULT_CHUNK_SIZE,
+    Payload,
+    BytesPayload,
+    CompressedPayload,
+)
 
-__all__ = ["FormatReader", "FormatFile"]
+__all__ = ["FormatReader", "FormatFile", "DEFAULT_CHUNK_SIZE"]
 
 
 class FormatReader(ABC):
     @abstractmethod
     def complies(self, payload: bytes) -> bool:
+        """
+        Tells whether a stored file is in the format of the reader, looking
+        only at its first bytes.
+
+        :param payload: Leading bytes of the stored file, at least as many
+                        as the format header.
+        :return: Boolean indicating whether the file is in the format.
+        """
         raise NotImplementedError
 
     @abstractmethod
     def read(self, filename: str, payload: bytes) -> "FormatFile":
         raise NotImplementedError
 
+    def open(self, filename: str, payload: Payload) -> "FormatFile":
+        """
+        Reads a FormatFile object from a payload view without loading the
+        payload into memory. Readers should override this, the default
+        implementation loads the whole payload.
+        """
+        return self.read(filename, payload.read())
+
 
 class FormatFile(ABC):
     __slots__ = (
@@ -25,31 +48,40 @@ class FormatFile(ABC):
         "_is_encrypted",
         "_filename",
         "_mime_type",
+        "_reference",
     )
 
-    _payload: bytes
+    # Whether the format can store references to deduplicated payloads
+    SUPPORTS_REFERENCES = False
+    # Encodings the format can store compressed payloads in
+    ENCODINGS = ()
+    # Whether the format stores the MIME type, or it's sniffed on every read
+    STORES_MIME_TYPE = True
+
+    _payload: Union[bytes, memoryview, Payload]
     _fs_filename: str
     _is_encrypted: bool
     _filename: Optional[str]
     _mime_type: Optional[str]
+    _reference: Optional[str]
 
     def __init__(
         self,
-        payload: bytes,
+        payload: Union[bytes, memoryview, Payload],
         fs_filename: str = None,
         is_encrypted: bool = False,
         filename: str = None,
         mime_type: str = None,
+        reference: str = None,
     ):
         self._payload = payload
         self._fs_filename = fs_filename or default_filename_generator()
         self._is_encrypted = is_encrypted
         self._filename = filename
-        if self._is_encrypted:
-            self._mime_type = mime_type
-        else:
-            # Try to guess MIME type if we are not encrypted and ONLY IF
-            self._mime_type = mime_type or magic.from_buffer(payload, mime=True)
+        self._reference = reference
+        # Missing MIME types of unencrypted files are only guessed once
+        # asked for, which many reads of the file never do
+        self._mime_type = mime_type
 
     @classmethod
     @abstractmethod
@@ -61,6 +93,75 @@ class FormatFile(ABC):
         """
         raise NotImplementedError
 
+    @classmethod
+    def open(cls, filename: str, payload: Payload) -> "FormatFile":
+        """
+        Reads a FormatFile object from a payload view, parsing only the format
+        metadata. The payload of the returned object is a view into the given
+        one. Formats should override this, the default implementation loads
+        the whole payload.
+
+        :return: FormatFile object.
+        """
+        return cls.read(filename, payload.read())
+
+    @classmethod
+    def write_stream(
+        cls,
+        fp: BinaryIO,
+        stream: BinaryIO,
+        filename: str,
+        mime_type: str = None,
+        key: bytes = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        generated_key: bool = False,
+        encoding: str = None,
+    ) -> None:
+        """
+        Writes the binary representation of a file read from a stream into the
+        given file object, encrypting it if a key is provided. Formats able to
+        process the payload in chunks should override this, the default
+        implementation buffers the whole stream and never compresses it.
+
+        :param fp: Writable file object to store the file in.
+        :param stream: Readable file object with the raw file contents.
+        :param filename: Original filename of the file.
+        :param mime_type: MIME type of the file, guessed if not provided.
+        :param key: Encryption key, if the file is to be encrypted.
+        :param chunk_size: Amount of bytes to process at once.
+        :param generated_key: Whether the key was randomly generated by the
+                              server, see encrypt().
+        :param encoding: Encoding to compress the payload with where it pays
+                         off, one of ENCODINGS.
+        """
+        file = cls(
+            payload=stream.read(), filename=filename, mime_type=mime_type
+        )
+        if key is not None:
+            file = file.encrypt(key, generated_key=generated_key)
+        fp.write(file.file)
+
+    @classmethod
+    def write_reference(
+        cls,
+        fp: BinaryIO,
+        filename: str,
+        digest: str,
+        mime_type: str = None,
+        sample: bytes = b"",
+    ) -> None:
+        """
+        Writes the binary representation of a file whose payload is stored
+        apart, as a blob. Formats supporting references should override this.
+
+        :param fp: Writable file object to store the file in.
+        :param filename: Original filename of the file.
+        :param digest: SHA-256 hex digest of the blob holding the payload.
+        :param mime_type: MIME type of the file, guessed if not provided.
+        :param sample: Start of the payload, to guess the MIME type from.
+        """
+        raise NotImplementedError("Format can't store references.")
+
     @property
     @abstractmethod
     def file(self) -> bytes:
@@ -72,16 +173,153 @@ class FormatFile(ABC):
         raise NotImplementedError
 
     @property
-    def payload(self) -> bytes:
+    def payload(self) -> Union[bytes, memoryview]:
         """
-        Returns the binary payload wrapped by the current file object.
+        Returns the binary payload wrapped by the current file object. Payloads
+        parsed from a binary file are memoryviews into it, not copies.
 
         :return: Binary payload wrapped by the current object.
         """
         if self._is_encrypted:
             raise TypeError("Cannot read the payload in an encrypted file.")
+        if isinstance(self._payload, Payload):
+            return self._payload.read()
         return self._payload
 
+    @property
+    def view(self) -> Payload:
+        """
+        Returns a view over the binary payload wrapped by the current file
+        object, which for lazily loaded files tells where the payload lives.
+
+        :return: Payload view.
+        """
+        if self._is_encrypted:
+            raise TypeError("Cannot read the payload in an encrypted file.")
+        if isinstance(self._payload, Payload):
+            return self._payload
+        return BytesPayload(self._payload)
+
+    @property
+    def encoding(self) -> Optional[str]:
+        """
+        Returns the encoding the payload of the current file is stored
+        compressed with. The payload and views over it are decompressed.
+
+        :return: Encoding or None if stored uncompressed.
+        """
+        if isinstance(self._payload, CompressedPayload):
+            return self._payload.encoding
+        return None
+
+    @property
+    def encoded_view(self) -> Payload:
+        """
+        Returns a view over the binary payload wrapped by the current file
+        object as it is stored, which is compressed if the file has an
+        encoding.
+
+        :return: Payload view.
+        """
+        if isinstance(self._payload, CompressedPayload):
+            return self._payload.source
+        return self.view
+
+    @property
+    def size(self) -> int:
+        """
+        Returns the size of the binary payload wrapped by the current file
+        object, without loading it.
+
+        :return: Payload size in bytes.
+        """
+        return len(self._payload)
+
+    def iter_payload(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        """
+        Yields a byte range of the binary payload wrapped by the current file
+        object in chunks, without loading the rest of it.
+
+        :param start: First byte of the range.
+        :param end: Byte after the last byte of the range, or None for the end
+                    of the payload.
+        :param chunk_size: Maximum size of each yielded chunk.
+        """
+        return self.view.iter_chunks(start, end, chunk_size)
+
+    @property
+    def reference(self) -> Optional[str]:
+        """
+        Returns the SHA-256 hex digest of the blob holding the payload of the
+        current file, if stored apart, in which case the payload has to be
+        resolved before being read.
+
+        :return: Blob digest or None if the payload is held by the file.
+        """
+        return self._reference
+
+    def resolve(
+        self, payload: Union[bytes, memoryview, Payload]
+    ) -> "FormatFile":
+        """
+        Returns a copy of the current reference holding the given payload, as
+        if it had been stored inline.
+
+        :param payload: Payload read from the referenced blob.
+        :return: Object representation of the file.
+        """
+        return type(self)(
+            payload=payload,
+            fs_filename=self._fs_filename,
+            is_encrypted=False,
+            filename=self._filename,
+            mime_type=self._mime_type,
+        )
+
+    def close(self) -> None:
+        """
+        Releases the resources held by a lazily loaded payload, if any.
+        """
+        if isinstance(self._payload, Payload):
+            self._payload.close()
+
+    @property
+    @abstractmethod
+    def version(self) -> int:
+        """
+        Returns the format version of the current file.
+
+        :return: Format version.
+        """
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def suite_id(self) -> Optional[int]:
+        """
+        Returns the ID of the suite the current file is encrypted with, read
+        from its crypto header.
+
+        :return: Suite ID or None if not encrypted.
+        """
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def tag(self) -> Optional[bytes]:
+        """
+        Returns the authentication tag stored with the ciphertext of the
+        current file, which can be read without the key.
+
+        :return: Stored tag or None if not encrypted.
+        """
+        raise NotImplementedError
+
     @property
     def fs_filename(self) -> str:
         """
@@ -123,36 +361,75 @@ class FormatFile(ABC):
         """
         if self._is_encrypted:
             raise TypeError("Cannot read the MIME type in an encrypted file.")
+        if self._mime_type is None:
+            self._mime_type = mime_sniffer.sniff(
+                self.view.read(0, MIME_SNIFF_SIZE)
+            )
         return self._mime_type
 
-    def encrypt(self, key: bytes) -> "FormatFile":
+    def assume_mime_type(self, mime_type: str) -> None:
+        """
+        Sets the MIME type of a file whose format doesn't store it, as sniffed
+        before and kept elsewhere, so it isn't sniffed again.
+
+        :param mime_type: MIME type of the current file.
+        """
+        if self._mime_type is None:
+            self._mime_type = mime_type
+
+    def encrypt(
+        self, key: bytes, generated_key: bool = False
+    ) -> "FormatFile":
         """
         Encrypts the payload in the current file object and return a copy with
         the encrypted data.
+
+        Keys randomly generated by the server have enough entropy to skip key
+        stretching, so formats may pick a faster suite for them. User-chosen
+        keys must never be flagged as generated.
         """
         if self.is_encrypted:
             raise TypeError("File already encrypted.")
-        return self._encryptor(key)
+        return self._encryptor(key, generated_key)
 
     @abstractmethod
-    def _encryptor(self, key: bytes) -> "FormatFile":
+    def _encryptor(
+        self, key: bytes, generated_key: bool = False
+    ) -> "FormatFile":
         """
         Function to be called when attempting to encrypt the payload. Operations
         are expected to perform a copy.
         """
         raise NotImplementedError
 
-    def decrypt(self, key: bytes) -> "FormatFile":
+    def decrypt(self, key: bytes, verify: bool = True) -> "FormatFile":
         """
         Decrypts the payload in the current file object and return a copy with
         the decrypted data.
+
+        Lazily loaded files may be left unverified, sparing a pass over the
+        whole payload when only the metadata and size are needed. A wrong
+        key then garbles the metadata, which is only caught as far as it
+        doesn't parse, and the payload must not be read.
+
+        :param key: Decryption key.
+        :param verify: Whether to authenticate the payload.
+        :return: Object representation of the decrypted file.
         """
         if not self.is_encrypted:
             raise TypeError("File not encrypted.")
-        return self._decryptor(key)
+        if verify:
+            return self._decryptor(key)
+        try:
+            file = self._decryptor(key, verify=False)
+        except (ValueError, struct.error) as e:
+            raise DecryptionError from e
+        if file.is_encrypted:
+            raise DecryptionError
+        return file
 
     @abstractmethod
-    def _decryptor(self, key: bytes) -> "FormatFile":
+    def _decryptor(self, key: bytes, verify: bool = True) -> "FormatFile":
         """
         Function to be called when attempting to decrypt the payload. Operations
         are expected to perform a copy.
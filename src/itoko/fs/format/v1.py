@@ -16,9 +16,11 @@ Footer layout:
 | Raw data | Filename (N bytes) | Filename length (6 bytes) |
 """
 import struct
+from typing import Optional
 
 from itoko.crypto.suite.aesv1 import AESv1Suite
 from itoko.fs.format import FormatReader, FormatFile
+from itoko.fs.payload import Payload
 
 __all__ = ["ItokoV1FormatReader", "ItokoV1FormatFile"]
 
@@ -29,6 +31,9 @@ class ItokoV1FormatReader(FormatReader):
     FOOTER_FORMAT = "!6s"
     FOOTER_SIZE = struct.calcsize("!6s")
 
+    # Not stored anywhere, V1 files have no version field
+    VERSION = 0x1
+
     ENCRYPTED_HEADER = b"1"
     UNENCRYPTED_HEADER = b"0"
     FILENAME_FOOTER_FORMAT = "{:06d}"
@@ -41,8 +46,14 @@ class ItokoV1FormatReader(FormatReader):
         if self.complies(payload):
             return ItokoV1FormatFile.read(filename, payload)
 
+    def open(self, filename: str, payload: Payload) -> "FormatFile":
+        if self.complies(payload.read(0, self.HEADER_SIZE)):
+            return ItokoV1FormatFile.open(filename, payload)
+
 
 class ItokoV1FormatFile(FormatFile):
+    STORES_MIME_TYPE = False
+
     @classmethod
     def read(cls, filename: str, payload: bytes) -> "ItokoV1FormatFile":
         """
@@ -53,12 +64,54 @@ class ItokoV1FormatFile(FormatFile):
         :return: Object representation of the binary file.
         """
         fr = ItokoV1FormatReader  # Gets tiring on the eyes
+        # Slicing a memoryview doesn't copy the underlying payload
+        payload = memoryview(payload)
         header = payload[: fr.HEADER_SIZE]
         if header == fr.ENCRYPTED_HEADER:
             return cls._read_enc(filename, payload)
         else:
             return cls._read_dec(filename, payload)
 
+    @classmethod
+    def open(cls, filename: str, payload: Payload) -> "ItokoV1FormatFile":
+        """
+        Parses the header and footer of a payload view into an
+        ItokoV1FormatFile object, whose payload is a view between them.
+
+        :param filename: Filename of the file stored in-server.
+        :param payload: Binary payload view including a filename footer.
+        :return: Object representation of the binary file.
+        """
+        fr = ItokoV1FormatReader  # Gets tiring on the eyes
+        header = payload.read(0, fr.HEADER_SIZE)
+        data = payload.slice(fr.HEADER_SIZE)
+        if header == fr.ENCRYPTED_HEADER:
+            return cls(
+                payload=data,
+                fs_filename=filename,
+                is_encrypted=True,
+                filename=None,
+                mime_type=None,
+            )
+        else:
+            return cls._open_dec(filename, data)
+
+    @classmethod
+    def _open_dec(cls, filename: str, data: Payload) -> "ItokoV1FormatFile":
+        fr = ItokoV1FormatReader  # Also gets tiring on the eyes
+        footer_pos = len(data) - fr.FOOTER_SIZE
+        footer = data.read(footer_pos)
+        filename_size, = struct.unpack(fr.FOOTER_FORMAT, footer)
+        filename_size = int(filename_size.decode("utf-8"))
+        r_filename = data.read(footer_pos - filename_size, footer_pos)
+        return cls(
+            payload=data.slice(0, footer_pos - filename_size),
+            fs_filename=filename,
+            is_encrypted=False,
+            filename=r_filename.decode("utf-8"),
+            mime_type=None,
+        )
+
     @classmethod
     def _read_enc(cls, filename: str, payload: bytes) -> "ItokoV1FormatFile":
         fr = ItokoV1FormatReader  # And also gets tiring on the eyes
@@ -74,16 +127,24 @@ class ItokoV1FormatFile(FormatFile):
     @classmethod
     def _read_dec(cls, filename: str, payload: bytes) -> "ItokoV1FormatFile":
         fr = ItokoV1FormatReader  # Also gets tiring on the eyes
-        header, data, footer = (
-            payload[: fr.HEADER_SIZE],
-            payload[fr.HEADER_SIZE: -fr.FOOTER_SIZE],
-            payload[-fr.FOOTER_SIZE:],
-        )
+        payload = memoryview(payload)
+        return cls._split_dec(filename, payload[fr.HEADER_SIZE:])
+
+    @classmethod
+    def _split_dec(
+        cls, filename: str, data: memoryview
+    ) -> "ItokoV1FormatFile":
+        fr = ItokoV1FormatReader  # Also gets tiring on the eyes
+        footer_pos = len(data) - fr.FOOTER_SIZE
+        footer = data[footer_pos:]
         # We still need to read the filename based on the footer
         filename_size, = struct.unpack(fr.FOOTER_FORMAT, footer)
         filename_size = int(filename_size.decode("utf-8"))
-        file_data, r_filename = data[:-filename_size], data[-filename_size:]
-        r_filename = r_filename.decode("utf-8")
+        file_data, r_filename = (
+            data[: footer_pos - filename_size],
+            data[footer_pos - filename_size: footer_pos],
+        )
+        r_filename = bytes(r_filename).decode("utf-8")
         # Got all data
         return cls(
             payload=file_data,
@@ -118,7 +179,25 @@ class ItokoV1FormatFile(FormatFile):
             header = fr.ENCRYPTED_HEADER
             return b"".join([header, self._payload])
 
-    def _encryptor(self, key: bytes) -> "ItokoV1FormatFile":
+    @property
+    def version(self) -> int:
+        return ItokoV1FormatReader.VERSION
+
+    @property
+    def suite_id(self) -> Optional[int]:
+        # V1 has no crypto header, there's a single suite
+        return AESv1Suite.SUITE_ID if self._is_encrypted else None
+
+    @property
+    def tag(self) -> Optional[bytes]:
+        if not self._is_encrypted:
+            return None
+        return AESv1Suite.read_tag(self._payload)
+
+    def _encryptor(
+        self, key: bytes, generated_key: bool = False
+    ) -> "ItokoV1FormatFile":
+        # V1 only knows a single suite, whatever the key
         # Don't encrypt the header, V1 is ugly like that
         encrypted_payload = AESv1Suite(key).encrypt(self.file[1:])
         return ItokoV1FormatFile(
@@ -129,10 +208,15 @@ class ItokoV1FormatFile(FormatFile):
             mime_type=None,
         )
 
-    def _decryptor(self, key: bytes) -> "ItokoV1FormatFile":
+    def _decryptor(
+        self, key: bytes, verify: bool = True
+    ) -> "ItokoV1FormatFile":
+        if isinstance(self._payload, Payload):
+            # Verify in a streaming pass and decrypt lazily
+            decrypted_view = AESv1Suite(key).open(self._payload, verify)
+            return self._open_dec(self._fs_filename, decrypted_view)
         decrypted_payload = AESv1Suite(key).decrypt(self._payload)
-        # Far easier to just reuse the previous reader
-        return self._read_dec(
-            self._fs_filename,
-            ItokoV1FormatReader.UNENCRYPTED_HEADER + decrypted_payload,
+        # The decrypted payload lacks the header, so skip straight past it
+        return self._split_dec(
+            self._fs_filename, memoryview(decrypted_payload)
         )
@@ -14,9 +14,9 @@ The flags field is a bit field with the current bits currently in use:
 1: No use
 2: No use
 3: No use
-4: No use
-5: No use
-6: No use
+4: XZ flag
+5: Gzip flag
+6: Reference flag
 7: Encrypted flag
 8: No use
 
@@ -27,13 +27,44 @@ In the case of a non-encrypted file, the next filename_length bytes following
 the header will be expected to contain the filename as a character sequence,
 and the following mime_type_length will be expected to contain the MIME type
 as a character sequence.
+
+If the reference flag is set, the payload isn't stored in the file but in a
+deduplicated blob, and the metadata is followed by the 32-byte SHA-256 digest
+of that blob instead. Only unencrypted files may be references.
+
+If the gzip or XZ flag is set, the payload is compressed in that format, and
+the metadata is followed by the uncompressed size of the payload as an
+unsigned 64-bit integer. Payloads are only compressed when it pays off, and
+never when encrypted.
 """
 import struct
+from typing import BinaryIO, Iterator, Optional, Type, Union
 
+from itoko.crypto.exc import DecryptionError
+from itoko.crypto.suite import Suite
 from itoko.crypto.suite.aesv2 import AESv2Suite
-from itoko.fs.format import FormatReader, FormatFile
+from itoko.crypto.suite.aesv2hkdf import AESv2HKDFSuite
+from itoko.crypto.suite.aesgcm import AESGCMSuite
+from itoko.crypto.suite.aesgcmhkdf import AESGCMHKDFSuite
+from itoko.fs.compression import (
+    ENCODINGS,
+    compressor,
+    should_compress,
+)
+from itoko.fs.format import FormatReader, FormatFile, DEFAULT_CHUNK_SIZE
+from itoko.fs.mime import mime_sniffer
+from itoko.fs.payload import (
+    Payload,
+    BytesPayload,
+    CompressedPayload,
+    iter_stream,
+)
 
-__all__ = ["ItokoV2FormatReader", "ItokoV2FormatFile"]
+__all__ = [
+    "ItokoV2FormatReader",
+    "ItokoV2FormatFile",
+    "ItokoV2GCMFormatFile",
+]
 
 
 class ItokoV2FormatReader(FormatReader):
@@ -44,9 +75,18 @@ class ItokoV2FormatReader(FormatReader):
     # that is safe
     VERSION = 0x2
     ENCRYPTED_FLAG = 0b0000_0010
+    REFERENCE_FLAG = 0b0000_0100
+    GZIP_FLAG = 0b0000_1000
+    XZ_FLAG = 0b0001_0000
+    ENCODING_FLAGS = {"gzip": GZIP_FLAG, "xz": XZ_FLAG}
+    DIGEST_SIZE = 32
+    SIZE_FORMAT = "!Q"
+    SIZE_SIZE = struct.calcsize("!Q")
 
     def complies(self, payload: bytes) -> bool:
         header = payload[: struct.calcsize(self.HEADER_FORMAT)]
+        if len(header) < self.HEADER_SIZE:
+            return False
         version, _, _, _ = struct.unpack(self.HEADER_FORMAT, header)
         return version == self.VERSION
 
@@ -54,8 +94,22 @@ class ItokoV2FormatReader(FormatReader):
         if self.complies(payload):
             return ItokoV2FormatFile.read(filename, payload)
 
+    def open(self, filename: str, payload: Payload) -> "FormatFile":
+        if self.complies(payload.read(0, self.HEADER_SIZE)):
+            return ItokoV2FormatFile.open(filename, payload)
+
 
 class ItokoV2FormatFile(FormatFile):
+    # Later formats sharing this layout override these
+    READER = ItokoV2FormatReader
+    SUITE = AESv2Suite
+    # Suite for server-generated keys, which need no key stretching
+    GENERATED_KEY_SUITE = AESv2HKDFSuite
+    # Suites which may be found in the crypto header when decrypting
+    SUITES = (AESv2Suite, AESv2HKDFSuite, AESGCMSuite, AESGCMHKDFSuite)
+    SUPPORTS_REFERENCES = True
+    ENCODINGS = ENCODINGS
+
     @classmethod
     def read(cls, filename: str, payload: bytes) -> "ItokoV2FormatFile":
         """
@@ -65,7 +119,9 @@ class ItokoV2FormatFile(FormatFile):
         :param payload: Binary payload including a filename footer.
         :return: Object representation of the binary file.
         """
-        fr = ItokoV2FormatReader  # Just because it gets tiring on the eyes
+        fr = cls.READER  # Just because it gets tiring on the eyes
+        # Slicing a memoryview doesn't copy the underlying payload
+        payload = memoryview(payload)
         header, data = payload[: fr.HEADER_SIZE], payload[fr.HEADER_SIZE:]
         # Parse header
         version, flags, fn_len, mt_len = struct.unpack(
@@ -84,58 +140,291 @@ class ItokoV2FormatFile(FormatFile):
             )
         else:
             fn, mt, file_data = (
-                data[: fn_len].decode("utf-8"),
-                data[fn_len: fn_len + mt_len].decode("utf-8"),
+                bytes(data[: fn_len]).decode("utf-8"),
+                bytes(data[fn_len: fn_len + mt_len]).decode("utf-8"),
                 data[fn_len + mt_len:],
             )
             return cls(
-                payload=file_data,
+                payload=cls._decode(flags, file_data),
                 fs_filename=filename,
                 is_encrypted=False,
                 filename=fn,
                 mime_type=mt,
+                reference=cls._read_reference(flags, file_data),
+            )
+
+    @classmethod
+    def open(cls, filename: str, payload: Payload) -> "ItokoV2FormatFile":
+        """
+        Parses the headers of a payload view into an ItokoV2FormatFile object,
+        whose payload is a view past the headers.
+
+        :param filename: Filename of the file stored in-server.
+        :param payload: Binary payload view including headers.
+        :return: Object representation of the binary file.
+        """
+        fr = cls.READER  # Just because it gets tiring on the eyes
+        header = payload.read(0, fr.HEADER_SIZE)
+        version, flags, fn_len, mt_len = struct.unpack(
+            fr.HEADER_FORMAT, header
+        )
+        is_encrypted = bool(flags & fr.ENCRYPTED_FLAG)
+        if is_encrypted:
+            return cls(
+                payload=payload.slice(fr.HEADER_SIZE),
+                fs_filename=filename,
+                is_encrypted=True,
+                filename=None,
+                mime_type=None,
             )
+        else:
+            data_pos = fr.HEADER_SIZE + fn_len + mt_len
+            metadata = payload.read(fr.HEADER_SIZE, data_pos)
+            file_data = payload.slice(data_pos)
+            return cls(
+                payload=cls._decode(flags, file_data),
+                fs_filename=filename,
+                is_encrypted=False,
+                filename=metadata[: fn_len].decode("utf-8"),
+                mime_type=metadata[fn_len:].decode("utf-8"),
+                reference=cls._read_reference(flags, file_data),
+            )
+
+    @classmethod
+    def _read_reference(
+        cls, flags: int, data: Union[memoryview, Payload]
+    ) -> Optional[str]:
+        fr = cls.READER  # Just because it gets tiring on the eyes
+        if not flags & fr.REFERENCE_FLAG:
+            return None
+        if isinstance(data, Payload):
+            digest = data.read(0, fr.DIGEST_SIZE)
+        else:
+            digest = bytes(data[: fr.DIGEST_SIZE])
+        if len(digest) != fr.DIGEST_SIZE:
+            raise ValueError("Truncated blob reference.")
+        return digest.hex()
+
+    @classmethod
+    def _decode(
+        cls, flags: int, data: Union[memoryview, Payload]
+    ) -> Union[memoryview, Payload]:
+        fr = cls.READER  # Just because it gets tiring on the eyes
+        for encoding, flag in fr.ENCODING_FLAGS.items():
+            if flags & flag:
+                break
+        else:
+            return data
+        if not isinstance(data, Payload):
+            data = BytesPayload(data)
+        size = data.read(0, fr.SIZE_SIZE)
+        if len(size) != fr.SIZE_SIZE:
+            raise ValueError("Truncated compressed payload.")
+        (length,) = struct.unpack(fr.SIZE_FORMAT, size)
+        # Decompressed on the fly, only as far as it's read
+        return CompressedPayload(
+            data.slice(fr.SIZE_SIZE), encoding, length
+        )
+
+    @classmethod
+    def write_stream(
+        cls,
+        fp: BinaryIO,
+        stream: BinaryIO,
+        filename: str,
+        mime_type: str = None,
+        key: bytes = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        generated_key: bool = False,
+        encoding: str = None,
+    ) -> None:
+        """
+        Writes a file read from a stream into the given file object without
+        ever holding more than a chunk of it in memory. If a key is provided
+        the file is encrypted on the fly, the file object must then be
+        seekable so the crypto header can be written once the HMAC is known.
+        Likewise when compressing, for the uncompressed size.
+
+        :param fp: Writable file object to store the file in.
+        :param stream: Readable file object with the raw file contents.
+        :param filename: Original filename of the file.
+        :param mime_type: MIME type of the file, guessed from at most
+                          MIME_SNIFF_SIZE bytes of the first chunk if not
+                          provided.
+        :param key: Encryption key, if the file is to be encrypted.
+        :param chunk_size: Amount of bytes to process at once.
+        :param generated_key: Whether the key was randomly generated by the
+                              server, in which case a faster suite is used.
+        :param encoding: Encoding to compress the payload with, if the first
+                         chunk tells it pays off. Ignored when encrypting.
+        """
+        fr = cls.READER  # Just because it gets tiring on the eyes
+        # Every chunk is read into the same buffer, nothing is allocated per
+        # chunk along the way
+        stream_chunks = iter_stream(stream, bytearray(chunk_size))
+        first = next(stream_chunks, memoryview(b""))
+        mime_type = mime_type or mime_sniffer.sniff(first)
+        fn = filename.encode("utf-8")
+        mt = mime_type.encode("utf-8")
+        # Compressed ciphertext would leak how well the plaintext compresses
+        if (
+            encoding is not None
+            and key is None
+            and should_compress(mime_type, bytes(first))
+        ):
+            flags = fr.ENCODING_FLAGS[encoding]
+        else:
+            encoding = None
+            flags = 0x0
+        header = struct.pack(
+            fr.HEADER_FORMAT, fr.VERSION, flags, len(fn), len(mt)
+        )
+
+        def payload_chunks() -> Iterator[memoryview]:
+            if first:
+                yield first
+            yield from stream_chunks
+
+        def chunks() -> Iterator[memoryview]:
+            yield memoryview(b"".join([header, fn, mt]))
+            yield from payload_chunks()
+
+        if encoding is not None:
+            fp.write(b"".join([header, fn, mt]))
+            size_pos = fp.tell()
+            fp.write(struct.pack(fr.SIZE_FORMAT, 0))
+            size = 0
+            c = compressor(encoding)
+            for chunk in payload_chunks():
+                size += len(chunk)
+                fp.write(c.compress(chunk))
+            fp.write(c.flush())
+            # Only known now, go back and fill it in
+            end_pos = fp.tell()
+            fp.seek(size_pos)
+            fp.write(struct.pack(fr.SIZE_FORMAT, size))
+            fp.seek(end_pos)
+        elif key is None:
+            for chunk in chunks():
+                fp.write(chunk)
+        else:
+            # We encrypt the file + headers to ease parsing when decrypting
+            fp.write(struct.pack(
+                fr.HEADER_FORMAT, fr.VERSION, fr.ENCRYPTED_FLAG, 0, 0
+            ))
+            suite = cls._suite(generated_key)
+            suite(key).encrypt_stream(chunks(), fp)
+
+    @classmethod
+    def write_reference(
+        cls,
+        fp: BinaryIO,
+        filename: str,
+        digest: str,
+        mime_type: str = None,
+        sample: bytes = b"",
+    ) -> None:
+        fr = cls.READER  # Just because it gets tiring on the eyes
+        mime_type = mime_type or mime_sniffer.sniff(sample)
+        fn = filename.encode("utf-8")
+        mt = mime_type.encode("utf-8")
+        fp.write(b"".join([
+            struct.pack(
+                fr.HEADER_FORMAT,
+                fr.VERSION,
+                fr.REFERENCE_FLAG,
+                len(fn),
+                len(mt),
+            ),
+            fn,
+            mt,
+            bytes.fromhex(digest),
+        ]))
 
     @property
     def file(self) -> bytes:
         """
         Returns the binary representation of the current object, which is the
-        header plus file metadata plus file data.
+        header plus file metadata plus file data, or the blob digest for
+        references.
 
         :return: Header followed by raw file content.
         """
-        fr = ItokoV2FormatReader  # Just because it gets tiring on the eyes too
+        fr = self.READER  # Just because it gets tiring on the eyes too
         version = fr.VERSION
         if self._is_encrypted:
             flags = 0x0 | fr.ENCRYPTED_FLAG
             fn_len = 0
             mt_len = 0
         else:
-            flags = 0x0
+            if self._reference:
+                flags = fr.REFERENCE_FLAG
+            else:
+                flags = fr.ENCODING_FLAGS.get(self.encoding, 0x0)
             fn_len = len(self.filename.encode("utf-8"))
             mt_len = len(self.mime_type.encode("utf-8"))
         header = struct.pack(fr.HEADER_FORMAT, version, flags, fn_len, mt_len)
         if self._is_encrypted:
             return b"".join([header, self._payload])
+        elif self._reference:
+            return b"".join([
+                header,
+                self._filename.encode("utf-8"),
+                self.mime_type.encode("utf-8"),
+                bytes.fromhex(self._reference),
+            ])
+        elif self.encoding is not None:
+            return b"".join([
+                header,
+                self._filename.encode("utf-8"),
+                self.mime_type.encode("utf-8"),
+                struct.pack(fr.SIZE_FORMAT, self.size),
+                self.encoded_view.read(),
+            ])
         else:
             return b"".join([
                 header,
                 self._filename.encode("utf-8"),
-                self._mime_type.encode("utf-8"),
+                self.mime_type.encode("utf-8"),
                 self._payload,
             ])
 
-    def _encryptor(self, key: bytes) -> "ItokoV2FormatFile":
+    @property
+    def version(self) -> int:
+        return self.READER.VERSION
+
+    @property
+    def suite_id(self) -> Optional[int]:
+        if not self._is_encrypted:
+            return None
+        return Suite.read_suite_id(self._payload)
+
+    @property
+    def tag(self) -> Optional[bytes]:
+        if not self._is_encrypted:
+            return None
+        suite = Suite.lookup(self.SUITES, self.suite_id)
+        return suite.read_tag(self._payload)
+
+    @classmethod
+    def _suite(cls, generated_key: bool = False) -> Type[Suite]:
+        return cls.GENERATED_KEY_SUITE if generated_key else cls.SUITE
+
+    def _encryptor(
+        self, key: bytes, generated_key: bool = False
+    ) -> "ItokoV2FormatFile":
         """
         Encrypts the current file with the given key, returning an
         UploadedEncryptedFile.
 
         :param key: Encryption key.
+        :param generated_key: Whether the key was generated by the server.
         :return: Object representation of the encrypted file.
         """
         # We encrypt the file + headers to ease parsing when decrypting
-        encrypted_payload = AESv2Suite(key).encrypt(self.file)
-        return ItokoV2FormatFile(
+        suite = self._suite(generated_key)
+        encrypted_payload = suite(key).encrypt(self.file)
+        return type(self)(
             payload=encrypted_payload,
             fs_filename=self._fs_filename,
             is_encrypted=True,
@@ -143,7 +432,33 @@ class ItokoV2FormatFile(FormatFile):
             mime_type=None,
         )
 
-    def _decryptor(self, key: bytes) -> "ItokoV2FormatFile":
-        decrypted_payload = AESv2Suite(key).decrypt(self._payload)
+    def _decryptor(
+        self, key: bytes, verify: bool = True
+    ) -> "ItokoV2FormatFile":
+        # The crypto header tells which suite encrypted the file
+        suite = Suite.from_bundle(self.SUITES, key, self._payload)
+        if isinstance(self._payload, Payload):
+            # Verify in a streaming pass and decrypt lazily
+            decrypted_view = suite.open(self._payload, verify)
+            fr = self.READER  # Just because it gets tiring on the eyes
+            # Unverified headers decrypted with a wrong key are garbage
+            if not verify and not fr().complies(
+                decrypted_view.read(0, fr.HEADER_SIZE)
+            ):
+                raise DecryptionError
+            return self.open(self._fs_filename, decrypted_view)
+        decrypted_payload = suite.decrypt(self._payload)
         # This way we just feed the file to the read() function
         return self.read(self._fs_filename, decrypted_payload)
+
+
+class ItokoV2GCMFormatFile(ItokoV2FormatFile):
+    """
+    V2 files encrypted with the single-pass GCM suites. Files are read back
+    as ItokoV2FormatFile, which decrypts every suite of the version, but
+    servers older than these suites can't decrypt them: only write them once
+    every server reading the storage decrypts suites 0x0006 and 0x0007.
+    """
+
+    SUITE = AESGCMSuite
+    GENERATED_KEY_SUITE = AESGCMHKDFSuite
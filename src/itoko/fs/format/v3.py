@@ -0,0 +1,45 @@
+"""
+Handles the binary protocol for chunked files.
+
+The layout is the same as V2, the header being:
+typedef struct header {
+    uint8_t version;
+    uint8_t flags;
+    uint16_t filename_length;
+    uint16_t mime_type_length;
+    uint16_t padding;
+};
+
+With the version field set to 0x03. The difference lies in encrypted files,
+which use a chunked suite instead of a single HMAC over the whole ciphertext.
+The payload is split in fixed-size chunks, each authenticated on its own, and
+the crypto header stores the chunk size and payload length so the position of
+any chunk can be computed. Any chunk can thus be verified and decrypted
+independently, without a full pass over the file before releasing a byte.
+"""
+from itoko.crypto.suite.aesv3 import AESv3Suite
+from itoko.crypto.suite.aesv3hkdf import AESv3HKDFSuite
+from itoko.fs.format import FormatFile
+from itoko.fs.format.v2 import ItokoV2FormatReader, ItokoV2FormatFile
+from itoko.fs.payload import Payload
+
+__all__ = ["ItokoV3FormatReader", "ItokoV3FormatFile"]
+
+
+class ItokoV3FormatReader(ItokoV2FormatReader):
+    VERSION = 0x3
+
+    def read(self, filename: str, payload: bytes) -> "FormatFile":
+        if self.complies(payload):
+            return ItokoV3FormatFile.read(filename, payload)
+
+    def open(self, filename: str, payload: Payload) -> "FormatFile":
+        if self.complies(payload.read(0, self.HEADER_SIZE)):
+            return ItokoV3FormatFile.open(filename, payload)
+
+
+class ItokoV3FormatFile(ItokoV2FormatFile):
+    READER = ItokoV3FormatReader
+    SUITE = AESv3Suite
+    GENERATED_KEY_SUITE = AESv3HKDFSuite
+    SUITES = (AESv3Suite, AESv3HKDFSuite)
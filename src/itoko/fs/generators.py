@@ -1,11 +1,22 @@
 import os
 import time
 import base64
+import threading
 
-__all__ = ["default_key_generator", "default_filename_generator"]
+__all__ = [
+    "FilenameGenerator",
+    "default_key_generator",
+    "default_filename_generator",
+]
 
 TIMESTAMP_PRECISION = 1000
 
+# Filenames generated within the same millisecond by a single process
+SEQUENCE_SIZE = 1000
+MAX_NODE_ID = 999
+# Linux PIDs never go past 2^22
+PID_DIGITS = 7
+
 
 def default_key_generator() -> bytes:
     """
@@ -15,9 +26,66 @@ def default_key_generator() -> bytes:
     return base64.urlsafe_b64encode(os.urandom(18))
 
 
-def default_filename_generator() -> str:
+class FilenameGenerator:
     """
-    Generates a filename. Currently the upload date timestamp in milliseconds is
-    used.
+    Generates filenames unique across processes and nodes. A filename is the
+    upload date timestamp in milliseconds followed by the node ID, the process
+    ID and a sequence number, all zero-padded decimals, so filenames sort by
+    upload date.
+
+    Once the sequence runs out within a millisecond, the next millisecond is
+    borrowed instead of waiting for it. The clock going back is handled the
+    same way, so a process never hands out the same filename twice.
     """
-    return str(int(time.time() * TIMESTAMP_PRECISION))
+
+    __slots__ = ("node_id", "_pid", "_last_ms", "_sequence", "_lock")
+
+    node_id: int
+
+    def __init__(self, node_id: int = 0) -> None:
+        self.node_id = node_id
+        self._pid = None
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def configure(self, node_id: int) -> None:
+        """
+        Sets the ID of the current node.
+
+        :param node_id: ID unique to every node sharing the storage folders,
+                        between 0 and 999.
+        """
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(
+                "Node ID must be between 0 and {}.".format(MAX_NODE_ID)
+            )
+        self.node_id = node_id
+
+    def __call__(self) -> str:
+        now_ms = int(time.time() * TIMESTAMP_PRECISION)
+        with self._lock:
+            pid = os.getpid()
+            if pid != self._pid:
+                # Forked, the sequence of the parent is no concern of ours
+                self._pid = pid
+                self._last_ms = 0
+                self._sequence = 0
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                self._sequence += 1
+                if self._sequence == SEQUENCE_SIZE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return "{}{:03d}{:0{}d}{:03d}".format(
+                self._last_ms,
+                self.node_id,
+                pid,
+                PID_DIGITS,
+                self._sequence,
+            )
+
+
+default_filename_generator = FilenameGenerator()
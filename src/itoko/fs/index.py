@@ -0,0 +1,110 @@
+"""
+Metadata index of stored files, kept in the database next to the shortened
+filenames. The index is only an accelerator, the stored files stay the source
+of truth and the index can be rebuilt from them at any time.
+"""
+import time
+from typing import Iterator, NamedTuple, Optional
+
+__all__ = ["FileRecord", "FileIndex"]
+
+# Access times are only written back when older than this many seconds, so
+# popular files don't cost a database write per request
+ACCESS_RESOLUTION = 60 * 60
+
+
+class FileRecord(NamedTuple):
+    fs_filename: str
+    storage_type: int
+    # Size of the stored file in bytes, headers included
+    size: int
+    version: int
+    suite_id: Optional[int]
+    is_encrypted: bool
+    filename: Optional[str]
+    mime_type: Optional[str]
+    created_at: float
+    accessed_at: Optional[float] = None
+    # SHA-256 hex digest of the unencrypted payload, when known
+    digest: Optional[str] = None
+
+
+class FileIndex:
+    """
+    Reads and writes file records in the files table.
+    """
+
+    __slots__ = ("db",)
+
+    FIELDS = ", ".join(FileRecord._fields)
+
+    def __init__(self, db) -> None:
+        """
+        :param db: Database connector, as in itoko.db.
+        """
+        self.db = db
+
+    @staticmethod
+    def _record(row: dict) -> FileRecord:
+        row["is_encrypted"] = bool(row["is_encrypted"])
+        return FileRecord(**row)
+
+    def get(self, fs_filename: str) -> Optional[FileRecord]:
+        """
+        Looks up the record of a stored file.
+
+        :param fs_filename: Filename of the file stored in-server.
+        :return: File record or None if not indexed.
+        """
+        row = self.db.query(
+            "SELECT {} FROM files WHERE fs_filename = ?".format(self.FIELDS),
+            (fs_filename,),
+            one=True,
+        )
+        if not row:
+            return None
+        return self._record(row)
+
+    def put(self, record: FileRecord) -> None:
+        """
+        Inserts or replaces the record of a stored file.
+
+        :param record: File record.
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO files ({}) VALUES ({})".format(
+                self.FIELDS, ", ".join("?" * len(FileRecord._fields))
+            ),
+            tuple(record),
+        )
+
+    def touch(self, record: FileRecord, now: float = None) -> None:
+        """
+        Records an access to a stored file, if the recorded one is old enough.
+
+        :param record: File record, as previously looked up.
+        :param now: Access timestamp, defaults to the current time.
+        """
+        now = time.time() if now is None else now
+        if record.accessed_at and now - record.accessed_at < ACCESS_RESOLUTION:
+            return
+        self.db.execute(
+            "UPDATE files SET accessed_at = ? WHERE fs_filename = ?",
+            (now, record.fs_filename),
+        )
+
+    def remove(self, fs_filename: str) -> None:
+        """
+        Drops the record of a stored file.
+
+        :param fs_filename: Filename of the file stored in-server.
+        """
+        self.db.execute(
+            "DELETE FROM files WHERE fs_filename = ?", (fs_filename,)
+        )
+
+    def __iter__(self) -> Iterator[FileRecord]:
+        for row in self.db.query(
+            "SELECT {} FROM files ORDER BY fs_filename".format(self.FIELDS)
+        ):
+            yield self._record(row)
@@ -0,0 +1,54 @@
+"""
+MIME type sniffing with libmagic. Only a bounded prefix of a payload is ever
+handed to libmagic, and its handle is opened once per process instead of once
+per file.
+"""
+import os
+import threading
+
+import magic
+
+__all__ = ["MIME_SNIFF_SIZE", "MimeSniffer", "mime_sniffer"]
+
+# Most leading bytes handed to libmagic, a fixed 64 KiB whatever the chunk
+# size. Streamed uploads are sniffed from their first chunk, of which libmagic
+# sees less than this if chunks are smaller.
+MIME_SNIFF_SIZE = 64 * 1024
+
+
+class MimeSniffer:
+    """
+    Guesses MIME types with a libmagic handle kept for the current process.
+    """
+
+    __slots__ = ("_magic", "_lock")
+
+    def __init__(self) -> None:
+        self._magic = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # Handles aren't inherited by forked processes, whose copy of the
+        # lock may have been taken by a thread that isn't there
+        self._magic = None
+        self._lock = threading.Lock()
+
+    def _handle(self) -> magic.Magic:
+        with self._lock:
+            if self._magic is None:
+                self._magic = magic.Magic(mime=True)
+            return self._magic
+
+    def sniff(self, data) -> str:
+        """
+        Guesses the MIME type of a payload from its first bytes.
+
+        :param data: Bytes-like object with the start of the payload, of
+                     which only MIME_SNIFF_SIZE bytes are looked at.
+        :return: MIME type.
+        """
+        return self._handle().from_buffer(bytes(data[:MIME_SNIFF_SIZE]))
+
+
+mime_sniffer = MimeSniffer()
@@ -0,0 +1,535 @@
+"""
+Read-only views over file payloads. A payload view knows its length and can
+yield any byte range of itself in chunks, so callers can stream files of any
+size without ever holding them in memory.
+"""
+import hashlib
+import io
+import os
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Iterator, Optional
+
+from itoko.crypto.parallel import parallel_engine
+from itoko.fs.compression import iter_decompress
+
+__all__ = [
+    "DEFAULT_CHUNK_SIZE",
+    "PREFETCH_SIZE",
+    "Payload",
+    "BytesPayload",
+    "FilePayload",
+    "CipherPayload",
+    "CompressedPayload",
+    "PayloadReader",
+    "HashingReader",
+    "iter_stream",
+]
+
+# Amount of bytes processed at once when streaming files in or out
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Amount of bytes read at once when opening a stored file, which holds the
+# headers of every format in all but the most unusual files
+PREFETCH_SIZE = 4096
+
+
+class Payload(ABC):
+    """
+    Read-only view over a byte sequence which may not be held in memory.
+    """
+
+    __slots__ = ()
+
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def slice(self, start: int = 0, end: int = None) -> "Payload":
+        """
+        Returns a view over a byte range of the current payload. No data is
+        read or copied.
+
+        :param start: First byte of the range.
+        :param end: Byte after the last byte of the range, or None for the end
+                    of the payload.
+        :return: View over the byte range.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_chunks(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        """
+        Yields a byte range of the current payload in chunks of at most
+        chunk_size bytes.
+
+        :param start: First byte of the range.
+        :param end: Byte after the last byte of the range, or None for the end
+                    of the payload.
+        :param chunk_size: Maximum size of each yielded chunk.
+        """
+        raise NotImplementedError
+
+    def iter_into(
+        self, buf: bytearray, start: int = 0, end: int = None
+    ) -> Iterator[memoryview]:
+        """
+        Yields a byte range of the current payload as views of at most
+        len(buf) bytes, filling the given buffer instead of allocating a new
+        object per chunk. Each view is only valid until the next one is
+        requested. Payloads able to read in place should override this, the
+        default implementation copies every chunk into the buffer.
+
+        :param buf: Preallocated buffer to read into.
+        :param start: First byte of the range.
+        :param end: Byte after the last byte of the range, or None for the end
+                    of the payload.
+        """
+        view = memoryview(buf)
+        for chunk in self.iter_chunks(start, end, len(buf)):
+            view[: len(chunk)] = chunk
+            yield view[: len(chunk)]
+
+    def read(self, start: int = 0, end: int = None) -> bytes:
+        """
+        Reads a byte range of the current payload into memory.
+
+        :param start: First byte of the range.
+        :param end: Byte after the last byte of the range, or None for the end
+                    of the payload.
+        :return: Bytes in the range.
+        """
+        start, end = self._bounds(start, end)
+        return b"".join(self.iter_chunks(start, end, max(end - start, 1)))
+
+    def prefetch(self, size: int = PREFETCH_SIZE) -> "Payload":
+        """
+        Returns a view over the same bytes whose first bytes are read at once
+        and kept in memory, so the many small reads of header parsing cost a
+        single read. Payloads whose reads are costly should override this,
+        the default implementation returns the current payload.
+
+        :param size: Amount of leading bytes to keep in memory.
+        :return: View over the same bytes.
+        """
+        return self
+
+    @property
+    def identity(self) -> Optional[tuple]:
+        """
+        Returns a value identifying the bytes behind the current payload for
+        as long as they are unchanged, which allows caching work done over
+        them, or None if the payload can't be identified.
+        """
+        return None
+
+    def close(self) -> None:
+        """
+        Releases any resource held by the payload.
+        """
+
+    def _bounds(self, start: int, end: Optional[int]):
+        length = len(self)
+        if end is None or end > length:
+            end = length
+        end = max(end, 0)
+        start = min(max(start, 0), end)
+        return start, end
+
+
+class BytesPayload(Payload):
+    """
+    Payload held in memory.
+    """
+
+    __slots__ = ("_data",)
+
+    _data: memoryview
+
+    def __init__(self, data: bytes) -> None:
+        self._data = memoryview(data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def slice(self, start: int = 0, end: int = None) -> "BytesPayload":
+        start, end = self._bounds(start, end)
+        return BytesPayload(self._data[start:end])
+
+    def iter_chunks(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        start, end = self._bounds(start, end)
+        for pos in range(start, end, chunk_size):
+            yield bytes(self._data[pos: min(pos + chunk_size, end)])
+
+    def iter_into(
+        self, buf: bytearray, start: int = 0, end: int = None
+    ) -> Iterator[memoryview]:
+        # The data is already in memory, hand out views of it instead
+        start, end = self._bounds(start, end)
+        for pos in range(start, end, len(buf)):
+            yield self._data[pos: min(pos + len(buf), end)]
+
+
+class FilePayload(Payload):
+    """
+    Payload stored in a byte range of an open file. Reads are positional, so
+    several views may share the same file object. Prefetched leading bytes
+    are carried over to the views sliced from them.
+    """
+
+    __slots__ = ("_fp", "_offset", "_length", "_head")
+
+    _fp: BinaryIO
+    _offset: int
+    _length: int
+    _head: bytes
+
+    def __init__(
+        self,
+        fp: BinaryIO,
+        offset: int = 0,
+        length: int = None,
+        head: bytes = b"",
+    ):
+        """
+        :param fp: File object opened for reading.
+        :param offset: Position in the file where the payload starts.
+        :param length: Length of the payload, or None for the rest of the
+                       file.
+        :param head: Leading bytes of the payload, already read.
+        """
+        self._fp = fp
+        self._offset = offset
+        if length is None:
+            length = os.fstat(fp.fileno()).st_size - offset
+        self._length = length
+        self._head = head
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def fp(self) -> BinaryIO:
+        """
+        Returns the file object backing the current payload.
+        """
+        return self._fp
+
+    @property
+    def offset(self) -> int:
+        """
+        Returns the position in the backing file where the payload starts.
+        """
+        return self._offset
+
+    @property
+    def identity(self) -> Optional[tuple]:
+        st = os.fstat(self._fp.fileno())
+        return (
+            st.st_dev,
+            st.st_ino,
+            st.st_size,
+            st.st_mtime_ns,
+            self._offset,
+            self._length,
+        )
+
+    def slice(self, start: int = 0, end: int = None) -> "FilePayload":
+        start, end = self._bounds(start, end)
+        return FilePayload(
+            self._fp, self._offset + start, end - start, self._head[start:end]
+        )
+
+    def prefetch(self, size: int = PREFETCH_SIZE) -> "FilePayload":
+        if len(self._head) >= min(size, self._length):
+            return self
+        return FilePayload(
+            self._fp, self._offset, self._length, self.read(0, size)
+        )
+
+    def iter_chunks(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        start, end = self._bounds(start, end)
+        if end <= len(self._head):
+            # Served from the prefetched bytes
+            yield from BytesPayload(self._head).iter_chunks(
+                start, end, chunk_size
+            )
+            return
+        fd = self._fp.fileno()
+        pos = self._offset + start
+        end = self._offset + end
+        while pos < end:
+            chunk = os.pread(fd, min(chunk_size, end - pos), pos)
+            if not chunk:
+                raise EOFError("File truncated while reading.")
+            pos += len(chunk)
+            yield chunk
+
+    def iter_into(
+        self, buf: bytearray, start: int = 0, end: int = None
+    ) -> Iterator[memoryview]:
+        if not hasattr(os, "preadv"):
+            yield from super().iter_into(buf, start, end)
+            return
+        start, end = self._bounds(start, end)
+        view = memoryview(buf)
+        fd = self._fp.fileno()
+        pos = self._offset + start
+        end = self._offset + end
+        while pos < end:
+            read = os.preadv(fd, [view[: min(len(view), end - pos)]], pos)
+            if not read:
+                raise EOFError("File truncated while reading.")
+            pos += read
+            yield view[:read]
+
+    def close(self) -> None:
+        self._fp.close()
+
+
+class CipherPayload(Payload):
+    """
+    Payload decrypted on the fly from a ciphertext payload. The cipher must be
+    seekable, as in CTR mode, so any byte range can be decrypted on its own.
+    """
+
+    __slots__ = ("_source", "_cipher", "_position")
+
+    _source: Payload
+    _position: int
+
+    def __init__(self, source: Payload, cipher, position: int = 0) -> None:
+        """
+        :param source: Ciphertext payload.
+        :param cipher: Seekable itoko Cipher keyed for the ciphertext.
+        :param position: Keystream position of the first ciphertext byte.
+        """
+        self._source = source
+        self._cipher = cipher
+        self._position = position
+
+    def __len__(self) -> int:
+        return len(self._source)
+
+    def slice(self, start: int = 0, end: int = None) -> "CipherPayload":
+        start, end = self._bounds(start, end)
+        return CipherPayload(
+            self._source.slice(start, end),
+            self._cipher,
+            self._position + start,
+        )
+
+    def iter_chunks(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        start, end = self._bounds(start, end)
+        if parallel_engine.accepts(end - start):
+            yield from parallel_engine.iter_decrypt(
+                self._cipher,
+                self._source,
+                self._position,
+                start,
+                end,
+                chunk_size,
+            )
+            return
+        decryptor = self._cipher.decryptor_at(self._position + start)
+        # Ciphertext is read into a single buffer, only plaintext is allocated
+        scratch = bytearray(chunk_size)
+        for chunk in self._source.iter_into(scratch, start, end):
+            yield decryptor.update(chunk)
+
+    def iter_into(
+        self, buf: bytearray, start: int = 0, end: int = None
+    ) -> Iterator[memoryview]:
+        start, end = self._bounds(start, end)
+        decryptor = self._cipher.decryptor_at(self._position + start)
+        view = memoryview(buf)
+        # Ciphers want some room past the data in their output buffer
+        scratch = bytearray(len(buf) - self._cipher.buffer_size(0))
+        for chunk in self._source.iter_into(scratch, start, end):
+            yield view[: decryptor.update_into(chunk, buf)]
+
+    def close(self) -> None:
+        self._source.close()
+
+
+class CompressedPayload(Payload):
+    """
+    Payload decompressed on the fly from a compressed payload. Compressed
+    streams can't be entered midway, so every range is decompressed from the
+    start of the stream, dropping whatever comes before it.
+    """
+
+    __slots__ = ("_source", "_encoding", "_start", "_length")
+
+    _source: Payload
+    _encoding: str
+    _start: int
+    _length: int
+
+    def __init__(
+        self, source: Payload, encoding: str, length: int, start: int = 0
+    ) -> None:
+        """
+        :param source: Compressed payload.
+        :param encoding: Encoding of the compressed payload, one of
+                         itoko.fs.compression.ENCODINGS.
+        :param length: Length of the view, in decompressed bytes.
+        :param start: Position of the view in the decompressed stream.
+        """
+        self._source = source
+        self._encoding = encoding
+        self._start = start
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def source(self) -> Payload:
+        """
+        Returns the compressed payload, for the whole stream.
+        """
+        return self._source
+
+    @property
+    def encoding(self) -> str:
+        """
+        Returns the encoding of the compressed payload.
+        """
+        return self._encoding
+
+    def slice(self, start: int = 0, end: int = None) -> "CompressedPayload":
+        start, end = self._bounds(start, end)
+        return CompressedPayload(
+            self._source, self._encoding, end - start, self._start + start
+        )
+
+    def iter_chunks(
+        self,
+        start: int = 0,
+        end: int = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        start, end = self._bounds(start, end)
+        if start == end:
+            return
+        start += self._start
+        end += self._start
+        pos = 0
+        for chunk in iter_decompress(
+            self._encoding,
+            self._source.iter_chunks(chunk_size=chunk_size),
+            chunk_size,
+        ):
+            chunk_end = pos + len(chunk)
+            if chunk_end > start:
+                yield chunk[max(start - pos, 0): end - pos]
+            pos = chunk_end
+            if pos >= end:
+                return
+        raise EOFError("Compressed payload truncated.")
+
+    def close(self) -> None:
+        self._source.close()
+
+
+class PayloadReader(io.RawIOBase):
+    """
+    Readable file object over a payload, for code taking streams, such as
+    FormatFile.write_stream(). Closing it leaves the payload open.
+    """
+
+    def __init__(self, payload: Payload) -> None:
+        self._payload = payload
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        view = memoryview(buf).cast("B")
+        end = min(self._position + len(view), len(self._payload))
+        # A single chunk per call, short reads are fine for raw streams
+        chunk = next(
+            self._payload.iter_into(view, self._position, end),
+            memoryview(b""),
+        )
+        # Payloads reading in place already filled the buffer
+        if chunk.obj is not view.obj:
+            view[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Readable file object passing another one through, keeping the SHA-256
+    digest of what was read, so a stream is hashed as it's stored.
+    """
+
+    def __init__(self, stream: BinaryIO) -> None:
+        self._stream = stream
+        self._hash = hashlib.sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        view = memoryview(buf).cast("B")
+        readinto = getattr(self._stream, "readinto", None)
+        if readinto is not None:
+            read = readinto(view) or 0
+        else:
+            chunk = self._stream.read(len(view))
+            read = len(chunk)
+            view[:read] = chunk
+        self._hash.update(view[:read])
+        return read
+
+    def hexdigest(self) -> str:
+        """
+        :return: SHA-256 hex digest of the bytes read so far.
+        """
+        return self._hash.hexdigest()
+
+
+def iter_stream(stream: BinaryIO, buf: bytearray) -> Iterator[memoryview]:
+    """
+    Yields the contents of a readable file object as views into the given
+    buffer, which is filled again for every chunk. Each view is only valid
+    until the next one is requested.
+
+    :param stream: Readable file object.
+    :param buf: Preallocated buffer to read into.
+    """
+    view = memoryview(buf)
+    readinto = getattr(stream, "readinto", None)
+    while True:
+        if readinto is not None:
+            read = readinto(buf)
+        else:
+            chunk = stream.read(len(buf))
+            read = len(chunk)
+            view[:read] = chunk
+        if not read:
+            return
+        yield view[:read]
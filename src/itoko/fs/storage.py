@@ -1,36 +1,86 @@
-import os
-from enum import Enum
-from typing import Optional, List
+import hashlib
+import io
+import time
+from typing import BinaryIO, Iterator, Optional, List, Type
 
-from itoko.fs.format import FormatReader, FormatFile
+from itoko.fs.atomic import FSyncPolicy
+from itoko.fs.backends import (
+    FSStorageType,
+    ObjectEntry,
+    ObjectStat,
+    StorageBackend,
+)
+from itoko.fs.blobs import BlobStore
+from itoko.fs.cache import hot_file_cache
+from itoko.fs.compression import ENCODINGS
+from itoko.fs.format import FormatReader, FormatFile, DEFAULT_CHUNK_SIZE
+from itoko.fs.index import FileIndex, FileRecord
+from itoko.fs.payload import HashingReader
+from itoko.lookup import lookup_filter
 
-__all__ = ["FSStorageType", "FSStorage"]
-
-
-class FSStorageType(Enum):
-    TEMPORARY_STORAGE = 1
-    PERMANENT_STORAGE = 2
+__all__ = ["FSStorageType", "FSyncPolicy", "FSStorage"]
 
 
 class FSStorage:
     """
-    Handles access to the external file system to store and retrieve files.
+    Handles storing and retrieving files through a storage backend, which
+    holds the stored files, see itoko.fs.backends.
+
+    Unencrypted payloads may be deduplicated into a blob store, in which case
+    stored files only reference them. References are resolved when reading,
+    so callers always get the payload.
+
+    Payloads stored in their own file may be compressed, where it pays off.
     """
-    __slots__ = ("temporary_folder", "permanent_folder", "readers")
+    __slots__ = (
+        "backend",
+        "readers",
+        "chunk_size",
+        "index",
+        "blobs",
+        "compression",
+    )
 
-    temporary_folder: str
-    permanent_folder: str
+    backend: StorageBackend
     readers: List[FormatReader]
+    chunk_size: int
+    index: Optional[FileIndex]
+    blobs: Optional[BlobStore]
+    compression: Optional[str]
 
     def __init__(
         self,
-        temporary_folder: str,
-        permanent_folder: str,
+        backend: StorageBackend,
         readers: List[FormatReader],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        index: FileIndex = None,
+        blobs: BlobStore = None,
+        compression: str = None,
     ) -> None:
-        self.temporary_folder = temporary_folder
-        self.permanent_folder = permanent_folder
+        """
+        :param backend: Storage backend holding the stored files.
+        :param blobs: Blob store to deduplicate unencrypted payloads into, or
+                      None to store every payload in its own file.
+        :param compression: Encoding to compress unencrypted payloads with,
+                            one of itoko.fs.compression.ENCODINGS, or None.
+        """
+        if compression is not None and compression not in ENCODINGS:
+            raise ValueError("Unknown encoding {}.".format(compression))
+        self.backend = backend
         self.readers = readers
+        self.chunk_size = chunk_size
+        self.index = index
+        self.blobs = blobs
+        self.compression = compression
+
+    def scan(self, st: FSStorageType) -> Iterator[ObjectEntry]:
+        """
+        Lists the stored files of a storage type, in no particular order.
+
+        :param st: Storage type to list.
+        :return: Entries with the name and a stat() method of every file.
+        """
+        return self.backend.scan(st)
 
     def exists(self, filename: str) -> Optional[FSStorageType]:
         """
@@ -41,14 +91,32 @@ class FSStorage:
         :param filename: Filename to search for.
         :return: Storage type where file was found or None.
         """
-        perm = os.path.join(self.permanent_folder, filename)
-        if os.path.exists(perm):
-            return FSStorageType.PERMANENT_STORAGE
-        temp = os.path.join(self.temporary_folder, filename)
-        if os.path.exists(temp):
-            return FSStorageType.TEMPORARY_STORAGE
+        if self.index is not None:
+            record = self.index.get(filename)
+            if record is not None:
+                return FSStorageType(record.storage_type)
+        # Not indexed, the file may predate the index
+        for st in (
+            FSStorageType.PERMANENT_STORAGE,
+            FSStorageType.TEMPORARY_STORAGE,
+        ):
+            try:
+                self.backend.stat(st, filename)
+            except FileNotFoundError:
+                continue
+            return st
         return None
 
+    def stat(self, st: FSStorageType, filename: str) -> ObjectStat:
+        """
+        Returns the status of a stored file.
+
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :return: Status of the stored file.
+        """
+        return self.backend.stat(st, filename)
+
     def read(self, st: FSStorageType, filename: str) -> FormatFile:
         """
         Reads a file stored in the server and attempts to parse it with the
@@ -59,23 +127,130 @@ class FSStorage:
         :param filename: Filename of the file stored in-server.
         :return: Object representation of the binary file.
         """
-        if st == FSStorageType.PERMANENT_STORAGE:
-            path = os.path.join(self.permanent_folder, filename)
-        elif st == FSStorageType.TEMPORARY_STORAGE:
-            path = os.path.join(self.temporary_folder, filename)
-        else:
-            raise TypeError("Invalid storage type provided.")
-
-        with open(path, "rb") as f:
-            payload = f.read()
+        # Readers slice memoryviews over the loaded file, backends map it
+        # where they can so the payload is never copied
+        payload = self.backend.map(st, filename)
 
         for reader in self.readers:
             if reader.complies(payload):
-                return reader.read(filename, payload)
+                file = reader.read(filename, payload)
+                if file.reference is None:
+                    return file
+                return file.resolve(self._blobs().map(file.reference))
 
         # We have a file, but can't parse it so pretend it's not there
         raise FileNotFoundError
 
+    def open(self, st: FSStorageType, filename: str) -> FormatFile:
+        """
+        Opens a file stored in the server and attempts to parse its headers
+        with the available readers. Unlike read(), the payload is not loaded
+        but left as a view into the stored file, which the caller must
+        release through FormatFile.close(). Formats are detected and headers
+        parsed from a single small read of the start of the file.
+
+        :param st: Storage type to probe.
+        :param filename: Filename of the file stored in-server.
+        :return: Object representation of the binary file.
+        """
+        return self._resolve(st, self._parse(st, filename))
+
+    def _resolve(self, st: FSStorageType, file: FormatFile) -> FormatFile:
+        if file.reference is not None:
+            # Only the small reference was opened, swap in the blob
+            file.close()
+            return file.resolve(self._blobs().open(file.reference))
+        if not (
+            file.STORES_MIME_TYPE or file.is_encrypted or self.index is None
+        ):
+            self._recall_mime_type(st, file)
+        return file
+
+    def _recall_mime_type(self, st: FSStorageType, file: FormatFile) -> None:
+        # Formats without a MIME type field have it sniffed once and kept in
+        # the index, files missing from it are indexed now
+        record = self.index.get(file.fs_filename)
+        if record is None:
+            record = self._record(
+                st,
+                file,
+                created_at=self.stat(st, file.fs_filename).st_mtime,
+            )
+            self.index.put(record)
+        file.assume_mime_type(record.mime_type)
+
+    def _parse(self, st: FSStorageType, filename: str) -> FormatFile:
+        # Readers probe and parse headers in many small reads, all served
+        # from a single read of the start of the file
+        payload = self.backend.open(st, filename).prefetch()
+        try:
+            for reader in self.readers:
+                file = reader.open(filename, payload)
+                if file is not None:
+                    return file
+        except Exception:
+            payload.close()
+            raise
+
+        # We have a file, but can't parse it so pretend it's not there
+        payload.close()
+        raise FileNotFoundError
+
+    def _read_reference(
+        self, st: FSStorageType, filename: str
+    ) -> Optional[str]:
+        try:
+            file = self._parse(st, filename)
+        except FileNotFoundError:
+            # Unparseable files are still removed, and hold no reference
+            return None
+        file.close()
+        return file.reference
+
+    def _blobs(self) -> BlobStore:
+        if self.blobs is None:
+            # References without a blob store can't be read
+            raise FileNotFoundError
+        return self.blobs
+
+    def _dedup(self, writer: Type[FormatFile], key: bytes = None) -> bool:
+        return (
+            key is None
+            and self.blobs is not None
+            and writer.SUPPORTS_REFERENCES
+        )
+
+    def _encoding(self, writer: Type[FormatFile]) -> Optional[str]:
+        if self.compression in writer.ENCODINGS:
+            return self.compression
+        return None
+
+    def _write_reference(
+        self,
+        st: FSStorageType,
+        fs_filename: str,
+        writer: Type[FormatFile],
+        digest: str,
+        filename: str,
+        mime_type: str = None,
+    ) -> None:
+        try:
+            sample = b""
+            if mime_type is None:
+                blob = self.blobs.open(digest)
+                try:
+                    sample = blob.read(0, self.chunk_size)
+                finally:
+                    blob.close()
+            with self.backend.create(st, fs_filename) as f:
+                writer.write_reference(
+                    f, filename, digest, mime_type=mime_type, sample=sample
+                )
+        except BaseException:
+            # Give the reference back, the file won't hold it
+            self.blobs.release(digest)
+            raise
+
     def write(self, st: FSStorageType, file: FormatFile) -> None:
         """
         Converts a Flask FileStorage, which represents a file being uploaded
@@ -85,12 +260,170 @@ class FSStorage:
         :param file: FileStorage being uploaded.
         :return: Object representation of the binary file.
         """
-        if st == FSStorageType.PERMANENT_STORAGE:
-            path = os.path.join(self.permanent_folder, file.fs_filename)
-        elif st == FSStorageType.TEMPORARY_STORAGE:
-            path = os.path.join(self.temporary_folder, file.fs_filename)
+        digest = None
+        if not file.is_encrypted and self._dedup(type(file)):
+            digest = self.blobs.put(io.BytesIO(file.payload), self.chunk_size)
+            self._write_reference(
+                st,
+                file.fs_filename,
+                type(file),
+                digest,
+                file.filename,
+                mime_type=file.mime_type,
+            )
+        elif (
+            not file.is_encrypted
+            and file.encoding is None
+            and self._encoding(type(file)) is not None
+        ):
+            digest = hashlib.sha256(file.payload).hexdigest()
+            # Let the format compress it, if worth it
+            with self.backend.create(st, file.fs_filename) as f:
+                type(file).write_stream(
+                    f,
+                    io.BytesIO(file.payload),
+                    filename=file.filename,
+                    mime_type=file.mime_type,
+                    chunk_size=self.chunk_size,
+                    encoding=self._encoding(type(file)),
+                )
         else:
-            raise TypeError("Invalid storage type provided.")
+            if not file.is_encrypted:
+                digest = hashlib.sha256(file.payload).hexdigest()
+            with self.backend.create(st, file.fs_filename) as f:
+                f.write(file.file)
+
+        self._index(st, file.fs_filename, digest)
+
+    def write_stream(
+        self,
+        st: FSStorageType,
+        fs_filename: str,
+        writer: Type[FormatFile],
+        stream: BinaryIO,
+        filename: str,
+        key: bytes = None,
+        generated_key: bool = False,
+    ) -> None:
+        """
+        Stores a file read from a stream in-server using the given format,
+        processing it in chunks so the whole file is never held in memory.
+
+        :param st: Storage type to upload to.
+        :param fs_filename: Filename to store the file as in-server.
+        :param writer: FormatFile class used to write the file.
+        :param stream: Readable file object with the raw file contents.
+        :param filename: Original filename of the file.
+        :param key: Encryption key, if the file is to be encrypted.
+        :param generated_key: Whether the key was randomly generated by the
+                              server.
+        """
+        if self._dedup(writer, key):
+            digest = self.blobs.put(stream, self.chunk_size)
+            self._write_reference(st, fs_filename, writer, digest, filename)
+            self._index(st, fs_filename, digest)
+            return
+
+        if key is None:
+            # Hashed on the way, for strong entity tags
+            stream = HashingReader(stream)
+        with self.backend.create(st, fs_filename) as f:
+            writer.write_stream(
+                f,
+                stream,
+                filename=filename,
+                key=key,
+                chunk_size=self.chunk_size,
+                generated_key=generated_key,
+                encoding=self._encoding(writer),
+            )
+
+        self._index(
+            st, fs_filename, stream.hexdigest() if key is None else None
+        )
+
+    def remove(self, st: FSStorageType, filename: str) -> None:
+        """
+        Deletes a stored file along with its index record and cached copy, if
+        any. Both are dropped even if the file was already gone.
 
-        with open(path, "wb+") as f:
-            f.write(file.file)
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :raises FileNotFoundError: If the file isn't stored.
+        """
+        reference = None
+        try:
+            if self.blobs is not None:
+                reference = self._read_reference(st, filename)
+            self.backend.remove(st, filename)
+        finally:
+            if self.index is not None:
+                self.index.remove(filename)
+            hot_file_cache.invalidate(filename)
+        # Only once the file is gone, in case of concurrent removals
+        if reference is not None:
+            self.blobs.release(reference)
+
+    def touch(self, filename: str) -> Optional[FileRecord]:
+        """
+        Records an access to a stored file in the index, if any.
+
+        :param filename: Filename of the file stored in-server.
+        :return: Index record of the file, as it was before the access, or
+                 None if not indexed.
+        """
+        if self.index is None:
+            return None
+        record = self.index.get(filename)
+        if record is not None:
+            self.index.touch(record)
+        return record
+
+    def record(
+        self,
+        st: FSStorageType,
+        filename: str,
+        created_at: float = None,
+        digest: str = None,
+    ) -> FileRecord:
+        """
+        Builds the index record of a stored file, parsing only its headers.
+        The payload digest is only known from references, unless given.
+
+        :param st: Storage type the file is stored in.
+        :param filename: Filename of the file stored in-server.
+        :param created_at: Creation timestamp, defaults to the current time.
+        :param digest: SHA-256 hex digest of the unencrypted payload.
+        :return: File record.
+        """
+        file = self._parse(st, filename)
+        digest = file.reference or digest
+        file = self._resolve(st, file)
+        try:
+            return self._record(st, file, created_at)._replace(
+                digest=None if file.is_encrypted else digest
+            )
+        finally:
+            file.close()
+
+    def _record(
+        self, st: FSStorageType, file: FormatFile, created_at: float = None
+    ) -> FileRecord:
+        return FileRecord(
+            fs_filename=file.fs_filename,
+            storage_type=st.value,
+            size=self.stat(st, file.fs_filename).st_size,
+            version=file.version,
+            suite_id=file.suite_id,
+            is_encrypted=file.is_encrypted,
+            filename=None if file.is_encrypted else file.filename,
+            mime_type=None if file.is_encrypted else file.mime_type,
+            created_at=time.time() if created_at is None else created_at,
+        )
+
+    def _index(
+        self, st: FSStorageType, filename: str, digest: str = None
+    ) -> None:
+        if self.index is not None:
+            self.index.put(self.record(st, filename, digest=digest))
+        lookup_filter.add_filename(filename)
@@ -0,0 +1,418 @@
+"""
+Filter of the stored filenames and short names, so lookups of names never
+handed out are turned down without touching the database or the storage.
+
+Every process keeps Bloom filters of both kinds of names, built from the
+files index and the shortened table in a background thread on first use.
+Every name is let through until the filters are built, so a request never
+waits for a build. Names are added to a journal shared by the processes of a
+node as they're stored, which every process replays into its filters before
+turning a name down, so names stored by other processes are never missed.
+Removed names stay in the filters until they're rebuilt, they only cost a
+lookup as before.
+
+The journal is a ring of name hashes in a memory-mapped file behind a
+sequence number. Processes replaying it too late to find every name they
+missed there drop their filters and rebuild them, letting every name through
+meanwhile. Filters filling up keep being used while bigger ones are built.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+from flask import Flask, current_app
+
+from itoko.db import db
+from itoko.fs.index import FileIndex
+
+__all__ = ["BloomFilter", "LookupFilter", "lookup_filter"]
+
+"""
+typedef struct journal {
+    uint64_t sequence;
+    entry entries[JOURNAL_ENTRIES];
+} journal;
+
+typedef struct entry {
+    uint8_t kind;
+    char digest[16];
+} entry;
+"""
+SEQUENCE_FORMAT = "!Q"
+SEQUENCE_SIZE = struct.calcsize(SEQUENCE_FORMAT)
+ENTRY_FORMAT = "!B16s"
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+JOURNAL_ENTRIES = 65536
+JOURNAL_SIZE = SEQUENCE_SIZE + ENTRY_SIZE * JOURNAL_ENTRIES
+
+FILENAME_KIND = 1
+SHORT_NAME_KIND = 2
+
+
+class BloomFilter:
+    """
+    Set of name digests answering whether a digest may have been added, with
+    no false negatives.
+    """
+
+    __slots__ = ("capacity", "size", "hashes", "count", "bits")
+
+    capacity: int
+    size: int
+    hashes: int
+    count: int
+    bits: bytearray
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        """
+        :param capacity: Digests the filter is sized for.
+        :param error_rate: False positive rate once the filter holds as many
+                           digests as its capacity.
+        """
+        self.capacity = max(capacity, 1)
+        # Optimal bit and hash counts for the given rate
+        self.size = max(
+            64,
+            math.ceil(
+                -self.capacity * math.log(error_rate) / math.log(2) ** 2
+            ),
+        )
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @staticmethod
+    def digest(name: str) -> bytes:
+        return hashlib.blake2b(name.encode("utf-8"), digest_size=16).digest()
+
+    def _positions(self, digest: bytes) -> Iterator[int]:
+        # Double hashing, as good as independent hashes for Bloom filters
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, digest: bytes) -> None:
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(digest)
+        )
+
+    @property
+    def error_rate(self) -> float:
+        """
+        Returns the expected false positive rate at the current fill.
+        """
+        return (
+            1 - math.exp(-self.hashes * self.count / self.size)
+        ) ** self.hashes
+
+
+class LookupFilter:
+    """
+    Per-process filters of the stored filenames and short names, kept in
+    sync through the shared journal.
+    """
+
+    __slots__ = (
+        "capacity",
+        "error_rate",
+        "journal_path",
+        "negatives",
+        "false_positives",
+        "rebuilds",
+        "_filters",
+        "_sequence",
+        "_journal",
+        "_journal_fd",
+        "_pid",
+        "_building",
+        "_lock",
+    )
+
+    capacity: int
+    error_rate: float
+    journal_path: str
+
+    def __init__(
+        self,
+        capacity: int = 0,
+        error_rate: float = 0.01,
+        journal_path: str = "",
+    ) -> None:
+        """
+        :param capacity: Names of each kind the filters are first sized for,
+                         0 disables the filter.
+        :param error_rate: False positive rate of full filters.
+        :param journal_path: File the journal is mapped from, shared by every
+                             process storing or looking up names.
+        """
+        self.negatives = 0
+        self.false_positives = 0
+        self.rebuilds = 0
+        self._filters = None
+        self._sequence = 0
+        self._journal = None
+        self._journal_fd = None
+        self._pid = None
+        self._building = False
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+        self.configure(capacity, error_rate, journal_path)
+
+    def _after_fork(self) -> None:
+        # Filters built so far are still good, a build in progress is gone
+        # with its thread, and the lock may have been held by it
+        self._building = False
+        self._lock = threading.Lock()
+
+    def configure(
+        self, capacity: int, error_rate: float, journal_path: str
+    ) -> None:
+        """
+        Sets the filter size and journal, making the journal if needed. The
+        filters are rebuilt on next use.
+        """
+        if not 0 < error_rate < 1:
+            raise ValueError("Error rate must be between 0 and 1.")
+        with self._lock:
+            self.capacity = capacity
+            self.error_rate = error_rate
+            self.journal_path = journal_path
+            self._filters = None
+            self._close_journal()
+        if self.enabled:
+            self._open_journal()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0 and bool(self.journal_path)
+
+    def _open_journal(self) -> mmap.mmap:
+        # Every process opens its own, flock() locks are shared with the
+        # processes the descriptor is inherited by
+        if self._journal is None or self._pid != os.getpid():
+            fd = os.open(self.journal_path, os.O_RDWR | os.O_CREAT, 0o666)
+            if os.fstat(fd).st_size < JOURNAL_SIZE:
+                os.ftruncate(fd, JOURNAL_SIZE)
+            self._journal = mmap.mmap(fd, JOURNAL_SIZE)
+            self._journal_fd = fd
+            self._pid = os.getpid()
+        return self._journal
+
+    def _close_journal(self) -> None:
+        if self._journal is not None and self._pid == os.getpid():
+            self._journal.close()
+            os.close(self._journal_fd)
+        self._journal = None
+        self._journal_fd = None
+
+    @contextmanager
+    def _locked_journal(self) -> Iterator[mmap.mmap]:
+        journal = self._open_journal()
+        fcntl.flock(self._journal_fd, fcntl.LOCK_EX)
+        try:
+            yield journal
+        finally:
+            fcntl.flock(self._journal_fd, fcntl.LOCK_UN)
+
+    def _journal_sequence(self) -> int:
+        return struct.unpack_from(
+            SEQUENCE_FORMAT, self._open_journal(), 0
+        )[0]
+
+    def add_filename(self, fs_filename: str) -> None:
+        """
+        Records a stored filename, for every process.
+
+        :param fs_filename: Filename of the file stored in-server.
+        """
+        self._add(FILENAME_KIND, fs_filename)
+
+    def add_short_name(self, short_name: int) -> None:
+        """
+        Records a handed out short name, for every process.
+
+        :param short_name: Number of the short name.
+        """
+        self._add(SHORT_NAME_KIND, str(short_name))
+
+    def _add(self, kind: int, name: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock, self._locked_journal() as journal:
+            sequence = struct.unpack_from(SEQUENCE_FORMAT, journal, 0)[0]
+            struct.pack_into(
+                ENTRY_FORMAT,
+                journal,
+                SEQUENCE_SIZE + ENTRY_SIZE * (sequence % JOURNAL_ENTRIES),
+                kind,
+                BloomFilter.digest(name),
+            )
+            # Published once the entry is complete
+            struct.pack_into(SEQUENCE_FORMAT, journal, 0, sequence + 1)
+
+    def may_exist(self, fs_filename: str) -> bool:
+        """
+        Tells whether a file may be stored by the given name. Must be called
+        within an application context, whose app builds the filters.
+
+        :param fs_filename: Filename of the file stored in-server.
+        :return: False if the file is surely not stored.
+        """
+        return self._may_contain(FILENAME_KIND, fs_filename)
+
+    def may_be_shortened(self, short_name: str) -> bool:
+        """
+        Tells whether a short name may have been handed out. Must be called
+        within an application context, whose app builds the filters.
+
+        :param short_name: Short name, as looked up.
+        :return: False if the short name surely wasn't handed out.
+        """
+        # Short names are numbers, leave anything else to the database
+        if not (short_name.isascii() and short_name.isdigit()):
+            return True
+        return self._may_contain(SHORT_NAME_KIND, str(int(short_name)))
+
+    def false_positive(self) -> None:
+        """
+        Records a name let through which turned out not to exist.
+        """
+        self.false_positives += 1
+
+    def _may_contain(self, kind: int, name: str) -> bool:
+        if not self.enabled:
+            return True
+        digest = BloomFilter.digest(name)
+        filters = self._filters
+        if filters is not None and digest in filters[kind]:
+            return True
+        # Names stored by other processes may be missing, catch up first
+        with self._lock:
+            if self._filters is not None:
+                self._replay()
+            if self._filters is None:
+                # Being built, anything may exist until then
+                self._start_build()
+                return True
+            found = digest in self._filters[kind]
+        if not found:
+            self.negatives += 1
+        return found
+
+    def _replay(self) -> None:
+        sequence = self._journal_sequence()
+        missed = sequence - self._sequence
+        if missed == 0:
+            return
+        elif not 0 < missed <= JOURNAL_ENTRIES:
+            # Overwritten already, or a new journal
+            self._filters = None
+            return
+        journal = self._open_journal()
+        for i in range(self._sequence, sequence):
+            kind, digest = struct.unpack_from(
+                ENTRY_FORMAT,
+                journal,
+                SEQUENCE_SIZE + ENTRY_SIZE * (i % JOURNAL_ENTRIES),
+            )
+            self._filters[kind].add(digest)
+        # Entries may have been overwritten while being read
+        if self._journal_sequence() - self._sequence > JOURNAL_ENTRIES:
+            self._filters = None
+            return
+        self._sequence = sequence
+        if any(f.count > f.capacity for f in self._filters.values()):
+            # Still free of false negatives, only less selective
+            self._start_build()
+
+    def _start_build(self) -> None:
+        if self._building:
+            return
+        self._building = True
+        # Anything stored from here on is replayed from the journal, and was
+        # indexed before being journaled
+        sequence = self._journal_sequence()
+        threading.Thread(
+            target=self._build,
+            args=(current_app._get_current_object(), sequence),
+            name="itoko-lookup-filter",
+            daemon=True,
+        ).start()
+
+    def _build(self, app: Flask, sequence: int) -> None:
+        try:
+            with app.app_context():
+                filters = {
+                    kind: self._new_filter(table)
+                    for kind, table in (
+                        (FILENAME_KIND, "files"),
+                        (SHORT_NAME_KIND, "shortened"),
+                    )
+                }
+                for record in FileIndex(db):
+                    filters[FILENAME_KIND].add(
+                        BloomFilter.digest(record.fs_filename)
+                    )
+                for row in db.query("SELECT short_name FROM shortened"):
+                    filters[SHORT_NAME_KIND].add(
+                        BloomFilter.digest(str(row["short_name"]))
+                    )
+        except Exception:
+            app.logger.exception("Failed to build the lookup filters.")
+            with self._lock:
+                self._building = False
+            return
+        with self._lock:
+            self._filters = filters
+            self._sequence = sequence
+            self._building = False
+            self.rebuilds += 1
+
+    def _new_filter(self, table: str) -> BloomFilter:
+        count = db.query(
+            "SELECT COUNT(*) AS count FROM {}".format(table), one=True
+        )["count"]
+        # Room to grow before being built again
+        return BloomFilter(max(self.capacity, 2 * count), self.error_rate)
+
+    def stats(self) -> dict:
+        """
+        Returns the filter counters of this process, with the memory taken
+        by the filters and their false positive rates, as expected from
+        their fill and as seen on lookups.
+        """
+        filters = self._filters or {}
+        checked = self.negatives + self.false_positives
+        return dict(
+            enabled=self.enabled,
+            filenames=(
+                filters[FILENAME_KIND].count if filters else 0
+            ),
+            short_names=(
+                filters[SHORT_NAME_KIND].count if filters else 0
+            ),
+            memory=sum(len(f.bits) for f in filters.values()),
+            expected_error_rate=max(
+                (f.error_rate for f in filters.values()), default=0.0
+            ),
+            negatives=self.negatives,
+            false_positives=self.false_positives,
+            error_rate=self.false_positives / checked if checked else 0.0,
+            rebuilds=self.rebuilds,
+        )
+
+
+lookup_filter = LookupFilter()
@@ -1,6 +1,7 @@
 from typing import Optional
 
 from itoko.db import db
+from itoko.lookup import lookup_filter
 
 
 def shorten_filename(filename: str) -> str:
@@ -11,6 +12,7 @@ def shorten_filename(filename: str) -> str:
         one=True,
     )
     short_name = result["short_name"]
+    lookup_filter.add_short_name(short_name)
     return f"{short_name:03d}"
 
 
@@ -23,3 +25,7 @@ def find_shortened(short_name: str) -> Optional[str]:
     if not result:
         return None
     return result["filename"]
+
+
+def remove_shortened(filename: str) -> None:
+    db.execute("DELETE FROM shortened WHERE filename = ?", (filename,))
@@ -0,0 +1,29 @@
+"""
+Registry of runtime counters, so caches and other per-process structures can
+be sized from live data. Counters are per process, as are the structures they
+describe.
+"""
+from typing import Callable, Dict
+
+__all__ = ["register_stats", "collect_stats"]
+
+_collectors: Dict[str, Callable[[], dict]] = {}
+
+
+def register_stats(name: str, collector: Callable[[], dict]) -> None:
+    """
+    Registers a function returning the counters of a component.
+
+    :param name: Name the counters are reported under.
+    :param collector: Function returning a dict of counters.
+    """
+    _collectors[name] = collector
+
+
+def collect_stats() -> Dict[str, dict]:
+    """
+    Collects the counters of every registered component.
+
+    :return: Counters of each component by name.
+    """
+    return {name: collector() for name, collector in _collectors.items()}
@@ -0,0 +1,188 @@
+"""
+Background maintenance tasks. A task does a bounded amount of work per step,
+so it can be run every so often by the in-process scheduler without hogging
+the disk, or stepped through in a loop by a console script.
+"""
+import fcntl
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+from flask import Flask
+
+__all__ = ["Task", "TaskRunner"]
+
+# Seconds between attempts of a runner to take over from the running one
+LEADER_RETRY_INTERVAL = 5.0
+
+
+class Task(ABC):
+    """
+    Maintenance job split in steps, which keeps its own progress between them.
+    """
+
+    __slots__ = ()
+
+    name: str = None
+
+    @abstractmethod
+    def step(self) -> bool:
+        """
+        Does a bounded amount of work, resuming from where the previous step
+        left off.
+
+        :return: Boolean indicating whether a full pass was completed.
+        """
+        raise NotImplementedError
+
+
+class TaskRunner:
+    """
+    Runs tasks in a daemon thread of the app process, each step in its own
+    application context and every task at its own interval. A failing step is
+    logged and retried at the next interval.
+
+    Threads don't survive a fork, so the thread belongs to the process which
+    started it, and starting the runner again in a forked process starts a
+    new thread there.
+
+    Given a lock file, runners of every process sharing it elect a single one
+    through an exclusive flock() on it. The others wait, trying to take over
+    every so often, which they do once the process holding the lock exits.
+    """
+
+    __slots__ = (
+        "app",
+        "lock_path",
+        "_tasks",
+        "_thread",
+        "_stop",
+        "_lock",
+        "_lock_fd",
+    )
+
+    app: Flask
+    lock_path: Optional[str]
+
+    _thread: Optional[threading.Thread]
+    _lock_fd: Optional[int]
+
+    def __init__(self, app: Flask, lock_path: str = None) -> None:
+        """
+        :param app: App whose context tasks are run in.
+        :param lock_path: File locked by the one runner running tasks among
+                          the processes sharing it, or None to always run
+                          them.
+        """
+        self.app = app
+        self.lock_path = lock_path
+        self._tasks: List[list] = []
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # Whatever the parent had is gone, the lock may even have been held
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # Our copy of the descriptor would keep the parent's flock() alive
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    @property
+    def leader(self) -> bool:
+        """
+        Whether the runner of this process is the one running tasks.
+        """
+        return self._lock_fd is not None or (
+            self.lock_path is None and self._thread is not None
+        )
+
+    def add(self, task: Task, interval: float) -> None:
+        """
+        Schedules a task.
+
+        :param task: Task to run.
+        :param interval: Seconds between the steps of the task.
+        """
+        self._tasks.append([task, interval, 0.0])
+
+    def start(self) -> None:
+        """
+        Starts the scheduler thread of the current process, if not running
+        yet. Cheap enough to be called before every request.
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="itoko-tasks", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Stops the scheduler thread once the running step is done.
+
+        :param timeout: Seconds to wait for the thread, None waits forever.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+            if self._lock_fd is not None:
+                # Closing releases the flock(), another runner takes over
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    def _elect(self) -> bool:
+        if self.lock_path is None or self._lock_fd is not None:
+            return True
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Held until the process exits or the runner is stopped
+        self._lock_fd = fd
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                elected = self._elect()
+            except OSError:
+                self.app.logger.exception("Failed to lock %s.", self.lock_path)
+                elected = False
+            if not elected:
+                self._stop.wait(LEADER_RETRY_INTERVAL)
+                continue
+            now = time.monotonic()
+            for entry in self._tasks:
+                task, interval, due = entry
+                if due > now:
+                    continue
+                try:
+                    with self.app.app_context():
+                        task.step()
+                except Exception:
+                    self.app.logger.exception(
+                        "Task %s failed.", task.name or type(task).__name__
+                    )
+                entry[2] = time.monotonic() + interval
+            if not self._tasks:
+                return
+            next_due = min(due for _, _, due in self._tasks)
+            self._stop.wait(max(next_due - time.monotonic(), 0))
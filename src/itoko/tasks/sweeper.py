@@ -0,0 +1,132 @@
+"""
+Expiry sweeper for the temporary storage folder. Files are expired once
+their last modification, which for stored files is their upload, is older
+than the configured TTL.
+
+The folder is walked with a single scandir pass kept open between steps, so
+each step resumes where the previous one stopped and only looks at a batch
+of entries. Spacing out the steps spreads the deletions over time instead of
+hitting the disk with a whole folder at once. The pass only lives in memory,
+as the folder is listed in no particular order: a restarted process, or one
+taking over the tasks, starts a new pass from the start.
+"""
+import time
+from typing import Iterator, Optional
+
+from flask import current_app
+
+from itoko.api import get_storage
+from itoko.fs.backends import ObjectEntry
+from itoko.fs.storage import FSStorageType, FSStorage
+from itoko.shorten import remove_shortened
+from itoko.tasks import Task
+
+__all__ = ["ExpirySweeper", "make_sweeper"]
+
+
+class ExpirySweeper(Task):
+    """
+    Deletes temporary files older than a TTL, along with their index records
+    and the shortened filenames pointing at them.
+    """
+
+    __slots__ = (
+        "fs",
+        "ttl",
+        "batch_size",
+        "scanned",
+        "removed",
+        "passes",
+        "_cursor",
+    )
+
+    name = "sweeper"
+
+    fs: FSStorage
+    ttl: float
+    batch_size: int
+    scanned: int
+    removed: int
+    passes: int
+
+    _cursor: Optional[Iterator[ObjectEntry]]
+
+    def __init__(self, fs: FSStorage, ttl: float, batch_size: int = 100):
+        """
+        :param fs: Storage handler whose temporary folder is swept.
+        :param ttl: Seconds temporary files are kept for.
+        :param batch_size: Amount of folder entries looked at per step.
+        """
+        if fs.backend.is_shared():
+            # Permanent files would be swept along with temporary ones
+            raise ValueError(
+                "Temporary and permanent storage share a location, refusing "
+                "to sweep it."
+            )
+        self.fs = fs
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.scanned = 0
+        self.removed = 0
+        self.passes = 0
+        self._cursor = None
+
+    def step(self) -> bool:
+        """
+        Looks at the next batch of entries in the temporary folder, deleting
+        the expired ones. A new pass over the folder is started once the
+        current one is exhausted.
+
+        :return: Boolean indicating whether the current pass was completed.
+        """
+        if self._cursor is None:
+            self._cursor = self.fs.scan(FSStorageType.TEMPORARY_STORAGE)
+        expires_before = time.time() - self.ttl
+        for _ in range(self.batch_size):
+            entry = next(self._cursor, None)
+            if entry is None:
+                self._cursor = None
+                self.passes += 1
+                return True
+            self.scanned += 1
+            try:
+                if entry.stat().st_mtime >= expires_before:
+                    continue
+            except FileNotFoundError:
+                # Removed since the folder was listed
+                continue
+            self._remove(entry.name)
+        return False
+
+    def _remove(self, filename: str) -> None:
+        try:
+            self.fs.remove(FSStorageType.TEMPORARY_STORAGE, filename)
+        except FileNotFoundError:
+            pass
+        remove_shortened(filename)
+        self.removed += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the sweeper counters.
+        """
+        return dict(
+            ttl=self.ttl,
+            scanned=self.scanned,
+            removed=self.removed,
+            passes=self.passes,
+        )
+
+
+def make_sweeper() -> ExpirySweeper:
+    """
+    Builds the expiry sweeper from the current app configuration.
+
+    :return: Expiry sweeper.
+    """
+    tasks_cfg = current_app.config["ITOKO_TASKS"]
+    return ExpirySweeper(
+        get_storage(),
+        ttl=tasks_cfg["temporary_ttl"],
+        batch_size=tasks_cfg["sweep_batch_size"],
+    )
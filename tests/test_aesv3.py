@@ -0,0 +1,73 @@
+import os
+import struct
+
+import pytest
+
+from itoko.crypto.exc import DecryptionError
+from itoko.crypto.suite.aesv3 import AESv3Suite
+from itoko.fs.payload import BytesPayload
+
+CHUNK_SIZE = 1024
+DATA = os.urandom(10 * CHUNK_SIZE + 100)
+# Every stored chunk is its HMAC followed by its ciphertext
+STORED_CHUNK = AESv3Suite.TAG_SIZE + CHUNK_SIZE
+LENGTH_OFFSET = struct.calcsize("!H6x16s16sI4x")
+
+
+@pytest.fixture(scope="module")
+def bundle():
+    return AESv3Suite(b"key", chunk_size=CHUNK_SIZE).encrypt(DATA)
+
+
+def chunk_at(index):
+    return AESv3Suite.HEADER_SIZE + index * STORED_CHUNK
+
+
+def read(bundle, start, end):
+    view = AESv3Suite(b"key").open(BytesPayload(bytes(bundle)))
+    return view.read(start, end)
+
+
+def test_ranged_reads(bundle):
+    for start, end in ((0, 1), (1000, 3000), (len(DATA) - 50, len(DATA))):
+        assert read(bundle, start, end) == DATA[start:end]
+
+
+def test_tampered_chunk(bundle):
+    tampered = bytearray(bundle)
+    tampered[chunk_at(3) + AESv3Suite.TAG_SIZE + 10] ^= 1
+    with pytest.raises(DecryptionError):
+        read(tampered, 3 * CHUNK_SIZE, 3 * CHUNK_SIZE + 10)
+    # Other chunks are verified on their own and still readable
+    assert read(tampered, 0, CHUNK_SIZE) == DATA[:CHUNK_SIZE]
+
+
+def test_swapped_chunks(bundle):
+    swapped = bytearray(bundle)
+    second, third = chunk_at(2), chunk_at(3)
+    swapped[second:third], swapped[third:third + STORED_CHUNK] = (
+        bundle[third:third + STORED_CHUNK],
+        bundle[second:third],
+    )
+    with pytest.raises(DecryptionError):
+        read(swapped, 2 * CHUNK_SIZE, 2 * CHUNK_SIZE + 10)
+    with pytest.raises(DecryptionError):
+        read(swapped, 3 * CHUNK_SIZE, 3 * CHUNK_SIZE + 10)
+
+
+def test_truncated_final_chunk(bundle):
+    with pytest.raises(DecryptionError):
+        read(bundle[:-10], len(DATA) - 50, len(DATA))
+
+
+def test_dropped_final_chunk(bundle):
+    with pytest.raises(DecryptionError):
+        read(bundle[: chunk_at(10)], len(DATA) - 50, len(DATA))
+
+
+def test_altered_length(bundle):
+    for length in (len(DATA) - 100, len(DATA) + CHUNK_SIZE):
+        altered = bytearray(bundle)
+        altered[LENGTH_OFFSET:LENGTH_OFFSET + 8] = struct.pack("!Q", length)
+        with pytest.raises(DecryptionError):
+            read(altered, 0, 10)
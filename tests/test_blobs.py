@@ -0,0 +1,101 @@
+import hashlib
+import io
+import os
+
+import pytest
+from flask import Flask
+
+from itoko.db import db, init_db
+from itoko.fs.backends import FSStorageType
+from itoko.fs.backends.memory import MemoryBackend
+from itoko.fs.blobs import BlobStore
+from itoko.fs.format.v2 import ItokoV2FormatFile, ItokoV2FormatReader
+from itoko.fs.index import FileIndex
+from itoko.fs.storage import FSStorage
+
+ST = FSStorageType.TEMPORARY_STORAGE
+DATA = os.urandom(100000)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture
+def fs(tmp_path):
+    app = Flask(__name__)
+    app.config["SQLITE3_DATABASE"] = str(tmp_path / "itoko.db")
+    db.init_app(app)
+    with app.app_context():
+        init_db()
+        yield FSStorage(
+            backend=MemoryBackend(),
+            readers=[ItokoV2FormatReader()],
+            index=FileIndex(db),
+            blobs=BlobStore(str(tmp_path / "blobs"), db),
+        )
+
+
+def store(fs, name, data=DATA):
+    fs.write_stream(
+        ST, name, ItokoV2FormatFile, io.BytesIO(data), filename="a.bin"
+    )
+
+
+def refs(digest=DIGEST):
+    row = db.query(
+        "SELECT refs FROM blobs WHERE digest = ?", (digest,), one=True
+    )
+    return row["refs"] if row is not None else 0
+
+
+def blob_count(fs):
+    return db.query("SELECT COUNT(*) AS n FROM blobs", one=True)["n"]
+
+
+def test_shared_blob_outlives_references(fs):
+    store(fs, "a")
+    store(fs, "b")
+    assert refs() == 2
+    fs.remove(ST, "b")
+    assert refs() == 1
+    assert bytes(fs.read(ST, "a").payload) == DATA
+    fs.remove(ST, "a")
+    assert blob_count(fs) == 0
+    assert not os.path.exists(fs.blobs.path(DIGEST))
+
+
+def test_failed_reference_write_releases(fs):
+    store(fs, "a")
+    # Same contents, the reference taken is given back
+    with pytest.raises(FileExistsError):
+        store(fs, "a")
+    assert refs() == 1
+    # New contents, the blob made for them goes away again
+    with pytest.raises(FileExistsError):
+        store(fs, "a", os.urandom(1000))
+    assert blob_count(fs) == 1
+
+
+def test_concurrent_remove_releases_once(fs, monkeypatch):
+    store(fs, "a")
+    store(fs, "b")
+    other = FSStorage(
+        backend=fs.backend,
+        readers=fs.readers,
+        index=fs.index,
+        blobs=fs.blobs,
+    )
+    read_reference = FSStorage._read_reference
+
+    def racing_read_reference(self, st, filename):
+        reference = read_reference(self, st, filename)
+        if self is fs:
+            # Another process removes the file in between
+            other.remove(st, filename)
+        return reference
+
+    monkeypatch.setattr(
+        FSStorage, "_read_reference", racing_read_reference
+    )
+    with pytest.raises(FileNotFoundError):
+        fs.remove(ST, "b")
+    assert refs() == 1
+    assert bytes(fs.read(ST, "a").payload) == DATA
@@ -0,0 +1,113 @@
+import os
+import subprocess
+import sys
+
+from itoko.fs.format.v2 import ItokoV2FormatFile
+
+DATA = os.urandom(300 * 1024 + 7)
+
+
+def run(tool, *args, cwd, **kwargs):
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    return subprocess.run(
+        [sys.executable, "-m", "itoko.cmd." + tool, *args],
+        cwd=cwd,
+        stderr=subprocess.PIPE,
+        **kwargs,
+    )
+
+
+def test_bare_output_filename(tmp_path):
+    (tmp_path / "a.bin").write_bytes(DATA)
+    r = run("encrypt", "a.bin", "k1", "-o", "a.itk", cwd=tmp_path)
+    assert r.returncode == 0, r.stderr
+    r = run("decrypt", "a.itk", "k1", "-o", "a.out", cwd=tmp_path)
+    assert r.returncode == 0, r.stderr
+    assert (tmp_path / "a.out").read_bytes() == DATA
+    assert sorted(os.listdir(tmp_path)) == ["a.bin", "a.itk", "a.out"]
+
+
+def test_stdin_to_stdout(tmp_path):
+    r = run("encrypt", "-", "k1", "--name", "x.bin", cwd=tmp_path, input=DATA)
+    assert r.returncode == 0, r.stderr
+    file = ItokoV2FormatFile.read("x", r.stdout).decrypt(b"k1")
+    assert file.filename == "x.bin"
+    assert bytes(file.payload) == DATA
+    r = run("decrypt", "-", "k1", cwd=tmp_path, input=r.stdout)
+    assert r.returncode == 0, r.stderr
+    assert r.stdout == DATA
+
+
+def test_redirected_stdout(tmp_path):
+    (tmp_path / "a.bin").write_bytes(DATA)
+    for mode in ("wb", "ab"):
+        with open(tmp_path / "a.itk", mode) as out:
+            r = run("encrypt", "a.bin", "k1", cwd=tmp_path, stdout=out)
+        assert r.returncode == 0, r.stderr
+        with open(tmp_path / "a.itk", "rb") as inp:
+            r = run("decrypt", "-", "k1", cwd=tmp_path, stdin=inp)
+        assert r.stdout == DATA
+        (tmp_path / "a.itk").unlink()
+
+
+def test_wrong_key_leaves_no_output(tmp_path):
+    (tmp_path / "a.bin").write_bytes(DATA)
+    run("encrypt", "a.bin", "k1", "-o", "a.itk", cwd=tmp_path)
+    r = run("decrypt", "a.itk", "k2", "-o", "a.out", cwd=tmp_path)
+    assert r.returncode == 1
+    assert b"wrong key" in r.stderr
+    assert sorted(os.listdir(tmp_path)) == ["a.bin", "a.itk"]
+
+
+def test_batch_folder(tmp_path):
+    source = tmp_path / "in"
+    (source / "sub").mkdir(parents=True)
+    files = {
+        "a": os.urandom(1000),
+        os.path.join("sub", "b"): os.urandom(70000),
+        "empty": b"",
+    }
+    for name, data in files.items():
+        (source / name).write_bytes(data)
+    # Files being written are left out
+    (source / ".c.part").write_bytes(b"x")
+    r = run("encrypt", "in", "k1", "-o", "enc", cwd=tmp_path)
+    assert r.returncode == 0, r.stderr
+    r = run("decrypt", "enc", "k1", "-o", "dec", cwd=tmp_path)
+    assert r.returncode == 0, r.stderr
+    for name, data in files.items():
+        assert (tmp_path / "dec" / name).read_bytes() == data
+    assert not (tmp_path / "dec" / ".c.part").exists()
+
+
+def test_batch_manifest(tmp_path):
+    lines = []
+    for i in range(4):
+        key = "key{}".format(i)
+        file = ItokoV2FormatFile(
+            payload=DATA[i:],
+            fs_filename="f{}".format(i),
+            filename="f.bin",
+            mime_type="application/octet-stream",
+        ).encrypt(key.encode("utf-8"))
+        (tmp_path / "f{}".format(i)).write_bytes(file.file)
+        lines.append("f{}\t{}".format(i, "wrong" if i == 3 else key))
+    lines.append("missing\tkey")
+    (tmp_path / "manifest").write_text("\n".join(lines) + "\n")
+    r = run("decrypt", "manifest", "--manifest", "-o", "out", cwd=tmp_path)
+    assert r.returncode == 1
+    errors = r.stderr.decode("utf-8").splitlines()[:-1]
+    assert sorted(line.split(":")[0] for line in errors) == ["f3", "missing"]
+    for i in range(3):
+        assert (tmp_path / "out" / "f{}".format(i)).read_bytes() == DATA[i:]
+    assert not (tmp_path / "out" / "f3").exists()
+    # Outputs already there are never overwritten
+    r = run("decrypt", "manifest", "--manifest", "-o", "out", cwd=tmp_path)
+    assert r.returncode == 1
+    assert b"FileExistsError" in r.stderr
+
+
+def test_batch_needs_output_folder(tmp_path):
+    (tmp_path / "in").mkdir()
+    r = run("encrypt", "in", "k1", cwd=tmp_path)
+    assert r.returncode == 2
@@ -0,0 +1,118 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from itoko import make_app
+from itoko.api import get_storage
+from itoko.cmd.reindex import reindex
+from itoko.crypto.exc import DecryptionError
+from itoko.crypto.suite.aesv2 import AESv2Suite
+from itoko.fs.format.v2 import ItokoV2FormatFile
+
+DATA = os.urandom(10000)
+
+CONFIG = """
+SQLITE3_DATABASE = "{folder}/itoko.db"
+
+[ITOKO_STORAGE]
+temporary_folder = "{folder}/temp"
+permanent_folder = "{folder}/perm"
+writer = "itoko.fs.format.v2:ItokoV2FormatFile"
+readers = ["itoko.fs.format.v2:ItokoV2FormatReader"]
+"""
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    for name in ("temp", "perm"):
+        (tmp_path / name).mkdir()
+    config = tmp_path / "config.toml"
+    config.write_text(CONFIG.format(folder=tmp_path))
+    monkeypatch.setenv("ITOKO_CONFIG", str(config))
+    file = ItokoV2FormatFile(
+        payload=DATA,
+        fs_filename="plain",
+        filename="a.bin",
+        mime_type="application/octet-stream",
+    )
+    (tmp_path / "perm" / "plain").write_bytes(file.file)
+    (tmp_path / "perm" / "enc").write_bytes(file.encrypt(b"k").file)
+    return make_app().test_client()
+
+
+def test_unencrypted_etag_is_weak(client):
+    r = client.get("/u/plain")
+    etag = r.headers["ETag"]
+    assert etag.startswith("W/")
+    r = client.get("/u/plain", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    # Weak tags never validate byte ranges
+    r = client.get(
+        "/u/plain", headers={"Range": "bytes=0-9", "If-Range": etag[2:]}
+    )
+    assert r.status_code == 200
+    assert r.data == DATA
+
+
+def test_encrypted_etag_is_strong(client):
+    r = client.get("/u/enc?key=k")
+    etag = r.headers["ETag"]
+    assert etag.startswith('"')
+    r = client.get(
+        "/u/enc?key=k", headers={"Range": "bytes=0-9", "If-Range": etag}
+    )
+    assert r.status_code == 206
+    assert r.data == DATA[:10]
+
+
+def upload(client, data):
+    r = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(data), "b.bin")},
+        headers={"Accept": "application/json"},
+    )
+    return r.get_json()["url"].split("/u/")[1]
+
+
+def test_stored_etag_is_strong(client):
+    name = upload(client, DATA)
+    r = client.get("/u/" + name)
+    etag = r.headers["ETag"]
+    assert etag.startswith('"')
+    r = client.get(
+        "/u/" + name, headers={"Range": "bytes=0-9", "If-Range": etag}
+    )
+    assert r.status_code == 206
+    assert r.data == DATA[:10]
+    # Same contents stored again get the digest, not the same tag
+    other = upload(client, DATA)
+    assert client.get("/u/" + other).headers["ETag"] != etag
+    with client.application.app_context():
+        record = get_storage().index.get(name)
+    assert record.digest == hashlib.sha256(DATA).hexdigest()
+
+
+def test_reindex_keeps_digest(client):
+    name = upload(client, DATA)
+    etag = client.get("/u/" + name).headers["ETag"]
+    with client.application.app_context():
+        reindex()
+    assert client.get("/u/" + name).headers["ETag"] == etag
+
+
+def test_encrypted_head_skips_verification(client, monkeypatch):
+    def fail(*args):
+        raise DecryptionError
+
+    monkeypatch.setattr(AESv2Suite, "_verify", staticmethod(fail))
+    r = client.head("/u/enc?key=k")
+    assert r.status_code == 200
+    assert r.headers["Content-Length"] == str(len(DATA))
+    assert r.headers["Content-Type"] == "application/octet-stream"
+    assert "a.bin" in r.headers["Content-Disposition"]
+    # Wrong keys garble the headers, which don't parse
+    assert client.head("/u/enc?key=x").status_code == 403
+    # Downloads still verify
+    assert client.get("/u/enc?key=k").status_code == 403
@@ -0,0 +1,87 @@
+import os
+
+from itoko.fs import cache
+from itoko.fs.backends import ObjectStat
+from itoko.fs.cache import HotFileCache
+from itoko.fs.format.v2 import ItokoV2FormatFile
+from itoko.fs.payload import BytesPayload
+
+
+def stored(name, size=1000):
+    file = ItokoV2FormatFile(
+        payload=os.urandom(size),
+        fs_filename=name,
+        filename=name + ".bin",
+        mime_type="application/octet-stream",
+    )
+    return (
+        ItokoV2FormatFile.open(name, BytesPayload(file.file)),
+        ObjectStat(len(file.file), 1),
+    )
+
+
+def test_cached_on_second_miss(tmp_path):
+    hot = HotFileCache(str(tmp_path), 100000, 10000)
+    file, stat = stored("a")
+    assert not hot.put("a", file, stat)
+    assert hot.get("a") is None
+    assert hot.put("a", file, stat)
+    cached, cached_stat = hot.get("a")
+    assert cached.view.read() == file.view.read()
+    assert cached_stat == stat
+    assert hot.rejections == 1 and hot.fills == 1
+
+
+def test_misses_fade_with_aging(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "SKETCH_SAMPLE", 4)
+    hot = HotFileCache(str(tmp_path), 100000, 10000, admission_misses=3)
+    file, stat = stored("a")
+    assert not hot.put("a", file, stat)
+    assert not hot.put("a", file, stat)
+    # Other misses halve the counters, 2 misses go down to 1
+    for name in "bc":
+        hot.put(name, *stored(name))
+    assert not hot.put("a", file, stat)
+    assert hot.put("a", file, stat)
+
+
+def test_evicts_in_batches_to_low_watermark(tmp_path, monkeypatch):
+    batches = []
+    evict = HotFileCache._evict
+
+    def counted(self, state, size):
+        batches.append(size)
+        evict(self, state, size)
+
+    monkeypatch.setattr(HotFileCache, "_evict", counted)
+    hot = HotFileCache(str(tmp_path), 10000, 2000)
+    names = [str(i) for i in range(20)]
+    for i, name in enumerate(names):
+        file, stat = stored(name)
+        hot.put(name, file, stat)
+        hot.put(name, file, stat)
+        # Oldest first by modification time
+        os.utime(hot._path(hot._digest(name)), ns=(i, i))
+    sizes = [entry.stat().st_size for entry in hot._scan()]
+    assert sum(sizes) <= 10000
+    assert hot._size(hot._open_state()) == sum(sizes)
+    # Folder scans only happen once over budget, each freeing a quarter
+    assert hot.fills == 20 and 0 < len(batches) <= 20 // 2
+    assert hot.get(names[-1]) is not None
+    assert hot.get(names[0]) is None
+
+
+def test_invalidation_is_accounted(tmp_path):
+    hot = HotFileCache(str(tmp_path), 100000, 10000)
+    for name in "ab":
+        file, stat = stored(name)
+        hot.put(name, file, stat)
+        hot.put(name, file, stat)
+    before = hot._size(hot._open_state())
+    hot.invalidate("a")
+    assert hot.get("a") is None
+    remaining = [entry.stat().st_size for entry in hot._scan()]
+    assert hot._size(hot._open_state()) == sum(remaining) < before
+    # State is shared through the folder with other processes
+    other = HotFileCache(str(tmp_path), 100000, 10000)
+    assert other._size(other._open_state()) == sum(remaining)
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from itoko.crypto.kdf.cache import derived_key_cache
+from itoko.crypto.suite.aesgcm import AESGCMSuite
+from itoko.crypto.suite.aesv1 import AESv1Suite
+from itoko.crypto.suite.aesv2 import AESv2Suite
+from itoko.crypto.suite.aesv3 import AESv3Suite
+from itoko.fs.payload import BytesPayload
+
+DATA = os.urandom(10000)
+
+
+@pytest.fixture
+def cache():
+    derived_key_cache.configure(max_size=16, ttl=300)
+    yield derived_key_cache
+    derived_key_cache.clear()
+    derived_key_cache.configure(max_size=0, ttl=300)
+
+
+@pytest.mark.parametrize(
+    "suite", [AESv1Suite, AESv2Suite, AESGCMSuite, AESv3Suite]
+)
+def test_decryption_uses_cache(cache, suite):
+    bundle = suite(b"key").encrypt(DATA)
+    hits = cache.hits
+    assert bytes(suite(b"key").decrypt(bundle)) == DATA
+    assert cache.hits == hits
+    # Both the whole and the lazy path find the key derived before
+    assert bytes(suite(b"key").decrypt(bundle)) == DATA
+    assert bytes(suite(b"key").open(BytesPayload(bundle)).read()) == DATA
+    assert cache.hits == hits + 2
@@ -0,0 +1,97 @@
+import time
+
+import pytest
+from flask import Flask
+
+from itoko import lookup
+from itoko.db import db, init_db
+from itoko.fs.index import FileIndex, FileRecord
+from itoko.lookup import LookupFilter
+
+ENTRIES = 16
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    # A small journal, so it wraps around quickly
+    monkeypatch.setattr(lookup, "JOURNAL_ENTRIES", ENTRIES)
+    monkeypatch.setattr(
+        lookup,
+        "JOURNAL_SIZE",
+        lookup.SEQUENCE_SIZE + lookup.ENTRY_SIZE * ENTRIES,
+    )
+    app = Flask(__name__)
+    app.config["SQLITE3_DATABASE"] = str(tmp_path / "itoko.db")
+    db.init_app(app)
+    with app.app_context():
+        init_db()
+        yield str(tmp_path / "journal")
+
+
+def store(other, name):
+    # As FSStorage does, indexed first and journaled then
+    FileIndex(db).put(
+        FileRecord(
+            fs_filename=name,
+            storage_type=1,
+            size=1,
+            version=2,
+            suite_id=None,
+            is_encrypted=False,
+            filename="a.txt",
+            mime_type="text/plain",
+            created_at=time.time(),
+        )
+    )
+    other.add_filename(name)
+
+
+def built(f):
+    deadline = time.monotonic() + 10
+    while f._building or f._filters is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_no_false_negatives(journal):
+    # Two processes of a node, sharing the journal and the database
+    mine = LookupFilter(4, 0.01, journal)
+    other = LookupFilter(4, 0.01, journal)
+    names = ["before{}".format(i) for i in range(3)]
+    for name in names:
+        store(other, name)
+    # Nothing is turned down while the filters are built
+    assert mine.may_exist("missing")
+    built(mine)
+    assert not mine.may_exist("missing")
+    assert all(mine.may_exist(name) for name in names)
+    # Stored elsewhere since, replayed from the journal, past the capacity
+    # of the filters too
+    for i in range(8):
+        names.append("journaled{}".format(i))
+        store(other, names[-1])
+        assert mine.may_exist(names[-1])
+    built(mine)
+    # Stored elsewhere while the journal wrapped around
+    for i in range(3 * ENTRIES):
+        names.append("wrapped{}".format(i))
+        store(other, names[-1])
+    assert mine.may_exist(names[-1])
+    built(mine)
+    assert all(mine.may_exist(name) for name in names)
+    assert not mine.may_exist("missing")
+    assert mine.stats()["filenames"] >= len(names)
+
+
+def test_short_names(journal):
+    mine = LookupFilter(4, 0.01, journal)
+    other = LookupFilter(4, 0.01, journal)
+    db.execute("INSERT INTO shortened (filename) VALUES ('a')")
+    mine.may_be_shortened("1")
+    built(mine)
+    assert mine.may_be_shortened("001")
+    assert not mine.may_be_shortened("2")
+    other.add_short_name(2)
+    assert mine.may_be_shortened("2")
+    # Anything but a number is left to the database
+    assert mine.may_be_shortened("abc")
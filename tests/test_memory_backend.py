@@ -0,0 +1,74 @@
+import io
+import os
+
+import pytest
+
+from itoko.fs.backends import FSStorageType
+from itoko.fs.backends.memory import MemoryBackend
+from itoko.fs.format.v2 import ItokoV2FormatFile, ItokoV2FormatReader
+from itoko.fs.format.v3 import ItokoV3FormatFile, ItokoV3FormatReader
+from itoko.fs.storage import FSStorage
+
+ST = FSStorageType.TEMPORARY_STORAGE
+
+
+@pytest.fixture
+def fs():
+    return FSStorage(
+        backend=MemoryBackend(),
+        readers=[ItokoV2FormatReader(), ItokoV3FormatReader()],
+        compression="gzip",
+    )
+
+
+@pytest.mark.parametrize("writer", [ItokoV2FormatFile, ItokoV3FormatFile])
+def test_round_trip(fs, writer):
+    data = os.urandom(300000)
+    fs.write_stream(ST, "plain", writer, io.BytesIO(data), filename="a.bin")
+    fs.write_stream(
+        ST, "enc", writer, io.BytesIO(data), filename="b.bin", key=b"k"
+    )
+    file = fs.read(ST, "plain")
+    assert bytes(file.payload) == data
+    assert file.filename == "a.bin"
+    file = fs.open(ST, "enc")
+    try:
+        assert file.is_encrypted
+        assert file.decrypt(b"k").view.read(1000, 2000) == data[1000:2000]
+    finally:
+        file.close()
+
+
+def test_compressed(fs):
+    text = b"".join(b"line %d\n" % i for i in range(20000))
+    fs.write_stream(
+        ST, "t", ItokoV2FormatFile, io.BytesIO(text), filename="t.txt"
+    )
+    assert fs.stat(ST, "t").st_size < len(text) // 4
+    file = fs.open(ST, "t")
+    try:
+        assert file.encoding == "gzip"
+        assert file.view.read() == text
+    finally:
+        file.close()
+
+
+def test_create_scan_remove(fs):
+    backend = fs.backend
+    with backend.create(ST, "a") as f:
+        f.write(b"a")
+    with pytest.raises(FileExistsError):
+        with backend.create(ST, "a") as f:
+            f.write(b"b")
+    # Failed writes store nothing
+    with pytest.raises(RuntimeError):
+        with backend.create(ST, "b") as f:
+            f.write(b"b")
+            raise RuntimeError
+    assert [entry.name for entry in fs.scan(ST)] == ["a"]
+    assert list(fs.scan(FSStorageType.PERMANENT_STORAGE)) == []
+    assert fs.exists("a") == ST
+    fs.remove(ST, "a")
+    assert fs.exists("a") is None
+    with pytest.raises(FileNotFoundError):
+        fs.remove(ST, "a")
@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+from itoko.fs.mime import mime_sniffer
+
+PDF = b"%PDF-1.4\n"
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_sniff_after_fork_with_lock_held():
+    assert mime_sniffer.sniff(PDF) == "application/pdf"
+    # As if another thread was sniffing when the process forked
+    with mime_sniffer._lock:
+        pid = os.fork()
+        if pid == 0:
+            ok = mime_sniffer.sniff(PDF) == "application/pdf"
+            os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert mime_sniffer.sniff(PDF) == "application/pdf"
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from itoko.fs.backends import FSStorageType  # noqa: E402
+from itoko.fs.backends.s3 import MIN_PART_SIZE, S3Backend  # noqa: E402
+
+BUCKET = "itoko"
+ST = FSStorageType.PERMANENT_STORAGE
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    with moto.mock_aws():
+        backend = S3Backend(
+            BUCKET, part_size=MIN_PART_SIZE, region_name="us-east-1"
+        )
+        backend.client.create_bucket(Bucket=BUCKET)
+        yield backend
+
+
+def get_object(backend, filename):
+    return backend.client.get_object(
+        Bucket=BUCKET, Key=backend._key(ST, filename)
+    )
+
+
+def test_multipart_upload_patches_first_part(backend):
+    data = os.urandom(2 * MIN_PART_SIZE + 12345)
+    with backend.create(ST, "f") as f:
+        f.write(b"\0" * 8)
+        f.write(data)
+        end = f.tell()
+        # Formats backfill their headers once the payload is written
+        f.seek(0)
+        f.write(b"patched!")
+        f.seek(end)
+        f.write(b"tail")
+    response = get_object(backend, "f")
+    # Multipart ETags end in the part count
+    assert response["ETag"].strip('"').endswith("-3")
+    assert response["Body"].read() == b"patched!" + data + b"tail"
+    assert backend.stat(ST, "f").st_size == 8 + len(data) + 4
+
+
+def test_seek_past_first_part_fails(backend):
+    with pytest.raises(OSError):
+        with backend.create(ST, "f") as f:
+            f.write(os.urandom(2 * MIN_PART_SIZE))
+            f.seek(MIN_PART_SIZE + 1)
+    with pytest.raises(FileNotFoundError):
+        backend.stat(ST, "f")
+
+
+def test_create_refuses_to_overwrite(backend):
+    with backend.create(ST, "small") as f:
+        f.write(b"first")
+    with pytest.raises(FileExistsError):
+        with backend.create(ST, "small") as f:
+            f.write(b"second")
+    with backend.create(ST, "big") as f:
+        f.write(os.urandom(MIN_PART_SIZE + 1))
+    with pytest.raises(FileExistsError):
+        with backend.create(ST, "big") as f:
+            f.write(os.urandom(MIN_PART_SIZE + 1))
+    assert get_object(backend, "small")["Body"].read() == b"first"
+
+
+def test_empty_object(backend):
+    with backend.create(ST, "empty"):
+        pass
+    assert backend.stat(ST, "empty").st_size == 0
+    payload = backend.open(ST, "empty")
+    assert len(payload) == 0
+    assert payload.read() == b""
+
+
+def test_ranged_reads(backend):
+    data = os.urandom(100000)
+    with backend.create(ST, "f") as f:
+        f.write(data)
+    payload = backend.open(ST, "f")
+    assert len(payload) == len(data)
+    # Served from the prefetched head, then with ranged GETs
+    assert payload.read(10, 20) == data[10:20]
+    assert payload.read(5000, 90000) == data[5000:90000]
+    assert payload.slice(99990).read() == data[99990:]
+    with pytest.raises(FileNotFoundError):
+        backend.open(ST, "missing")
+
+
+def test_scan_and_remove(backend):
+    for name in ("a", "b"):
+        with backend.create(ST, name) as f:
+            f.write(name.encode("utf-8"))
+    with backend.create(FSStorageType.TEMPORARY_STORAGE, "c") as f:
+        f.write(b"c")
+    assert sorted(entry.name for entry in backend.scan(ST)) == ["a", "b"]
+    backend.remove(ST, "a")
+    assert [entry.name for entry in backend.scan(ST)] == ["b"]
+    with pytest.raises(FileNotFoundError):
+        backend.remove(ST, "a")
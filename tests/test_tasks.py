@@ -0,0 +1,81 @@
+import os
+import threading
+
+import pytest
+from flask import Flask
+
+from itoko import tasks
+from itoko.tasks import Task, TaskRunner
+
+
+class Counter(Task):
+    __slots__ = ("steps",)
+
+    def __init__(self):
+        self.steps = threading.Semaphore(0)
+
+    def step(self):
+        self.steps.release()
+        return True
+
+
+@pytest.fixture
+def runner():
+    runner = TaskRunner(Flask(__name__))
+    yield runner
+    runner.stop()
+
+
+def test_runner_steps_tasks(runner):
+    task = Counter()
+    runner.add(task, 0.01)
+    runner.start()
+    runner.start()
+    assert task.steps.acquire(timeout=5)
+    assert task.steps.acquire(timeout=5)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_runner_restarts_in_forked_process(runner):
+    task = Counter()
+    runner.add(task, 0.01)
+    runner.start()
+    assert task.steps.acquire(timeout=5)
+    # As if a request was starting it when the process forked
+    with runner._lock:
+        pid = os.fork()
+        if pid == 0:
+            # The thread of the parent isn't there, start one of our own
+            task.steps = threading.Semaphore(0)
+            runner.start()
+            ok = task.steps.acquire(timeout=5) and task.steps.acquire(
+                timeout=5
+            )
+            os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_single_runner_elected(tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, "LEADER_RETRY_INTERVAL", 0.01)
+    lock_path = str(tmp_path / "tasks.lock")
+    # Every runner opens the lock file on its own, as in different processes
+    leader = TaskRunner(Flask(__name__), lock_path=lock_path)
+    other = TaskRunner(Flask(__name__), lock_path=lock_path)
+    first, second = Counter(), Counter()
+    leader.add(first, 0.01)
+    other.add(second, 0.01)
+    try:
+        leader.start()
+        assert first.steps.acquire(timeout=5)
+        other.start()
+        assert not second.steps.acquire(timeout=0.2)
+        assert leader.leader
+        assert not other.leader
+        # The other one takes over once the leader is gone
+        leader.stop()
+        assert second.steps.acquire(timeout=5)
+        assert other.leader
+    finally:
+        leader.stop()
+        other.stop()
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from itoko.fs.format.v2 import (
+    ItokoV2FormatFile,
+    ItokoV2FormatReader,
+    ItokoV2GCMFormatFile,
+)
+from itoko.fs.payload import BytesPayload
+
+DATA = os.urandom(100 * 1024 + 5)
+
+
+@pytest.mark.parametrize(
+    "cls,generated_key,suite_id",
+    [
+        (ItokoV2FormatFile, False, 2),
+        (ItokoV2FormatFile, True, 4),
+        (ItokoV2GCMFormatFile, False, 6),
+        (ItokoV2GCMFormatFile, True, 7),
+    ],
+)
+def test_writer_suites(cls, generated_key, suite_id):
+    file = cls(
+        payload=DATA,
+        fs_filename="f",
+        filename="f.bin",
+        mime_type="application/octet-stream",
+    ).encrypt(b"key", generated_key=generated_key)
+    assert file.suite_id == suite_id
+    # Every suite is read back by the one v2 reader
+    stored = ItokoV2FormatReader().read("f", file.file)
+    assert bytes(stored.decrypt(b"key").payload) == DATA
+    opened = ItokoV2FormatReader().open("f", BytesPayload(file.file))
+    decrypted = opened.decrypt(b"key")
+    assert decrypted.filename == "f.bin"
+    assert bytes(decrypted.view.read(5, 1005)) == DATA[5:1005]
@@ -0,0 +1,25 @@
+import hashlib
+
+from itoko.crypto.hmac.cache import VerificationCache
+
+IDENTITY = ("dev", "ino", 1, 2)
+TAG = b"t" * 32
+
+
+def test_verified_with_same_key_only():
+    cache = VerificationCache()
+    cache.add(IDENTITY, TAG, b"k" * 32)
+    assert cache.is_verified(IDENTITY, TAG, b"k" * 32)
+    assert not cache.is_verified(IDENTITY, TAG, b"x" * 32)
+    assert not cache.is_verified(IDENTITY, b"u" * 32, b"k" * 32)
+
+
+def test_keys_are_not_stored_as_plain_hashes():
+    key = b"k" * 32
+    first, second = VerificationCache(), VerificationCache()
+    first.add(IDENTITY, TAG, key)
+    second.add(IDENTITY, TAG, key)
+    stored = first._entries[(IDENTITY, TAG)]
+    assert stored != hashlib.sha256(key).digest()
+    # Every process keys its hashes with its own secret
+    assert stored != second._entries[(IDENTITY, TAG)]
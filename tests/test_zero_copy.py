@@ -0,0 +1,122 @@
+import hashlib
+import io
+import mmap
+import os
+
+import pytest
+
+from itoko import make_app
+from itoko.fs.backends import FSStorageType
+from itoko.fs.backends.filesystem import FilesystemBackend
+from itoko.fs.format.v1 import ItokoV1FormatFile, ItokoV1FormatReader
+from itoko.fs.format.v2 import ItokoV2FormatFile, ItokoV2FormatReader
+from itoko.fs.format.v3 import ItokoV3FormatFile, ItokoV3FormatReader
+from itoko.fs.storage import FSStorage
+
+DATA = os.urandom(200 * 1024 + 3)
+
+CONFIG = """
+SQLITE3_DATABASE = "{folder}/itoko.db"
+
+[ITOKO_STORAGE]
+temporary_folder = "{folder}/temp"
+permanent_folder = "{folder}/perm"
+blob_folder = "{folder}/blobs"
+accel_redirect = "/_itoko/blobs/"
+writer = "itoko.fs.format.v2:ItokoV2FormatFile"
+readers = ["itoko.fs.format.v2:ItokoV2FormatReader"]
+"""
+
+FORMATS = [
+    (ItokoV1FormatFile, ItokoV1FormatReader),
+    (ItokoV2FormatFile, ItokoV2FormatReader),
+    (ItokoV3FormatFile, ItokoV3FormatReader),
+]
+
+
+def make_file(cls):
+    return cls(
+        payload=DATA,
+        fs_filename="f",
+        filename="f.bin",
+        mime_type="application/octet-stream",
+    ).file
+
+
+@pytest.fixture
+def fs(tmp_path):
+    return FSStorage(
+        backend=FilesystemBackend(
+            str(tmp_path / "temp"), str(tmp_path / "perm")
+        ),
+        readers=[reader() for _, reader in FORMATS],
+    )
+
+
+@pytest.mark.parametrize("cls,reader", FORMATS)
+def test_read_maps_payload(fs, cls, reader):
+    os.makedirs(fs.backend.permanent_folder)
+    path = os.path.join(fs.backend.permanent_folder, "f")
+    with open(path, "wb") as f:
+        f.write(make_file(cls))
+    file = fs.read(FSStorageType.PERMANENT_STORAGE, "f")
+    assert isinstance(file, cls)
+    payload = file.payload
+    assert isinstance(payload, memoryview)
+    assert isinstance(payload.obj, mmap.mmap)
+    assert payload == DATA
+    assert file.filename == "f.bin"
+
+
+@pytest.mark.parametrize("cls,reader", FORMATS)
+def test_readers_slice_in_place(cls, reader):
+    # Slices of a memoryview keep its backing object, copies don't
+    backing = bytearray(make_file(cls))
+    file = reader().read("f", memoryview(backing))
+    payload = file.payload
+    assert isinstance(payload, memoryview)
+    assert payload.obj is backing
+    assert payload == DATA
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    for name in ("temp", "perm"):
+        (tmp_path / name).mkdir()
+    config = tmp_path / "config.toml"
+    config.write_text(CONFIG.format(folder=tmp_path))
+    monkeypatch.setenv("ITOKO_CONFIG", str(config))
+    return make_app().test_client()
+
+
+def upload(client, **form):
+    r = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(DATA), "f.bin"), **form},
+        headers={"Accept": "application/json"},
+    )
+    return r.get_json()["url"].split("/u/")[1]
+
+
+def test_blobs_are_sent_by_nginx(client):
+    digest = hashlib.sha256(DATA).hexdigest()
+    name = upload(client)
+    r = client.get("/u/" + name, headers={"Range": "bytes=0-9"})
+    assert r.status_code == 200
+    assert r.data == b""
+    assert r.headers["X-Accel-Redirect"] == "/_itoko/blobs/{}/{}/{}".format(
+        digest[:2], digest[2:4], digest
+    )
+    assert r.headers["ETag"].startswith('"')
+    assert "f.bin" in r.headers["Content-Disposition"]
+    # Bodiless answers are still up to itoko
+    r = client.head("/u/" + name)
+    assert "X-Accel-Redirect" not in r.headers
+    assert r.headers["Content-Length"] == str(len(DATA))
+
+
+def test_inline_payloads_are_sent_by_itoko(client):
+    url = upload(client, encrypt="1")
+    r = client.get("/u/" + url)
+    assert "X-Accel-Redirect" not in r.headers
+    assert r.data == DATA